@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+
+class GroupCodes:
+    """Group keys of several frames factorized once into shared dense integer codes"""
+
+    def __init__(self, codes, keys, group_cols):
+        self.codes = codes
+        self.keys = keys
+        self.group_cols = group_cols
+        self.n_groups = len(keys)
+        # per (frame, column) sorted (group, value) pairs for distinct counts
+        self.pairs = {}
+
+    def check(self, frames):
+        if len(frames) != len(self.codes) or any(len(df) != len(c) for df, c in zip(frames, self.codes)):
+            raise ValueError('group codes were encoded for other frames')
+
+    def distinct_pairs(self, frame_idx, df, column):
+        if (frame_idx, column) not in self.pairs:
+            value_codes = pd.factorize(df[column])[0]
+            self.pairs[(frame_idx, column)] = sort_pairs(self.codes[frame_idx], value_codes)
+        return self.pairs[(frame_idx, column)]
+
+
+def encode_groups(frames, group_cols):
+    """
+    Codes are shared between frames, so a group has the same code in every frame,
+    and follow the sorted order of the keys, as groupby does.
+    Rows with a missing key get code -1 and are skipped, as groupby(dropna=True) does.
+    """
+    sizes = [len(df) for df in frames]
+    columns = {col: pd.concat([df[col] for df in frames], ignore_index=True) for col in group_cols}
+    combined = np.zeros(sum(sizes), dtype='int64')
+    valid = np.ones(sum(sizes), dtype=bool)
+    for col in group_cols:
+        col_codes, col_uniques = pd.factorize(columns[col], sort=True)
+        radix = max(len(col_uniques), 1)
+        if combined.max(initial=0) >= np.iinfo('int64').max // radix - 1:
+            # keep the mixed radix within int64: compress the keys seen so far
+            combined = np.unique(combined, return_inverse=True)[1].reshape(-1)
+        combined = combined * radix + np.maximum(col_codes, 0)
+        valid &= col_codes >= 0
+    _, first_row, inverse = np.unique(combined[valid], return_index=True, return_inverse=True)
+    codes = np.full(len(combined), -1, dtype='int64')
+    codes[valid] = inverse.reshape(-1)
+    rows = np.flatnonzero(valid)[first_row]
+    keys = pd.DataFrame({col: columns[col].take(rows).reset_index(drop=True) for col in group_cols})
+    return GroupCodes(np.split(codes, np.cumsum(sizes)[:-1]), keys, list(group_cols))
+
+
+def group_count(codes, n_groups, mask=None):
+    keep = codes >= 0 if mask is None else (codes >= 0) & mask
+    return np.bincount(codes[keep], minlength=n_groups)
+
+
+def group_sum(codes, values, n_groups, mask=None):
+    """Sum skipping NaN, like groupby sum"""
+    keep = (codes >= 0) & ~np.isnan(values)
+    if mask is not None:
+        keep &= mask
+    return np.bincount(codes[keep], weights=values[keep], minlength=n_groups)
+
+
+def sort_pairs(codes, value_codes):
+    """Rows with a group and a value, sorted by (group, value)"""
+    rows = np.flatnonzero((codes >= 0) & (value_codes >= 0))
+    n_values = int(value_codes.max(initial=0)) + 1
+    pairs = codes[rows] * n_values + value_codes[rows]
+    order = np.argsort(pairs, kind='stable')
+    return rows[order], pairs[order], n_values
+
+
+def group_nunique(codes, value_codes, n_groups, mask=None, pairs=None):
+    """Sort-based distinct count of factorized values (-1 is missing) per group"""
+    rows, sorted_pairs, n_values = sort_pairs(codes, value_codes) if pairs is None else pairs
+    if mask is not None:
+        sorted_pairs = sorted_pairs[mask[rows]]
+    first = np.ones(len(sorted_pairs), dtype=bool)
+    first[1:] = sorted_pairs[1:] != sorted_pairs[:-1]
+    return np.bincount(sorted_pairs[first] // n_values, minlength=n_groups)
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+from .join import take
+from .prepare import cells_to_str, geo_to_cells, to_cells, unique_points
+
+
+## the same bucketing as the order and recprice queries
+DEFAULT_HEX_SIZE = 7
+GROUP_SPLIT = 50
+
+C1 = np.uint32(0xcc9e2d51)
+C2 = np.uint32(0x1b873593)
+
+
+def rotl32(x, r):
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def fmix32(h):
+    h ^= h >> np.uint32(16)
+    h *= np.uint32(0x85ebca6b)
+    h ^= h >> np.uint32(13)
+    h *= np.uint32(0xc2b2ae35)
+    h ^= h >> np.uint32(16)
+    return h
+
+
+def murmurhash3_32(keys, seed=0, signed=False):
+    """Vectorized MurmurHash3 x86_32 of utf-8 strings, uint32 (int32 when signed)"""
+    data = np.char.encode(np.asarray(keys, dtype=str), 'utf-8')
+    if not len(data):
+        return np.zeros(0, dtype=np.int32 if signed else np.uint32)
+    lengths = np.char.str_len(data).astype(np.uint32)
+    n_words = (data.dtype.itemsize + 3) // 4
+    # null-padded bytes as little-endian 4-byte words
+    blocks = np.zeros((len(data), n_words * 4), dtype=np.uint8)
+    blocks[:, :data.dtype.itemsize] = np.frombuffer(data.tobytes(), dtype=np.uint8).reshape(len(data), -1)
+    words = blocks.view('<u4')
+
+    h = np.full(len(data), seed, dtype=np.uint32)
+    n_blocks = lengths // 4
+    for i in range(n_words):
+        k = rotl32(words[:, i] * C1, 15) * C2
+        h = np.where(i < n_blocks, rotl32(h ^ k, 13) * np.uint32(5) + np.uint32(0xe6546b64), h)
+    # the tail bytes are followed by zero padding in their word
+    tail = np.take_along_axis(words, np.minimum(n_blocks, n_words - 1).astype(np.int64)[:, None], axis=1)[:, 0]
+    k = rotl32(tail * C1, 15) * C2
+    h = np.where(lengths % 4 > 0, h ^ k, h)
+    h = fmix32(h ^ lengths)
+    return h.view(np.int32) if signed else h
+
+
+def get_switch_index(df, df_exp, ts_column, overlap='latest'):
+    """
+    Position in df_exp of the switch window [switch_start_dttm, switch_finish_dttm) of the row's city
+    and order type (any order type if df_exp has none) containing the timestamp.
+    -1 when no window contains it: before the experiment, in a gap between windows or after it,
+    all of them are 'Before' as in the queries. overlap: see lookup_windows.
+    ValueError if only one of the timestamps and the windows is tz-aware
+    """
+    index = np.full(len(df), -1, dtype='int64')
+    df_exp = df_exp.reset_index(drop=True)
+    ts = pd.DatetimeIndex(df[ts_column])
+    tz_aware = ts.tz is not None
+    ts = to_ns(ts)
+    for (city_id, order_type), df_windows in df_exp.groupby(['city_id', 'order_type'], dropna=False):
+        rows = (df['city_id'] == city_id).to_numpy()
+        if not pd.isna(order_type):
+            rows = rows & (df['order_type'] == order_type).to_numpy()
+        position = lookup_windows(
+            ts[rows],
+            to_ns(df_windows['switch_start_dttm'], tz_aware),
+            to_ns(df_windows['switch_finish_dttm'], tz_aware),
+            overlap,
+        )
+        index[rows] = np.where(position >= 0, df_windows.index.to_numpy()[position], index[rows])
+    return index
+
+
+def lookup_windows(ts, starts, finishes, overlap='latest'):
+    """
+    Position of the window containing each timestamp, -1 if none, in O(n log k) for k windows.
+    overlap: 'latest' - the window with the latest start among the ones containing the timestamp,
+    'raise' - ValueError if windows overlap
+    """
+    if not len(starts):
+        return np.full(len(ts), -1, dtype='int64')
+    order = np.argsort(starts, kind='stable')
+    starts, finishes = starts[order], finishes[order]
+    ## the furthest finish of the windows started so far: past it no window contains the timestamp
+    reach = np.maximum.accumulate(finishes)
+    if overlap == 'raise' and (starts[1:] < reach[:-1]).any():
+        raise ValueError('switch windows overlap')
+    candidate = np.searchsorted(starts, ts, side='right') - 1
+    found = np.full(len(ts), -1, dtype='int64')
+    # a nested window can end before the timestamp while an earlier, longer one still contains it:
+    # step back only for those timestamps
+    pending = (candidate >= 0) & (ts < reach[np.maximum(candidate, 0)])
+    while pending.any():
+        rows = np.flatnonzero(pending)
+        hit = ts[rows] < finishes[candidate[rows]]
+        found[rows[hit]] = candidate[rows[hit]]
+        candidate[rows[~hit]] -= 1
+        pending[rows[hit]] = False
+        pending[rows[~hit]] = candidate[rows[~hit]] >= 0
+    return np.where(found >= 0, order[np.maximum(found, 0)], -1)
+
+
+def to_ns(values, tz_aware=None):
+    """
+    Timestamps as int64 nanoseconds (UTC for tz-aware ones), NaT as the minimal int64.
+    tz_aware: whether the timestamps they are compared with are tz-aware. ValueError if these are not alike:
+    naive local and tz-aware UTC timestamps would be compared as if both were UTC
+    """
+    values = pd.DatetimeIndex(values)
+    if tz_aware is not None and (values.tz is not None) != tz_aware:
+        raise ValueError(f"{'tz-aware' if tz_aware else 'naive'} timestamps looked up in "
+                         f"{'naive' if values.tz is None else 'tz-aware'} ones")
+    return values.as_unit('ns').asi8
+
+
+def assign_groups(df, df_exp, ts_column, group_column, signed=False):
+    """
+    Local version of the group assignment in get_order_query/get_recprice_query:
+    switch window by timestamp, hex_from at the experiment hexagon size, and for hex experiments
+    murmurhash32(exp_salt || switch_start_dttm_unix || hex_from) % 100 < 50 -> 'A', else 'Control'.
+    Rows out of the experiment windows are 'Before'
+    """
+    df_exp = df_exp.reset_index(drop=True)
+    if 'switch_start_dttm_unix' not in df_exp.columns:
+        df_exp['switch_start_dttm_unix'] = (
+            df_exp['switch_start_dttm'] - pd.Timestamp(0, tz='UTC')
+        ) // pd.Timedelta(seconds=1)
+    window = get_switch_index(df, df_exp, ts_column)
+    df['switch_start_dttm'] = take(df_exp['switch_start_dttm'], window, index=df.index)
+    df['switch_finish_dttm'] = take(df_exp['switch_finish_dttm'], window, index=df.index)
+
+    hex_sizes = take(df_exp['hexagon_size'], window).fillna(DEFAULT_HEX_SIZE).astype(int).to_numpy()
+    points = unique_points(df['fromlatitude'], df['fromlongitude'])
+    cells = np.zeros(len(df), dtype=np.uint64)
+    for hex_size in np.unique(hex_sizes):
+        rows = hex_sizes == hex_size
+        cells[rows] = geo_to_cells(df['fromlatitude'], df['fromlongitude'], hex_size, points=points)[rows]
+    df['hex_from'] = cells_to_str(cells)
+
+    ## hash every distinct (switch, hex) once
+    is_hex = take(df_exp['is_hex'], window).fillna(False).astype(bool).to_numpy() & (cells != 0)
+    cell_codes, cell_uniques = pd.factorize(cells[is_hex])
+    pairs, first, inverse = np.unique(
+        window[is_hex] * len(cell_uniques) + cell_codes, return_index=True, return_inverse=True
+    )
+    pair_window = window[is_hex][first]
+    keys = (
+        df_exp['exp_salt'].astype(str).to_numpy()[pair_window].astype(object)
+        + df_exp['switch_start_dttm_unix'].astype('int64').astype(str).to_numpy()[pair_window].astype(object)
+        + cells_to_str(cells[is_hex][first]).astype(object)
+    )
+    mmhash = murmurhash3_32(keys.astype(str), signed=signed).astype(np.int64)[inverse.reshape(-1)]
+
+    groups = take(df_exp['group_name'], window).fillna('Before').to_numpy(dtype=object, copy=True)
+    # BigQuery MOD keeps the sign of the dividend
+    groups[is_hex] = np.where(np.fmod(mmhash, 100) < GROUP_SPLIT, 'A', 'Control')
+    df[group_column] = groups
+    return df
+
+
+def verify_groups(df, df_exp, ts_column, group_column, signed=False):
+    """
+    Re-assigns the groups of downloaded rows locally. Prints the share of rows with the same
+    group and hex_from as in BigQuery and returns the rows that differ
+    """
+    local = assign_groups(
+        df[['city_id', 'order_type', ts_column, 'fromlatitude', 'fromlongitude']].copy(),
+        df_exp, ts_column, group_column, signed,
+    )
+    same_group = (local[group_column] == df[group_column]).to_numpy()
+    expected = to_cells(df['hex_from'])
+    same_hex = (to_cells(local['hex_from']) == expected) | (expected == 0)
+    print(f'{group_column}: доля совпадений: {round(same_group.mean(), 4)}')
+    print(f'hex_from: доля совпадений: {round(same_hex.mean(), 4)}')
+    df_diff = df[~(same_group & same_hex)].copy()
+    df_diff[f'local_{group_column}'] = local.loc[df_diff.index, group_column]
+    return df_diff
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+from .bootstrap import resample_weights
+
+
+class DistanceBins:
+    """
+    Cumulative sums and counts of value_column over fine distance bins, one row per switch interval:
+    any bin_size that is a multiple of fine_size is re-aggregated from them in O(bins),
+    without a new groupby
+    """
+
+    def __init__(self, df, distance_column='distance', value_column='recprice', fine_size=10,
+                 interval_cols=['switch_start_dttm'], groups={"control": "Control", "treatment": "A"}):
+        df = df[df['group_name'].isin([groups['control'], groups['treatment']])]
+        df = df[df[distance_column].notnull() & df[value_column].notnull()]
+        self.fine_size = fine_size
+        fine = (df[distance_column].to_numpy(dtype=float) // fine_size).astype('int64')
+        self.fine_start = fine.min() if len(fine) else 0
+        fine -= self.fine_start
+        self.n_fine = fine.max() + 1 if len(fine) else 0
+        codes, intervals = pd.MultiIndex.from_frame(df[['group_name'] + interval_cols]).factorize()
+        self.intervals = intervals.to_frame(index=False, name=['group_name'] + interval_cols)
+        self.is_treatment = (self.intervals['group_name'] == groups['treatment']).to_numpy()
+        flat = codes * self.n_fine + fine
+        size = len(intervals) * self.n_fine
+        sums = np.bincount(flat, df[value_column].to_numpy(dtype=float), size).reshape(len(intervals), self.n_fine)
+        counts = np.bincount(flat, minlength=size).reshape(len(intervals), self.n_fine)
+        ## a leading zero column: the sum of fine bins [i, j) is cum[:, j] - cum[:, i]
+        self.cum_sums = np.pad(np.cumsum(sums, axis=1), ((0, 0), (1, 0)))
+        self.cum_counts = np.pad(np.cumsum(counts, axis=1), ((0, 0), (1, 0)))
+
+    def aggregate(self, bin_size):
+        """Bin starts (distance // bin_size * bin_size) and interval x bin sums and counts"""
+        if bin_size % self.fine_size:
+            raise ValueError(f'bin_size must be a multiple of fine_size={self.fine_size}')
+        step = bin_size // self.fine_size
+        first = (self.fine_start // step) * step
+        ## bin edges in fine bins relative to fine_start, clipped to the precomputed range
+        edges = np.arange(first, self.fine_start + self.n_fine + step, step)
+        positions = np.clip(edges - self.fine_start, 0, self.n_fine)
+        sums = np.diff(self.cum_sums[:, positions], axis=1)
+        counts = np.diff(self.cum_counts[:, positions], axis=1)
+        return edges[:-1] * self.fine_size, sums, counts
+
+
+def find_crossings(x, diff, y):
+    """
+    Crossings of two lines given by their difference diff and one of them y at points x,
+    over the last axis (any leading shape, e.g. resamples): a sign change between consecutive
+    non-NaN points, linearly interpolated. Returns the is-crossing mask of the right points
+    and the x and y of the crossing there
+    """
+    valid = ~np.isnan(diff)
+    position = np.where(valid, np.arange(diff.shape[-1]), -1)
+    ## the previous non-NaN point of every point
+    previous = np.maximum.accumulate(position, axis=-1)
+    previous = np.concatenate([np.full(previous.shape[:-1] + (1,), -1), previous[..., :-1]], axis=-1)
+    safe = np.maximum(previous, 0)
+    d1, d2 = np.take_along_axis(diff, safe, axis=-1), diff
+    y1, y2 = np.take_along_axis(y, safe, axis=-1), y
+    x1, x2 = np.asarray(x, dtype=float)[safe], np.broadcast_to(np.asarray(x, dtype=float), diff.shape)
+    is_crossing = valid & (previous >= 0) & (d1 * d2 < 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = d1 / (d1 - d2)
+        return is_crossing, x1 + share * (x2 - x1), y1 + share * (y2 - y1)
+
+
+def first_crossing(is_crossing, x_cross, y_cross):
+    """x and y of the first crossing along the last axis, NaN without one"""
+    first = np.argmax(is_crossing, axis=-1)[..., None]
+    found = is_crossing.any(axis=-1)
+    return (np.where(found, np.take_along_axis(x_cross, first, axis=-1)[..., 0], np.nan),
+            np.where(found, np.take_along_axis(y_cross, first, axis=-1)[..., 0], np.nan))
+
+
+def group_means(sums, counts, is_treatment, weights_control=None, weights_treatment=None):
+    """Mean value per bin of control and treatment, optionally of weighted (resampled) intervals"""
+    means = []
+    for rows, weights in [(~is_treatment, weights_control), (is_treatment, weights_treatment)]:
+        if weights is None:
+            total, n = sums[rows].sum(axis=0), counts[rows].sum(axis=0)
+        else:
+            total, n = weights @ sums[rows], weights @ counts[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means.append(np.where(n > 0, total / n, np.nan))
+    return means
+
+
+def find_axis_price(df_full, bin_size=300, distance_bins=None, n_resamples=1000, alpha=0.05, method='poisson',
+                    batch_size=200, random_state=42, **kwargs):
+    """
+    The axis point of effects.ipynb: where the mean recprice of A and Control per distance bin cross.
+    Returns all crossings (distance and recprice, the first one is the axis_price of the notebook)
+    and the bootstrap of the first crossing over switch intervals resampled within each group:
+    its CIs and the share of resamples with a crossing.
+    distance_bins: a DistanceBins of df_full to reuse between bin sizes, kwargs go to DistanceBins
+    """
+    if distance_bins is None:
+        distance_bins = DistanceBins(df_full, **kwargs)
+    x, sums, counts = distance_bins.aggregate(bin_size)
+    is_treatment = distance_bins.is_treatment
+    mean_control, mean_treatment = group_means(sums, counts, is_treatment)
+    is_crossing, x_cross, y_cross = find_crossings(x, mean_treatment - mean_control, mean_treatment)
+    df_crossings = pd.DataFrame({'distance': x_cross[is_crossing], 'axis_price': y_cross[is_crossing]})
+
+    rng = np.random.default_rng(random_state)
+    boot_x, boot_y = [], []
+    for start in range(0, n_resamples, batch_size):
+        size = min(batch_size, n_resamples - start)
+        weights_control = resample_weights((~is_treatment).sum(), size, method, rng)
+        weights_treatment = resample_weights(is_treatment.sum(), size, method, rng)
+        control, treatment = group_means(sums, counts, is_treatment, weights_control, weights_treatment)
+        crossing_x, crossing_y = first_crossing(*find_crossings(x, treatment - control, treatment))
+        boot_x.append(crossing_x)
+        boot_y.append(crossing_y)
+    boot_x, boot_y = np.concatenate(boot_x), np.concatenate(boot_y)
+
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    found = ~np.isnan(boot_x)
+    point_x, point_y = first_crossing(is_crossing, x_cross, y_cross)
+    ci = pd.Series({
+        'distance': float(point_x), 'axis_price': float(point_y), 'crossing_share': found.mean(),
+    })
+    for name, values in [('distance', boot_x), ('axis_price', boot_y)]:
+        low, high = np.percentile(values[found], q) if found.any() else (np.nan, np.nan)
+        ci[f'{name}_ci_low'], ci[f'{name}_ci_high'] = low, high
+    return df_crossings, ci
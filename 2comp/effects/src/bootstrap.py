@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+from .metrics import METRIC_LIST, get_switchback_results
+
+
+def interval_strata(df, by=['day', 'hour'], ts_column='switch_start_dttm'):
+    """
+    Codes of the strata of the intervals: 'day', 'hour', 'weekday' of the switch start
+    or any other column of df
+    """
+    ts = pd.to_datetime(df[ts_column]) if ts_column in df.columns else None
+    keys = []
+    for key in by:
+        if key == 'day':
+            keys.append(ts.dt.floor('D'))
+        elif key == 'hour':
+            keys.append(ts.dt.hour)
+        elif key == 'weekday':
+            keys.append(ts.dt.weekday)
+        else:
+            keys.append(df[key])
+    if not keys:
+        return np.zeros(len(df), dtype='int64')
+    return pd.MultiIndex.from_arrays(keys).factorize()[0]
+
+
+def resample_weights(n, size, method='poisson', rng=None):
+    """
+    Bootstrap weights of n intervals, size x n: Poisson(1) counts or
+    multinomial counts summing to n (the classic bootstrap)
+    """
+    rng = np.random.default_rng(rng)
+    if method == 'poisson':
+        return rng.poisson(1.0, (size, n)).astype(float)
+    if method == 'multinomial':
+        return rng.multinomial(n, np.full(n, 1 / n), size=size).astype(float) if n else np.zeros((size, 0))
+    raise ValueError(f'unknown method {method}')
+
+
+def mixed_strata(strata, is_treatment):
+    """Mask of the intervals whose stratum holds both groups: only these can change group in a permutation"""
+    n = np.bincount(strata)
+    n_treatment = np.bincount(strata, is_treatment, len(n))
+    return ((n_treatment > 0) & (n_treatment < n))[strata]
+
+
+def permute_within(strata, size, rng=None):
+    """size x n permutations of positions 0..n-1 that move an interval only within its stratum"""
+    rng = np.random.default_rng(rng)
+    order = np.argsort(strata, kind='stable')
+    ## sorted strata codes plus a uniform key < 1: argsort shuffles inside every block only
+    keys = strata[order][None, :] + rng.random((size, len(strata)))
+    return order[np.argsort(keys, axis=1)], order
+
+
+def bootstrap_ratios(numerators, denominators, size, method='poisson', batch_size=1000, rng=None):
+    """Ratio of sums of every resample and metric, size x metrics, as weights @ numerators / weights @ denominators"""
+    rng = np.random.default_rng(rng)
+    ratios = np.empty((size, numerators.shape[1]))
+    for start in range(0, size, batch_size):
+        weights = resample_weights(len(numerators), min(batch_size, size - start), method, rng)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios[start:start + len(weights)] = (weights @ numerators) / (weights @ denominators)
+    return ratios
+
+
+def bootstrap_group_ratios(numerators, denominators, is_treatment, units, size, method='poisson', batch_size=1000,
+                           rng=None):
+    """
+    Ratios of sums of control and treatment, each size x metrics, with the resampling units
+    (codes 0..n-1 of the rows) drawn jointly: the rows of a unit in both groups get the same weight
+    """
+    rng = np.random.default_rng(rng)
+    n_units = units.max() + 1 if len(units) else 0
+    control, treatment = np.empty((size, numerators.shape[1])), np.empty((size, numerators.shape[1]))
+    for start in range(0, size, batch_size):
+        weights = resample_weights(n_units, min(batch_size, size - start), method, rng)[:, units]
+        for ratios, rows in [(control, ~is_treatment), (treatment, is_treatment)]:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios[start:start + len(weights)] = (
+                    (weights[:, rows] @ numerators[rows]) / (weights[:, rows] @ denominators[rows])
+                )
+    return control, treatment
+
+
+def permutation_uplifts(numerators, denominators, is_treatment, strata, size, batch_size=1000, rng=None):
+    """Ratio differences treatment - control, size x metrics, with the group labels permuted within strata"""
+    rng = np.random.default_rng(rng)
+    uplifts = np.empty((size, numerators.shape[1]))
+    x_total, y_total = numerators.sum(axis=0), denominators.sum(axis=0)
+    for start in range(0, size, batch_size):
+        permutation, order = permute_within(strata, min(batch_size, size - start), rng)
+        labels = np.empty(permutation.shape, dtype=float)
+        labels[:, order] = is_treatment[permutation]
+        x_t, y_t = labels @ numerators, labels @ denominators
+        with np.errstate(divide='ignore', invalid='ignore'):
+            uplifts[start:start + len(labels)] = x_t / y_t - (x_total - x_t) / (y_total - y_t)
+    return uplifts
+
+
+def get_switchback_results_bootstrap(df, alpha, metric_list=METRIC_LIST, groups={"control": "Control", "treatment": "A"},
+                                     n_resamples=10000, method='poisson', permutation=True, strata=['weekday'],
+                                     ts_column='switch_start_dttm', equal_var=True, batch_size=1000, random_state=42):
+    """
+    get_switchback_results with resampling of the switch intervals next to the t-test:
+    percentile CIs of uplift_abs and uplift_rel from a bootstrap within each group and,
+    when permutation, a p-value of the ratio difference with the group labels permuted within strata
+    (interval_strata keys; strata=None permutes over all intervals).
+    When control and treatment share intervals (hex experiments), the intervals of ts_column are resampled
+    jointly with the same weights for both groups instead.
+    Only strata with both groups can permute: strata as fine as the intervals (['day', 'hour']) would give
+    a p-value of 1, so without any such stratum the labels are permuted over all intervals.
+    All metrics share every resample
+    """
+    df_res = get_switchback_results(df, alpha, metric_list, groups, equal_var)
+    metric_list = [i for i in metric_list if i[0] in set(df_res['metric'])]
+    rng = np.random.default_rng(random_state)
+    df = df[df['group_name'].isin([groups['control'], groups['treatment']])]
+    numerators = df[[i[1] for i in metric_list]].fillna(0).to_numpy(dtype=float)
+    denominators = df[[i[2] for i in metric_list]].fillna(0).to_numpy(dtype=float)
+    is_treatment = (df['group_name'] == groups['treatment']).to_numpy()
+
+    intervals = pd.factorize(df[ts_column])[0] if ts_column in df.columns else np.arange(len(df))
+    if mixed_strata(intervals, is_treatment).any():
+        ## a resampled interval brings its control and treatment rows together
+        control, treatment = bootstrap_group_ratios(numerators, denominators, is_treatment, intervals,
+                                                    n_resamples, method, batch_size, rng)
+    else:
+        ## resampling within each group keeps the numbers of control and treatment intervals
+        control = bootstrap_ratios(numerators[~is_treatment], denominators[~is_treatment],
+                                   n_resamples, method, batch_size, rng)
+        treatment = bootstrap_ratios(numerators[is_treatment], denominators[is_treatment],
+                                     n_resamples, method, batch_size, rng)
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, values in [('uplift_abs', treatment - control), ('uplift_rel', treatment / control - 1)]:
+            values = np.where(np.isfinite(values), values, np.nan)
+            low, high = np.nanpercentile(values, q, axis=0) if len(values) else (np.nan, np.nan)
+            df_res[f'{name}_ci_low'], df_res[f'{name}_ci_high'] = low, high
+
+    if permutation:
+        codes = interval_strata(df, strata, ts_column) if strata else np.zeros(len(df), dtype='int64')
+        mixed = mixed_strata(codes, is_treatment)
+        if not mixed.all():
+            print(f"Warning: {(~mixed).sum()} of {len(codes)} intervals are in strata {strata} without both groups")
+        if len(codes) and not mixed.any():
+            print("Warning: no stratum with both groups, permuting over all intervals")
+            codes = np.zeros(len(df), dtype='int64')
+        uplifts = permutation_uplifts(numerators, denominators, is_treatment, codes, n_resamples, batch_size, rng)
+        observed = df_res['uplift_abs'].to_numpy(dtype=float)
+        ## (1 + #as extreme) / (1 + #resamples); resamples with an empty group do not count
+        finite = np.isfinite(uplifts)
+        extreme = (np.abs(uplifts) >= np.abs(observed) * (1 - 1e-12)) & finite
+        df_res['permutation_pvalue'] = np.where(
+            np.isfinite(observed), (1 + extreme.sum(axis=0)) / (1 + finite.sum(axis=0)), np.nan
+        )
+    return df_res
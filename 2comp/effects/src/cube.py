@@ -0,0 +1,197 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .aggregate import encode_groups, group_count, group_nunique, group_sum
+from .join import JoinIndex
+from .metrics import METRIC_REGISTRY, aggregate_source_dense, eval_condition, is_integer_metric
+
+CUBE_GROUP_COLS = ['group_name', 'switch_start_dttm', 'switch_finish_dttm']
+BIN_COLS = ['surge_bin', 'orders_distance_bin']
+FINE_SURGE_STEP = 0.05
+FINE_DISTANCE_STEP = 0.1
+MISSING_SUFFIX = '__missing'
+IDS_SUFFIX = '__ids'
+
+
+def fine_index(values, step):
+    """
+    Fine bin of every value, floor(values / step). The epsilon keeps values on a bin edge
+    (1.5 / 0.05 = 29.999...) in the bin they start, as // with a binary-exact step does
+    """
+    return np.floor(np.asarray(values, dtype=float) / step + 1e-9)
+
+
+def multi_cell_ids(codes, ids, n_groups):
+    """
+    Ids (factorized, -1 is missing) found in more than one group, as an int64 array of them per group.
+    Distinct counts of groups merged together are their sum less the repeats of these ids
+    """
+    keep = (codes >= 0) & (ids >= 0)
+    n_ids = int(ids.max(initial=0)) + 1
+    pairs = np.unique(codes[keep] * n_ids + ids[keep])
+    cell, cell_ids = pairs // n_ids, pairs % n_ids
+    multi = np.bincount(cell_ids, minlength=n_ids)[cell_ids] > 1
+    cell, cell_ids = cell[multi], cell_ids[multi]
+    bounds = np.searchsorted(cell, np.arange(n_groups + 1))
+    res = np.empty(n_groups, dtype=object)
+    res[:] = [cell_ids[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    return res
+
+
+class MetricCube:
+    """
+    Registry metrics of every group x fine surge bin x fine distance bin cell.
+    A metric is NaN in a cell where its filter keeps no rows, so coarser cells are sums of the fine ones
+    with NaN only when all of them are. Distinct counts are summed too, less the repeats of the ids that fall
+    in several cells (a calcprice with orders at different distances), kept per cell as <metric>__ids
+    """
+
+    def __init__(self, cells, registry, integer, group_cols, fine_surge_step, fine_distance_step,
+                 bound_dynamic_surge):
+        self.cells = cells
+        self.registry = registry
+        self.integer = integer
+        self.group_cols = group_cols
+        self.fine_surge_step = fine_surge_step
+        self.fine_distance_step = fine_distance_step
+        self.bound_dynamic_surge = bound_dynamic_surge
+        ## the multi-cell ids as flat (cell, id) arrays
+        self.ids = {}
+        for name, _, _, how, _ in registry:
+            if how == 'nunique':
+                cell_ids = cells[f'{name}{IDS_SUFFIX}']
+                lengths = cell_ids.map(len).to_numpy()
+                self.ids[name] = (np.repeat(np.arange(len(cells)), lengths),
+                                  np.concatenate([np.zeros(0, dtype='int64')] + cell_ids[lengths > 0].to_list())
+                                  .astype('int64'))
+
+    def coarse_bins(self, column, step, fine_step, upper):
+        ratio = step / fine_step
+        if not np.isclose(ratio, round(ratio)) or round(ratio) < 1:
+            raise ValueError(f'step {step} must be a multiple of the cube step {fine_step}')
+        bins = (self.cells[column].to_numpy(dtype='int64') // round(ratio)) * float(step)
+        return np.minimum(bins, upper)
+
+    def metrics(self, group_cols, step_surge_bin=0.5, step_orders_distance_bin=5,
+                filtered_surge_bin=np.unique([1.0, 1.5, 2.0]), filtered_dist_bins=np.arange(0, 25 + 1, 5)):
+        """
+        calculate_metrics(group_cols) of the prepare_my frames with these steps and clips, from the cube cells.
+        group_cols: any of the cube group columns, 'surge_bin' and 'orders_distance_bin'.
+        Steps exact in binary (0.25, 0.5, 1, 5) give the same bins as prepare_my; with others (0.1)
+        a value on a bin edge stays in the bin it starts, where // may put it one bin lower (1.0 // 0.1 == 9).
+        ValueError without both bin columns: the cube has no rows without a surge or a distance
+        """
+        if not set(BIN_COLS) <= set(group_cols):
+            raise ValueError(f'group_cols must include {BIN_COLS}')
+        cells = self.cells[[col for col in group_cols if col in self.cells.columns]].copy()
+        cells['surge_bin'] = self.coarse_bins('surge_fine', step_surge_bin, self.fine_surge_step,
+                                              max(filtered_surge_bin))
+        cells['orders_distance_bin'] = self.coarse_bins('distance_fine', step_orders_distance_bin,
+                                                        self.fine_distance_step, max(filtered_dist_bins))
+        group_codes = encode_groups([cells], group_cols)
+        codes, n_groups = group_codes.codes[0], group_codes.n_groups
+        # cells with a missing key are dropped when grouping by it, as groupby(dropna=True) does
+        missing = np.zeros(len(cells), dtype=bool)
+        for col in group_cols:
+            if col in self.group_cols:
+                missing |= self.cells[f'{col}{MISSING_SUFFIX}'].to_numpy()
+        codes = np.where(missing, -1, codes)
+        # groups of the first registry source (df_recprice) are the base of the left join
+        base = group_sum(codes, self.cells[f'{self.registry[0][1]}_rows'].to_numpy(dtype=float), n_groups) > 0
+        columns = {}
+        for name, _, _, how, _ in self.registry:
+            values = self.cells[name].to_numpy(dtype=float)
+            has_rows = group_count(codes, n_groups, ~np.isnan(values)) > 0
+            values = group_sum(codes, values, n_groups)
+            if how == 'nunique':
+                values -= self.repeated_ids(name, codes, n_groups)
+            values = np.where(has_rows, values, np.nan)[base]
+            if self.integer[name] and not np.isnan(values).any():
+                values = np.round(values).astype('int64')
+            columns[name] = values
+        return pd.concat([group_codes.keys[base].reset_index(drop=True), pd.DataFrame(columns)], axis=1)
+
+    def repeated_ids(self, name, codes, n_groups):
+        """Per coarse group, how many times its multi-cell ids of the metric are counted more than once"""
+        cells, ids = self.ids[name]
+        groups = codes[cells]
+        return group_count(groups, n_groups) - group_nunique(groups, ids, n_groups)
+
+    def save(self, path):
+        """Parquet with the cube parameters in the schema metadata"""
+        table = pa.Table.from_pandas(self.cells, preserve_index=False)
+        meta = {
+            'registry': self.registry, 'integer': self.integer, 'group_cols': self.group_cols,
+            'fine_surge_step': self.fine_surge_step, 'fine_distance_step': self.fine_distance_step,
+            'bound_dynamic_surge': self.bound_dynamic_surge,
+        }
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'metric_cube': json.dumps(meta)})
+        pq.write_table(table, path, compression='zstd')
+
+
+def load_cube(path):
+    table = pq.read_table(path)
+    meta = json.loads(table.schema.metadata[b'metric_cube'])
+    return MetricCube(table.to_pandas(), meta['registry'], meta['integer'], meta['group_cols'],
+                      meta['fine_surge_step'], meta['fine_distance_step'], meta['bound_dynamic_surge'])
+
+
+def build_cube(df_recprice_prepared, df_orders_prepared, df_full, bound_dynamic_surge=0.0,
+               fine_surge_step=FINE_SURGE_STEP, fine_distance_step=FINE_DISTANCE_STEP,
+               group_cols=CUBE_GROUP_COLS, registry=METRIC_REGISTRY, join_index=None):
+    """
+    One pass over the prepared frames at the finest grain: the joins and the surge bound of prepare_my,
+    then every registry metric per group x fine surge bin x fine distance bin.
+    Rows without a surge or a distance are dropped, as calculate_metrics drops missing bins.
+    MetricCube.metrics serves any coarser steps and clips of prepare_my without rescanning the rows
+    """
+    if join_index is None:
+        join_index = JoinIndex(df_orders_prepared, df_recprice_prepared, on='calcprice_uuid')
+    df_recprice = join_index.join(df_recprice_prepared, df_orders_prepared, ['distance_in_km'], reverse=True)
+    df_order = join_index.join(df_orders_prepared, df_recprice_prepared, ['original_dynamic_surge_updated'])
+    frames = {'recprice': df_recprice, 'order': df_order, 'full': df_full}
+    for source, df in frames.items():
+        df = df[df['original_dynamic_surge_updated'] > bound_dynamic_surge].copy()
+        df['surge_fine'] = fine_index(df['original_dynamic_surge_updated'], fine_surge_step)
+        df['distance_fine'] = fine_index(df['distance_in_km'], fine_distance_step)
+        ## 'Before' rows have no switch window: a missing key is a flag of the cell, so that they
+        ## still count when the query does not group by that column
+        for col in group_cols:
+            df[f'{col}{MISSING_SUFFIX}'] = df[col].isnull().to_numpy()
+        frames[source] = df
+    for col in group_cols:
+        values = pd.concat([df[col] for df in frames.values()], ignore_index=True).dropna()
+        for df in frames.values():
+            if len(values):
+                df[col] = df[col].fillna(values.iloc[0])
+
+    cell_cols = list(group_cols) + [f'{col}{MISSING_SUFFIX}' for col in group_cols] + ['surge_fine', 'distance_fine']
+    group_codes = encode_groups(list(frames.values()), cell_cols)
+    columns = {}
+    for frame_idx, (source, df) in enumerate(frames.items()):
+        codes = group_codes.codes[frame_idx]
+        columns[f'{source}_rows'] = group_count(codes, group_codes.n_groups).astype('int32')
+        source_registry = [i for i in registry if i[1] == source]
+        if source_registry:
+            columns.update(aggregate_source_dense(df, frame_idx, group_codes, source_registry))
+        ## the reverse join copies a calcprice to the distance of each of its orders
+        terms = {}
+        for name, _, column, how, condition in source_registry:
+            if how == 'nunique':
+                ids = pd.factorize(df[column])[0]
+                if condition is not None:
+                    ids = np.where(eval_condition(df, condition, terms), ids, -1)
+                columns[f'{name}{IDS_SUFFIX}'] = multi_cell_ids(codes, ids, group_codes.n_groups)
+    cells = pd.concat([group_codes.keys, pd.DataFrame({
+        **{name: columns[name] for name, _, _, _, _ in registry},
+        **{f'{name}{IDS_SUFFIX}': columns[f'{name}{IDS_SUFFIX}'] for name, _, _, how, _ in registry if how == 'nunique'},
+        **{f'{source}_rows': columns[f'{source}_rows'] for source in frames},
+    })], axis=1)
+    cells = cells.astype({'surge_fine': 'int32', 'distance_fine': 'int32'})
+    integer = {name: bool(is_integer_metric(frames[source][column], how)) for name, source, column, how, _ in registry}
+    return MetricCube(cells, [list(i) for i in registry], integer, list(group_cols), fine_surge_step,
+                      fine_distance_step, bound_dynamic_surge)
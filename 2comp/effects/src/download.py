@@ -1,17 +1,29 @@
+import hashlib
+import json
+import os
+import pathlib
 import warnings
 
 warnings.filterwarnings("ignore")
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from google.cloud import bigquery
 
+from .schema import ORDER_SCHEMA, RECPRICE_SCHEMA, apply_schema, read_parquet
+
 client = bigquery.Client(project='analytics-dev-333113')
 
+CACHE_DIR = pathlib.Path('data/cache')
+CACHE_MAX_BYTES = 20 * 1024 ** 3
+PARTITION_LAG = pd.Timedelta(hours=3)
+
 
-def download_experiment_data(exp_id, user_name):
-    tmp_query = f"""
+def get_experiment_table_query(exp_id, user_name):
+    return f"""
     CREATE OR REPLACE TABLE `analytics-dev-333113.temp.{user_name}_exp`
     OPTIONS(
       expiration_timestamp=TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 1 DAY)
@@ -173,16 +185,47 @@ def download_experiment_data(exp_id, user_name):
     ORDER BY exp_id, switch_start_dttm, switch_finish_dttm
     )
     """
+
+
+## the order and recprice queries join the {user_name}_exp table of download_experiment_data.
+## It is created on the first query that misses the cache, once per process:
+## a rerun with a warm cache does not query BigQuery at all
+EXP_IDS = {}
+EXP_TABLES = {}
+
+
+def create_experiment_table(exp_id, user_name, refresh=False):
+    if refresh or EXP_TABLES.get(user_name) != exp_id:
+        client.query(get_experiment_table_query(exp_id, user_name)).result()
+        EXP_TABLES[user_name] = exp_id
+
+
+def ensure_experiment_table(user_name, exp_id=None):
+    """Creates the table of exp_id (by default the last download_experiment_data of user_name)"""
+    exp_id = EXP_IDS.get(user_name) if exp_id is None else exp_id
+    if exp_id is not None:
+        create_experiment_table(exp_id, user_name)
+
+
+def download_experiment_data(exp_id, user_name, refresh=False):
+    EXP_IDS[user_name] = exp_id
     query = f"""
     SELECT *
     FROM `analytics-dev-333113.temp.{user_name}_exp`
     """
-    client.query(tmp_query).result()
-    return client.query(query).to_dataframe()
+    # the table content depends on exp_id only
+    path = get_cache_path('experiment', {'exp_id': exp_id})
+    if path.exists() and not refresh:
+        os.utime(path)
+        return read_parquet(path)
+    create_experiment_table(exp_id, user_name, refresh)
+    df = client.query(query).to_dataframe()
+    write_cache(df, path)
+    return df
 
 
-def download_order_data(start_date, stop_date, city_id, order_type, user_name):
-    query = f"""
+def get_order_query(start_date, stop_date, city_id, order_type, user_name):
+    return f"""
     WITH
     details_prepare AS (
         SELECT *
@@ -352,11 +395,10 @@ def download_order_data(start_date, stop_date, city_id, order_type, user_name):
         ) _
     ) _
     """
-    return client.query(query).to_dataframe()
 
 
-def download_recprice_data(start_date, stop_date, city_id, order_type, user_name):
-    query = f"""
+def get_recprice_query(start_date, stop_date, city_id, order_type, user_name):
+    return f"""
     WITH
     recprice_tbl AS (
         SELECT *
@@ -457,4 +499,182 @@ def download_recprice_data(start_date, stop_date, city_id, order_type, user_name
         ) _
     ) _
     """
-    return client.query(query).to_dataframe()
+
+
+def download_order_data(start_date, stop_date, city_id, order_type, user_name, exp_id=None, refresh=False,
+                        compact=False):
+    query = get_order_query(start_date, stop_date, city_id, order_type, user_name)
+    params = dict(start_date=start_date, stop_date=stop_date, city_id=city_id, order_type=order_type, exp_id=exp_id)
+    df = query_to_dataframe(query, params if exp_id is not None else None, refresh,
+                            on_miss=lambda: ensure_experiment_table(user_name, exp_id))
+    return apply_schema(df, ORDER_SCHEMA) if compact else df
+
+
+def download_recprice_data(start_date, stop_date, city_id, order_type, user_name, exp_id=None, refresh=False,
+                           compact=False):
+    query = get_recprice_query(start_date, stop_date, city_id, order_type, user_name)
+    params = dict(start_date=start_date, stop_date=stop_date, city_id=city_id, order_type=order_type, exp_id=exp_id)
+    df = query_to_dataframe(query, params if exp_id is not None else None, refresh,
+                            on_miss=lambda: ensure_experiment_table(user_name, exp_id))
+    return apply_schema(df, RECPRICE_SCHEMA) if compact else df
+
+
+# Streaming
+## results come as pyarrow.RecordBatch through the BigQuery Storage Read API and never as one DataFrame.
+## bq_client can be any object with bq_client.query(query).result().to_arrow_iterable()
+def get_bqstorage_client():
+    """Storage Read API client with the default credentials, None without google-cloud-bigquery-storage"""
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return None
+    return bigquery_storage.BigQueryReadClient()
+
+
+def stream_query_batches(query, bq_client=None, bqstorage_client=None):
+    """
+    bqstorage_client: by default a Storage Read API client for the module client and none for an injected one.
+    Without it the batches come page by page through the REST API
+    """
+    if bq_client is None:
+        bq_client = client
+        bqstorage_client = get_bqstorage_client() if bqstorage_client is None else bqstorage_client
+    rows = bq_client.query(query).result()
+    yield from rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+
+
+def stream_order_data(start_date, stop_date, city_id, order_type, user_name, bq_client=None, bqstorage_client=None):
+    query = get_order_query(start_date, stop_date, city_id, order_type, user_name)
+    if bq_client is None:
+        ensure_experiment_table(user_name)
+    return stream_query_batches(query, bq_client, bqstorage_client)
+
+
+def stream_recprice_data(start_date, stop_date, city_id, order_type, user_name, bq_client=None,
+                         bqstorage_client=None):
+    query = get_recprice_query(start_date, stop_date, city_id, order_type, user_name)
+    if bq_client is None:
+        ensure_experiment_table(user_name)
+    return stream_query_batches(query, bq_client, bqstorage_client)
+
+
+def write_batches_to_parquet(batches, path, schema=None):
+    """
+    Writes record batches one by one, returns the number of rows.
+    An empty result is written as an empty file with schema (no columns without it), so that it can be read back
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    writer = None
+    rows = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, pa.schema([]) if schema is None else schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, path)
+    return rows
+
+
+# Incremental pricing logs
+## data/exp_id=.../recprice/utc_date=YYYY-MM-DD/part-0.pqt, one partition per UTC date.
+## A partition written before its date was over (plus PARTITION_LAG for late rows) is downloaded again
+def download_recprice_data_incremental(start_date, stop_date, city_id, order_type, user_name, exp_id,
+                                       data_root=None, refresh=False):
+    root = pathlib.Path(f'data/exp_id={exp_id}/recprice') if data_root is None else pathlib.Path(data_root)
+    dates = pd.date_range(start_date, stop_date, freq='D')
+    to_download = [i for i in dates if refresh or not is_partition_complete(get_partition_path(root, i), i)]
+    if to_download:
+        ensure_experiment_table(user_name, exp_id)
+    for run_start, run_stop in get_date_runs(to_download):
+        print(f'downloading {run_start.date()} - {run_stop.date()}')
+        df = download_recprice_data(
+            start_date=str(run_start.date()),
+            stop_date=str(run_stop.date()),
+            city_id=city_id,
+            order_type=order_type,
+            user_name=user_name,
+        )
+        utc_date = df['utc_recprice_dttm'].dt.tz_localize(None).dt.normalize()
+        for date in pd.date_range(run_start, run_stop, freq='D'):
+            write_partition(df[utc_date == date], get_partition_path(root, date))
+    return pd.concat([read_parquet(get_partition_path(root, i)) for i in dates], ignore_index=True)
+
+
+def get_partition_path(root, date):
+    return root / f'utc_date={date.date()}' / 'part-0.pqt'
+
+
+def is_partition_complete(path, date):
+    if not path.exists():
+        return False
+    written = pd.Timestamp(path.stat().st_mtime, unit='s')
+    return written >= date + pd.Timedelta(days=1) + PARTITION_LAG
+
+
+def get_date_runs(dates):
+    """Contiguous [start, stop] runs of sorted dates"""
+    runs = []
+    for date in dates:
+        if runs and date - runs[-1][1] == pd.Timedelta(days=1):
+            runs[-1][1] = date
+        else:
+            runs.append([date, date])
+    return runs
+
+
+def write_partition(df, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    df.reset_index(drop=True).to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Local cache
+## the queries join the {user_name}_exp temp table, so its content (exp_id) is a part of the key
+## and results are only cached when exp_id is passed
+def get_cache_path(query, params):
+    key = hashlib.sha256((query + json.dumps(params, sort_keys=True, default=str)).encode()).hexdigest()
+    return CACHE_DIR / f'{key}.pqt'
+
+
+def query_to_dataframe(query, cache_params=None, refresh=False, on_miss=None):
+    """on_miss: called before the query runs, e.g. to create the tables it reads"""
+    if cache_params is not None:
+        path = get_cache_path(query, cache_params)
+        if path.exists() and not refresh:
+            os.utime(path)
+            return read_parquet(path)
+    if on_miss is not None:
+        on_miss()
+    df = client.query(query).to_dataframe()
+    if cache_params is not None:
+        write_cache(df, path)
+    return df
+
+
+def write_cache(df, path):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    evict_cache()
+
+
+def evict_cache(max_bytes=None):
+    """Drops least recently used files until the cache fits into max_bytes"""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    files = sorted(CACHE_DIR.glob('*.pqt'), key=lambda x: x.stat().st_mtime)
+    total = sum(i.stat().st_size for i in files)
+    for path in files:
+        if total <= max_bytes:
+            break
+        total -= path.stat().st_size
+        path.unlink()
@@ -111,20 +111,24 @@ def draw_heatmap_NEW(df, metric_list, calc_list, step_y):
     return 0
 
 
-def draw_lines(df_recprice, df_order, df_full, metric_list):
-    for i in metric_list:
-        ddt = calculate_metrics(
+def draw_lines(df_recprice, df_order, df_full, metric_list, group_codes=None, dfm=None):
+    """dfm: the metrics by group_name, surge_bin, orders_distance_bin from MetricCube.metrics instead of the frames"""
+    if dfm is None:
+        dfm = calculate_metrics(
             df_recprice,
             df_order,
             df_full,
             group_cols=['group_name', 'surge_bin', 'orders_distance_bin'],
-        ).sort_values(by=['group_name', 'surge_bin', 'orders_distance_bin'])
+            group_codes=group_codes,
+        )
+    dfm = dfm.sort_values(by=['group_name', 'surge_bin', 'orders_distance_bin'])
 
-        ddt = ddt[ddt['group_name'] != 'Before']
+    for i in metric_list:
+        ddt = dfm[dfm['group_name'] != 'Before'].copy()
         ddt[i[0]] = ddt[i[1]] / ddt[i[2]]
         ddt[['group_name', 'surge_bin', 'orders_distance_bin', i[0]]]
 
-        ddt['group_surge'] = ddt['group_name'] + " | Surge " + ddt['surge_bin'].astype(str)
+        ddt['group_surge'] = ddt['group_name'].astype(str) + " | Surge " + ddt['surge_bin'].astype(str)
 
         fig = px.line(
             ddt,
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+
+class JoinIndex:
+    """
+    Join key of two frames (orders and recprice) factorized once into shared codes.
+    Row pairs of a left join are computed once per direction and reused,
+    so moving a column from one frame to the other is a gather, not a new merge.
+    As in merge, missing keys match each other
+    """
+
+    def __init__(self, df_left, df_right, on='calcprice_uuid'):
+        codes, _ = pd.factorize(pd.concat([df_left[on], df_right[on]], ignore_index=True), use_na_sentinel=False)
+        self.on = on
+        self.codes = (codes[:len(df_left)], codes[len(df_left):])
+        self.rows = {}
+
+    def check(self, df_a, df_b, reverse=False):
+        codes_a, codes_b = self.codes[::-1] if reverse else self.codes
+        if len(df_a) != len(codes_a) or len(df_b) != len(codes_b):
+            raise ValueError('join index was built for other frames')
+
+    def pairs(self, reverse=False):
+        """
+        Rows of df_left.merge(df_right, how='left') as positions in both frames, in the merge order,
+        -1 for a left row without a match. reverse: the same for df_right.merge(df_left, how='left')
+        """
+        if reverse not in self.rows:
+            codes_a, codes_b = self.codes[::-1] if reverse else self.codes
+            order = np.argsort(codes_b, kind='stable')
+            sorted_b = codes_b[order]
+            start = np.searchsorted(sorted_b, codes_a, side='left')
+            counts = np.searchsorted(sorted_b, codes_a, side='right') - start
+            n_rows = np.maximum(counts, 1)
+            rows_a = np.repeat(np.arange(len(codes_a)), n_rows)
+            offsets = np.arange(len(rows_a)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+            matched = np.repeat(counts, n_rows) > 0
+            rows_b = np.full(len(rows_a), -1, dtype='int64')
+            rows_b[matched] = order[(np.repeat(start, n_rows) + offsets)[matched]]
+            self.rows[reverse] = rows_a, rows_b
+        return self.rows[reverse]
+
+    def column(self, df_a, df_b, column, reverse=False):
+        """Values of the column in the joined rows, taken from df_a if it has the column, as merge does"""
+        rows_a, rows_b = self.pairs(reverse)
+        if column in df_a.columns:
+            return take(df_a[column], rows_a)
+        return take(df_b[column], rows_b)
+
+    def join(self, df_a, df_b, columns=None, reverse=False, keep=None):
+        """
+        df_a.merge(df_b[[on] + columns], on=on, how='left'); columns are the ones of df_b
+        that df_a doesn't have by default. keep: boolean mask of the joined rows to return,
+        the index is then the one the filtered merge result would have
+        """
+        self.check(df_a, df_b, reverse)
+        rows_a, rows_b = self.pairs(reverse)
+        if columns is None:
+            columns = [col for col in df_b.columns if col not in df_a.columns]
+        index = None
+        if keep is not None:
+            index = np.flatnonzero(keep)
+            rows_a, rows_b = rows_a[index], rows_b[index]
+        df = df_a.take(rows_a)
+        df.index = pd.RangeIndex(len(df)) if index is None else pd.Index(index)
+        for col in columns:
+            if col != self.on:
+                df[col] = take(df_b[col], rows_b, index=df.index)
+        return df
+
+
+def take(values, rows, index=None):
+    """Gather by position, -1 gives a missing value"""
+    array = pd.api.extensions.take(values.array, rows, allow_fill=True)
+    return pd.Series(array, index=index, name=values.name)
@@ -1,10 +1,14 @@
+import re
 import warnings
 warnings.filterwarnings("ignore")
 
 import numpy as np
 import pandas as pd
 
-from .pipeline import RatioMetricHypothesisTestingPipeline
+from .aggregate import encode_groups, group_count, group_sum, group_nunique
+from .pipeline import (PRE_SUFFIX, BatchRatioMetricHypothesisTestingPipeline,
+                       MomentsRatioMetricHypothesisTestingPipeline, RatioMetricHypothesisTestingPipeline,
+                       ratio_ttest_from_moments)
 
 
 
@@ -72,19 +76,105 @@ METRIC_LIST = [
     ["orders_by_recprice_share", "orders_recprice_count", "orders_count"]
 ]
 
-
-def get_switchback_results(df, alpha, metric_list=METRIC_LIST, groups={"control":"Control", "treatment":"A"}):
-    res_list = []
-    for i in metric_list:
-        pipeline = RatioMetricHypothesisTestingPipeline(df, i[0], i[1], i[2], groups)
-        try: pipeline.run()
-        except ValueError as VE: print('ValueError: {VE}', i[1], i[2])
-        except KeyError as KE: print('KeyError: {KE}', i[1], i[2])
-        res_list.append(pipeline.result)
-    df_res = pd.DataFrame(res_list)
+## pre-period slot columns of prepare_*_data and the timestamp attribute they are taken from
+SLOT_ATTRIBUTES = {'utc_weekday': 'weekday', 'utc_hour': 'hour'}
+
+
+def get_switchback_results(df, alpha, metric_list=METRIC_LIST, groups={"control":"Control", "treatment":"A"},
+                           equal_var=True, method="linearization", adjustment=None):
+    """
+    method: 'linearization' - t-test of the linearized intervals, 'moments' - the same p-values
+    from per-group moments in one pass, 'delta' - delta-method variance from the same moments.
+    adjustment: None, 'cuped' or 'regression' - variance reduction of the linearized intervals
+    with the pre-period covariates of add_pre_period_covariates
+    """
+    if adjustment is not None and method != "linearization":
+        raise ValueError("adjustment needs method='linearization'")
+    if method == "linearization":
+        df_res = BatchRatioMetricHypothesisTestingPipeline(df, metric_list, groups, equal_var, adjustment).run()
+    elif method in ("moments", "delta"):
+        variance = "delta" if method == "delta" else "linearization"
+        df_res = MomentsRatioMetricHypothesisTestingPipeline(df, metric_list, groups, equal_var, variance).run()
+    else:
+        raise ValueError(f"unknown method {method}")
     df_res[f'is_significant'] = df_res['pvalue'] < alpha
     return df_res
 
+def add_pre_period_covariates(dfm, df_recprice, df_order, df_full, slot_cols=['utc_weekday', 'utc_hour'],
+                              ts_column='switch_start_dttm', before='Before', registry=None):
+    """
+    Covariates of the intervals from the pre-period (DAYS_BEFORE days labelled 'Before'):
+    every registry column summed over the pre-period slot (UTC weekday and hour) of the switch start,
+    as <column>_pre columns of dfm. One calculate_metrics call for all metrics
+    """
+    frames = [df[df['group_name'] == before] for df in (df_recprice, df_order, df_full)]
+    dfm_pre = calculate_metrics(*frames, group_cols=slot_cols, registry=registry or METRIC_REGISTRY)
+    ts = pd.to_datetime(dfm[ts_column])
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert('UTC')
+    slots = pd.DataFrame({col: getattr(ts.dt, SLOT_ATTRIBUTES[col]).to_numpy() for col in slot_cols})
+    pre = slots.merge(
+        dfm_pre.astype({col: slots[col].dtype for col in slot_cols}), on=slot_cols, how='left'
+    ).drop(columns=slot_cols)
+    pre.columns = [f'{col}{PRE_SUFFIX}' for col in pre.columns]
+    pre.index = dfm.index
+    return pd.concat([dfm.drop(columns=pre.columns, errors='ignore'), pre], axis=1)
+
+def flatten_switchback_results(df_res):
+    single_row = {}
+    for _, row in df_res.iterrows():
+        for stat_name in df_res.columns:
+            single_row[f"{row['metric']}.{stat_name}"] = row[stat_name]
+    return single_row
+
+
+def get_switchback_cell_results(df_recprice, df_order, df_full, alpha, surge_bins, dist_bins,
+                                group_cols=['group_name', 'switch_start_dttm', 'switch_finish_dttm'],
+                                metric_list=METRIC_LIST, groups={"control":"Control", "treatment":"A"}, dfm=None):
+    """
+    Switchback results of every surge_bin x orders_distance_bin cell from one calculate_metrics call
+    on the unfiltered frames, one row per cell with metric.stat columns as draw_heatmap expects.
+    The tests of all cells and metrics are one ratio_ttest_from_moments call on the per-cell moments.
+    dfm: the metrics by cell_cols + group_cols computed elsewhere (MetricCube.metrics), the frames are not used
+    """
+    cell_cols = ['surge_bin', 'orders_distance_bin']
+    if dfm is None:
+        dfm = calculate_metrics(df_recprice, df_order, df_full, group_cols=cell_cols + group_cols)
+    missing = [i for i in metric_list if i[1] not in dfm.columns or i[2] not in dfm.columns]
+    for i in missing:
+        print(f"KeyError: missing columns for metric {i}")
+    metric_list = [i for i in metric_list if i not in missing]
+    metrics = [i[0] for i in metric_list]
+
+    cells = pd.MultiIndex.from_product([surge_bins, dist_bins], names=cell_cols)
+    cell_codes = cells.get_indexer(pd.MultiIndex.from_frame(dfm[cell_cols]))
+    arms = np.select([dfm['group_name'] == groups['control'], dfm['group_name'] == groups['treatment']], [0, 1], -1)
+    rows = (cell_codes >= 0) & (arms >= 0)
+    x = dfm[[i[1] for i in metric_list]].fillna(0).to_numpy(dtype=float)[rows]
+    y = dfm[[i[2] for i in metric_list]].fillna(0).to_numpy(dtype=float)[rows]
+    ## [n, Σx, Σy, Σx², Σy², Σxy] of every cell x arm x metric in one groupby
+    sums = (pd.DataFrame(np.hstack([np.ones((len(x), 1)), x, y, x * x, y * y, x * y]))
+            .groupby(cell_codes[rows] * 2 + arms[rows]).sum()
+            .reindex(range(2 * len(cells)), fill_value=0).to_numpy())
+    n = np.broadcast_to(sums[:, :1, None], (len(sums), len(metrics), 1))
+    moments = np.concatenate([n, sums[:, 1:].reshape(len(sums), 5, len(metrics)).transpose(0, 2, 1)], axis=-1)
+    moments = moments.reshape(len(cells), 2, len(metrics), 6)
+    result = ratio_ttest_from_moments(moments[:, 0], moments[:, 1])
+    result['is_significant'] = result['pvalue'] < alpha
+    for key in ['n_obs_control', 'n_obs_experimental']:
+        # interval counts stay integers where every cell has them, as in calc_n_obs
+        if not np.isnan(result[key]).any():
+            result[key] = result[key].astype('int64')
+
+    columns = {'surge_bin': cells.get_level_values(0), 'dist_bin': cells.get_level_values(1)}
+    stats = ['control_value', 'experimental_value', 'uplift_abs', 'uplift_rel', 'pvalue', 'effect_size',
+             'n_obs_control', 'n_obs_experimental', 'power', 'obs_needed', 'is_significant']
+    for j, metric in enumerate(metrics):
+        columns[f'{metric}.metric'] = metric
+        for stat in stats:
+            columns[f'{metric}.{stat}'] = result[stat][:, j]
+    return pd.DataFrame(columns)
+
 from .pipeline import RatioMetricHypothesisTestingPipeline
 
 def get_switchback_results_new(df, alpha, metric_list=METRIC_LIST, groups={"control": "Control", "treatment": "A"}):
@@ -364,48 +454,185 @@ def metric_surge_le_1_rides_count(df, group_cols):
             .reset_index())
 
 
-def calculate_metrics(df_recprice, df_order, df_full, group_cols):
-    dfm = (metric_calcprices_count(df_recprice, group_cols)
-           .merge(metric_orders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_orders_by_recprice_neighborhood_10_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_tenders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_orders_with_bids_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_start_price_bid_orders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_start_price_bid_accepted_orders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_start_price_bid_rides_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_accepted_orders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_rides_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_price_start_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_rides_price_start_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_price_highrate_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_rides_price_highrate_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_price_tender_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_price_done_usd_sum(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_good_orders_count(df_order, group_cols), on=group_cols, how='left')
-           .merge(metric_price_base_usd_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_recprice_usd_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_minprice_usd_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_dynamic_surge_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_original_dynamic_surge_updated_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_calcprices_count(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_sum(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_calcprices_count(df_recprice, group_cols), on=group_cols, how='left')
-           .merge(metric_orders_by_minprice_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_orders_by_minprice_with_bids_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_accepted_orders_by_minprice_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_rides_by_minprice_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_orders_with_bids_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_orders_with_bids_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_start_price_bid_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_start_price_bid_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_accepted_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_accepted_orders_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_gr_1_rides_count(df_full, group_cols), on=group_cols, how='left')
-           .merge(metric_surge_le_1_rides_count(df_full, group_cols), on=group_cols, how='left'))
+# declarative twin of the metric_* functions above:
+# [dfm column, source frame, aggregated column, aggregation, row filter]
+# row filters are boolean expressions over the source frame columns
+METRIC_REGISTRY = [
+    ["calcprices_count", "recprice", "calcprice_uuid", "nunique", None],
+    ["orders_count", "order", "order_uuid", "nunique", None],
+    ["orders_recprice_count", "order", "order_uuid", "nunique", "price_start_usd / price_highrate_usd >= 0.9"],
+    ["tenders_count", "order", "tenders_count", "sum", None],
+    ["orders_with_bids_count", "order", "is_order_with_tender", "sum", None],
+    ["start_price_bid_orders_count", "order", "is_order_start_price_bid", "sum", None],
+    ["start_price_bid_accepted_orders_count", "order", "is_order_accepted_start_price_bid", "sum", None],
+    ["start_price_bid_rides_count", "order", "is_order_done_start_price_bid", "sum", None],
+    ["accepted_orders_count", "order", "is_order_accepted", "sum", None],
+    ["rides_count", "order", "is_order_done", "sum", None],
+    ["price_start_usd_sum", "order", "price_start_usd", "sum", None],
+    ["rides_price_start_usd_sum", "order", "rides_price_start_usd", "sum", None],
+    ["price_highrate_usd_sum", "order", "price_highrate_usd", "sum", None],
+    ["rides_price_highrate_usd_sum", "order", "rides_price_highrate_usd", "sum", None],
+    ["price_tender_usd_sum", "order", "price_tender_usd", "sum", None],
+    ["price_done_usd_sum", "order", "price_done_usd", "sum", None],
+    ["good_orders_count", "order", "is_order_good", "sum", None],
+    ["price_base_usd_sum", "recprice", "price_base_usd", "sum", None],
+    ["recprice_usd_sum", "recprice", "recprice_usd", "sum", None],
+    ["minprice_usd_sum", "recprice", "minprice_usd", "sum", None],
+    ["surge_sum", "recprice", "surge", "sum", None],
+    ["dynamic_surge_sum", "recprice", "dynamic_surge", "sum", None],
+    ["original_dynamic_surge_updated_sum", "recprice", "original_dynamic_surge_updated", "sum", None],
+    ["surge_gr_1_sum", "recprice", "surge", "sum", "surge > 1"],
+    ["surge_gr_1_calcprices_count", "recprice", "calcprice_uuid", "nunique", "surge > 1"],
+    ["surge_le_1_sum", "recprice", "surge", "sum", "surge <= 1"],
+    ["surge_le_1_calcprices_count", "recprice", "calcprice_uuid", "nunique", "surge <= 1"],
+    ["orders_by_minprice_count", "full", "order_uuid", "nunique",
+     "price_start_usd >= minprice_usd * 0.99 and price_start_usd <= minprice_usd * 1.01"],
+    ["orders_by_minprice_with_bids_count", "full", "order_uuid", "nunique",
+     "price_start_usd >= minprice_usd * 0.99 and price_start_usd <= minprice_usd * 1.01 and is_order_with_tender"],
+    ["accepted_orders_by_minprice_count", "full", "order_uuid", "nunique",
+     "price_start_usd >= minprice_usd * 0.99 and price_start_usd <= minprice_usd * 1.01 and is_order_accepted"],
+    ["rides_by_minprice_count", "full", "order_uuid", "nunique",
+     "price_start_usd >= minprice_usd * 0.99 and price_start_usd <= minprice_usd * 1.01 and is_order_done"],
+    ["surge_gr_1_orders_count", "full", "order_uuid", "nunique", "surge > 1"],
+    ["surge_le_1_orders_count", "full", "order_uuid", "nunique", "surge <= 1"],
+    ["surge_gr_1_orders_with_bids_count", "full", "order_uuid", "nunique", "surge > 1 and is_order_with_tender"],
+    ["surge_le_1_orders_with_bids_count", "full", "order_uuid", "nunique", "surge <= 1 and is_order_with_tender"],
+    ["surge_gr_1_start_price_bid_orders_count", "full", "order_uuid", "nunique", "surge > 1 and is_order_start_price_bid"],
+    ["surge_le_1_start_price_bid_orders_count", "full", "order_uuid", "nunique", "surge <= 1 and is_order_start_price_bid"],
+    ["surge_gr_1_accepted_orders_count", "full", "order_uuid", "nunique", "surge > 1 and is_order_accepted"],
+    ["surge_le_1_accepted_orders_count", "full", "order_uuid", "nunique", "surge <= 1 and is_order_accepted"],
+    ["surge_gr_1_rides_count", "full", "order_uuid", "nunique", "surge > 1 and is_order_done"],
+    ["surge_le_1_rides_count", "full", "order_uuid", "nunique", "surge <= 1 and is_order_done"],
+]
+
+
+def eval_condition(df, condition, cache=None):
+    """Row mask of a registry filter, conjunctions are evaluated term by term and cached"""
+    cache = {} if cache is None else cache
+    mask = None
+    for term in condition.split(' and '):
+        if term not in cache:
+            columns = [i for i in dict.fromkeys(re.findall(r'[A-Za-z_]\w*', term)) if i in df.columns]
+            cache[term] = df[columns].eval(term).fillna(False).astype(bool).to_numpy()
+        mask = cache[term] if mask is None else mask & cache[term]
+    return mask
+
+
+def aggregate_source(df, group_cols, registry):
+    """All sums, counts and nuniques of one source frame in a single groupby"""
+    data = df[group_cols].copy()
+    agg = {}
+    masks = {}
+    terms = {}
+    codes = {}
+    for name, _, column, how, condition in registry:
+        if how == 'nunique':
+            # distinct ids are counted on integer codes instead of uuid strings
+            if column not in codes:
+                codes[column] = pd.Series(pd.factorize(df[column])[0], index=df.index).replace(-1, np.nan)
+            values = codes[column]
+        elif df[column].dtype == bool:
+            values = df[column].astype('int64')
+        else:
+            values = df[column]
+        if condition is not None:
+            if condition not in masks:
+                masks[condition] = pd.Series(eval_condition(df, condition, terms), index=df.index)
+                rows_col = f'__rows_{len(masks)}'
+                data[rows_col] = masks[condition].astype('int64')
+                agg[rows_col] = (rows_col, 'sum')
+            values = values.where(masks[condition])
+        data[name] = values
+        agg[name] = (name, how)
+    res = data.groupby(group_cols, observed=True).agg(**agg)
+    # a filter that keeps no rows of a group drops the group, as in metric_*
+    for i, condition in enumerate(masks, start=1):
+        empty = res.pop(f'__rows_{i}') == 0
+        for name, _, _, _, metric_condition in registry:
+            if metric_condition == condition:
+                res[name] = res[name].where(~empty)
+    return res
+
+
+def aggregate_source_dense(df, frame_idx, group_codes, registry):
+    """Same as aggregate_source on shared group codes with bincount"""
+    res = {}
+    masks = {}
+    terms = {}
+    codes = group_codes.codes[frame_idx]
+    n_groups = group_codes.n_groups
+    present = group_count(codes, n_groups) > 0
+    for name, _, column, how, condition in registry:
+        mask = None
+        if condition is not None:
+            if condition not in masks:
+                masks[condition] = eval_condition(df, condition, terms)
+            mask = masks[condition]
+        if how == 'nunique':
+            pairs = group_codes.distinct_pairs(frame_idx, df, column)
+            values = group_nunique(codes, None, n_groups, mask, pairs=pairs).astype(float)
+        else:
+            values = group_sum(codes, df[column].to_numpy(dtype=float, na_value=np.nan), n_groups, mask)
+        rows = present if mask is None else group_count(codes, n_groups, mask) > 0
+        res[name] = np.where(rows, values, np.nan)
+    return res
+
+
+def calculate_metrics(df_recprice, df_order, df_full, group_cols, registry=METRIC_REGISTRY,
+                      backend='numpy', group_codes=None):
+    """
+    backend='numpy' aggregates on group keys factorized once for the three frames,
+    pass group_codes=encode_groups([df_recprice, df_order, df_full], group_cols)
+    to reuse the encoding between calls on the same frames.
+    backend='pandas' runs one groupby per frame.
+    backend='duckdb' runs the registry as DuckDB queries; the frames can also be paths
+    of downloaded Parquet files and df_full None, see outofcore.calculate_metrics_duckdb
+    """
+    if backend == 'duckdb':
+        from .outofcore import calculate_metrics_duckdb
+        return calculate_metrics_duckdb(df_recprice, df_order, df_full, group_cols, registry)
+    frames = {"recprice": df_recprice, "order": df_order, "full": df_full}
+    if backend == 'pandas':
+        return calculate_metrics_pandas(frames, group_cols, registry)
+    if group_codes is None:
+        group_codes = encode_groups(list(frames.values()), group_cols)
+    group_codes.check(list(frames.values()))
+    codes = dict(zip(frames, group_codes.codes))
+    aggregated = {}
+    for frame_idx, (source, df) in enumerate(frames.items()):
+        source_registry = [i for i in registry if i[1] == source]
+        if source_registry:
+            aggregated[source] = aggregate_source_dense(df, frame_idx, group_codes, source_registry)
+    # groups of the first registry source (df_recprice) are the base of the left join
+    base = group_count(codes[registry[0][1]], group_codes.n_groups) > 0
+    columns = {}
+    for name, source, column, how, _ in registry:
+        values = aggregated[source][name][base]
+        if is_integer_metric(frames[source][column], how) and not np.isnan(values).any():
+            values = values.astype('int64')
+        columns[name] = values
+    dfm = pd.concat([group_codes.keys[base].reset_index(drop=True), pd.DataFrame(columns)], axis=1)
+    return dfm
+
+
+def is_integer_metric(column, how):
+    return how == 'nunique' or pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column)
+
+
+def calculate_metrics_pandas(frames, group_cols, registry):
+    aggregated = {}
+    for source, df in frames.items():
+        source_registry = [i for i in registry if i[1] == source]
+        if source_registry:
+            aggregated[source] = aggregate_source(df, group_cols, source_registry)
+    index = aggregated[registry[0][1]].index
+    columns = {}
+    for name, source, column, how, _ in registry:
+        values = aggregated[source][name].reindex(index)
+        if is_integer_metric(frames[source][column], how) and values.notnull().all():
+            values = values.astype('int64')
+        columns[name] = values
+    dfm = pd.DataFrame(columns, index=index).reset_index()
     return dfm
 
            
@@ -0,0 +1,254 @@
+import numpy as np
+import pandas as pd
+
+from .aggregate import group_count, group_sum
+from .metrics import METRIC_LIST, METRIC_REGISTRY, eval_condition, is_integer_metric
+from .pipeline import ratio_ttest_from_moments
+
+
+GROUP_COLS = ['group_name', 'switch_start_dttm', 'surge_bin', 'orders_distance_bin']
+# HyperLogLog constant for 2 ** precision >= 128 registers
+HLL_ALPHA = 0.7213
+
+
+def bit_length(x):
+    """Number of significant bits of uint64 values"""
+    n = np.zeros(len(x), dtype=np.int64)
+    x = x.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(shift))
+        n += big * shift
+        x = np.where(big, x >> np.uint64(shift), x)
+    return n + (x > 0)
+
+
+def hash_ids(values):
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def mix_hashes(a, b):
+    """One 64-bit hash of a pair of hashes (splitmix64 finalizer)"""
+    h = a * np.uint64(0x9e3779b97f4a7c15) ^ b
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+class OnlineMetrics:
+    """
+    Mergeable accumulators of the registry metrics per group key, updated with new order,
+    recprice and full batches as they arrive: row counts and sums, exact distinct sets
+    (or HyperLogLog sketches with distinct='hll') and, per arm and cell, the sums of squares
+    over the intervals that the linearized t-test needs.
+    metrics() is the dfm of calculate_metrics on everything seen so far,
+    results() the switchback results per cell without going back to the rows
+    """
+
+    def __init__(self, group_cols=GROUP_COLS, registry=METRIC_REGISTRY, metric_list=METRIC_LIST,
+                 arm_col='group_name', unit_col='switch_start_dttm', distinct='exact', precision=12):
+        self.group_cols = list(group_cols)
+        self.registry = registry
+        self.arm_col = arm_col
+        self.unit_col = unit_col
+        self.cell_cols = [col for col in self.group_cols if col not in (arm_col, unit_col)]
+        self.distinct = distinct
+        self.precision = precision
+        self.names = [i[0] for i in registry]
+        self.metric_list = [i for i in metric_list if i[1] in self.names and i[2] in self.names]
+        self.num_idx = [self.names.index(i[1]) for i in self.metric_list]
+        self.den_idx = [self.names.index(i[2]) for i in self.metric_list]
+        ## row counts per (source, filter): a metric without rows in a group is NaN
+        self.filters = list(dict.fromkeys((source, condition) for _, source, _, _, condition in registry))
+        self.integer = {}
+
+        self.keys = pd.DataFrame(columns=self.group_cols)
+        self.index = {}
+        self.values = np.zeros((0, len(registry)))
+        self.rows = np.zeros((0, len(self.filters)), dtype=np.int64)
+        self.key_hash = np.zeros(0, dtype=np.uint64)
+        self.seen = {name: (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+                     for name, _, _, how, _ in registry if how == 'nunique'}
+        self.registers = {name: np.zeros((0, 2 ** precision), dtype=np.uint8) for name in self.seen}
+        ## moments of the intervals per (arm, cell): [n, Σx, Σy, Σx², Σy², Σxy] for every ratio metric
+        self.moment_keys = pd.DataFrame(columns=[arm_col] + self.cell_cols)
+        self.moment_index = {}
+        self.moment_code = np.zeros(0, dtype=np.int64)
+        self.moments = np.zeros((0, len(self.metric_list), 6))
+
+    def encode(self, df):
+        """Codes of the group keys of the rows, new keys are added; -1 for a missing key"""
+        valid = df[self.group_cols].notnull().all(axis=1).to_numpy()
+        codes = np.full(len(df), -1, dtype=np.int64)
+        if not valid.any():
+            return codes
+        batch_codes, batch_keys = pd.factorize(pd.MultiIndex.from_frame(df.loc[valid, self.group_cols]))
+        keys = list(batch_keys)
+        new = [key for key in keys if key not in self.index]
+        if new:
+            self.add_keys(pd.DataFrame(new, columns=self.group_cols))
+        key_codes = np.array([self.index[key] for key in keys], dtype=np.int64)
+        codes[valid] = key_codes[batch_codes]
+        return codes
+
+    def add_keys(self, new_keys):
+        start = len(self.keys)
+        self.keys = pd.concat([self.keys, new_keys], ignore_index=True) if start else new_keys.reset_index(drop=True)
+        self.index.update({key: start + i for i, key in enumerate(new_keys.itertuples(index=False, name=None))})
+        self.key_hash = np.concatenate([self.key_hash, pd.util.hash_pandas_object(new_keys, index=False).to_numpy()])
+        n = len(new_keys)
+        self.values = np.vstack([self.values, np.zeros((n, self.values.shape[1]))])
+        self.rows = np.vstack([self.rows, np.zeros((n, self.rows.shape[1]), dtype=np.int64)])
+        for name in self.registers:
+            if self.distinct == 'hll':
+                self.registers[name] = np.vstack([self.registers[name], np.zeros((n, 2 ** self.precision), np.uint8)])
+
+        moment_cols = [self.arm_col] + self.cell_cols
+        moment_codes = []
+        for key in new_keys[moment_cols].itertuples(index=False, name=None):
+            if key not in self.moment_index:
+                self.moment_index[key] = len(self.moment_index)
+                self.moment_keys.loc[len(self.moment_keys)] = key
+            moment_codes.append(self.moment_index[key])
+        self.moment_code = np.concatenate([self.moment_code, np.array(moment_codes, dtype=np.int64)])
+        n_moments = len(self.moment_index) - len(self.moments)
+        self.moments = np.concatenate([self.moments, np.zeros((n_moments,) + self.moments.shape[1:])])
+
+    def update(self, df, source):
+        """Adds a batch of rows of one source ('recprice', 'order' or 'full')"""
+        codes = self.encode(df)
+        touched = np.unique(codes[codes >= 0])
+        self.add_moments(touched, -1)
+        n_groups = len(self.keys)
+        masks, terms = {}, {}
+        for i, (filter_source, condition) in enumerate(self.filters):
+            if filter_source != source:
+                continue
+            masks[condition] = None if condition is None else eval_condition(df, condition, terms)
+            self.rows[:, i] += group_count(codes, n_groups, masks[condition])
+        for j, (name, metric_source, column, how, condition) in enumerate(self.registry):
+            if metric_source != source:
+                continue
+            self.integer[name] = self.integer.get(name, True) and is_integer_metric(df[column], how)
+            if how == 'nunique':
+                self.update_distinct(name, j, codes, df[column], masks[condition])
+            else:
+                values = df[column].to_numpy(dtype=float, na_value=np.nan)
+                self.values[:, j] += group_sum(codes, values, n_groups, masks[condition])
+        self.add_moments(touched, 1)
+        return self
+
+    def update_distinct(self, name, j, codes, ids, mask):
+        keep = (codes >= 0) & ids.notnull().to_numpy()
+        if mask is not None:
+            keep &= mask
+        codes, ids = codes[keep], hash_ids(ids[keep])
+        if self.distinct == 'hll':
+            p = np.uint64(self.precision)
+            register = (ids >> (np.uint64(64) - p)).astype(np.int64)
+            rank = np.minimum(64 - bit_length(ids << p) + 1, 64 - self.precision + 1).astype(np.uint8)
+            np.maximum.at(self.registers[name], (codes, register), rank)
+        else:
+            self.add_pairs(name, j, mix_hashes(self.key_hash[codes], ids), codes)
+
+    def add_pairs(self, name, j, pairs, codes):
+        """Exact distinct count: (group, id) pair hashes seen so far, a new pair adds 1 to its group"""
+        pairs, first = np.unique(pairs, return_index=True)
+        codes = codes[first]
+        seen, seen_codes = self.seen[name]
+        is_new = ~np.isin(pairs, seen, assume_unique=True)
+        self.values[:, j] += np.bincount(codes[is_new], minlength=len(self.keys))
+        pairs = np.concatenate([seen, pairs[is_new]])
+        codes = np.concatenate([seen_codes, codes[is_new]])
+        order = np.argsort(pairs, kind='stable')
+        self.seen[name] = pairs[order], codes[order]
+
+    def distinct_counts(self, name):
+        """HyperLogLog estimate per group, linear counting for small counts"""
+        registers = self.registers[name]
+        m = registers.shape[1]
+        estimate = HLL_ALPHA / (1 + 1.079 / m) * m ** 2 / np.power(2.0, -registers.astype(float)).sum(axis=1)
+        zeros = (registers == 0).sum(axis=1)
+        with np.errstate(divide='ignore'):
+            small = m * np.log(m / np.maximum(zeros, 1))
+        return np.where((estimate <= 2.5 * m) & (zeros > 0), small, estimate)
+
+    def current_values(self):
+        values = self.values.copy()
+        if self.distinct == 'hll':
+            for name in self.registers:
+                values[:, self.names.index(name)] = self.distinct_counts(name)
+        return values
+
+    def add_moments(self, codes, sign):
+        """Adds (sign=1) or removes (sign=-1) the intervals of the groups in the moments"""
+        if not len(codes) or not self.metric_list:
+            return
+        # an interval is a row of dfm, i.e. a group with recprice rows
+        present = self.rows[codes, self.filters.index((self.registry[0][1], None))] > 0
+        codes = codes[present]
+        values = self.current_values()[codes] if self.distinct == 'hll' else self.values[codes]
+        x, y = values[:, self.num_idx], values[:, self.den_idx]
+        contribution = np.stack([np.ones_like(x), x, y, x * x, y * y, x * y], axis=-1)
+        np.add.at(self.moments, self.moment_code[codes], sign * contribution)
+
+    def merge(self, other):
+        """Adds the accumulators of another OnlineMetrics with the same settings"""
+        codes = self.encode(other.keys)
+        self.add_moments(np.unique(codes), -1)
+        ## a distinct count is recounted from the union of the sets, everything else adds up
+        distinct = [j for j, name in enumerate(self.names) if name in self.seen]
+        other_values = other.values.copy()
+        other_values[:, distinct] = 0
+        self.values[codes] += other_values
+        self.rows[codes] += other.rows
+        for j in distinct:
+            name = self.names[j]
+            if self.distinct == 'hll':
+                np.maximum.at(self.registers[name], codes, other.registers[name])
+            else:
+                pairs, other_codes = other.seen[name]
+                self.add_pairs(name, j, pairs, codes[other_codes])
+        for name, integer in other.integer.items():
+            self.integer[name] = self.integer.get(name, True) and integer
+        self.add_moments(np.unique(codes), 1)
+        return self
+
+    def metrics(self):
+        """dfm of calculate_metrics on all the batches so far"""
+        values = self.current_values()
+        base = self.rows[:, self.filters.index((self.registry[0][1], None))] > 0
+        columns = {}
+        for j, (name, source, _, how, condition) in enumerate(self.registry):
+            has_rows = self.rows[:, self.filters.index((source, condition))] > 0
+            column = np.where(has_rows, values[:, j], np.nan)[base]
+            if self.integer.get(name, how == 'nunique') and self.distinct != 'hll' and not np.isnan(column).any():
+                column = column.astype('int64')
+            columns[name] = column
+        keys = self.keys[base].reset_index(drop=True)
+        dfm = pd.concat([keys, pd.DataFrame(columns)], axis=1)
+        return dfm.sort_values(self.group_cols, ignore_index=True)
+
+    def cell_moments(self, groups={"control": "Control", "treatment": "A"}):
+        """Cells and the control and treatment moments of every cell, (cells x metrics x 6)"""
+        cells = self.moment_keys[self.cell_cols].drop_duplicates().reset_index(drop=True)
+        moments = dict(zip(self.moment_keys.itertuples(index=False, name=None), self.moments))
+        empty = np.zeros((len(self.metric_list), 6))
+        arms = []
+        for arm in [groups['control'], groups['treatment']]:
+            arm_moments = [moments.get((arm,) + cell, empty) for cell in cells.itertuples(index=False, name=None)]
+            arms.append(np.stack(arm_moments) if arm_moments else np.zeros((0,) + empty.shape))
+        return cells, arms[0], arms[1]
+
+    def results(self, alpha=0.05, groups={"control": "Control", "treatment": "A"}, equal_var=True):
+        """Switchback results per cell from the moments, as get_switchback_results on each cell"""
+        cells, control, treatment = self.cell_moments(groups)
+        result = ratio_ttest_from_moments(control, treatment, equal_var)
+        n_metrics = len(self.metric_list)
+        df_res = cells.loc[cells.index.repeat(n_metrics)].reset_index(drop=True)
+        df_res['metric'] = [i[0] for i in self.metric_list] * len(cells)
+        for key, values in result.items():
+            df_res[key] = np.asarray(values).reshape(-1)
+        df_res['is_significant'] = df_res['pvalue'] < alpha
+        return df_res
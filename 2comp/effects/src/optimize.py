@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+
+from .runner import run_in_pool, save_results
+from .simulate import get_config_grid, get_distance_bins, iter_highrate_chunks
+
+
+def aggregate_response(df_recprice, df_full, step_distance_bin=1, max_distance_bin=25, ratio_step=0.05,
+                       distance_column='log_distance_in_km'):
+    """
+    Calcprices (df_recprice), orders and rides (df_full) per distance bin and recprice / price_base bin
+    of ratio_step, with the mean log of the ratio of the cell's calcprices
+    """
+    frames = []
+    for source, df in [('recprice', df_recprice), ('full', df_full)]:
+        df = df[(df['price_base_usd'] > 0) & (df['recprice_usd'] > 0) & df[distance_column].notnull()]
+        ratio = (df['recprice_usd'] / df['price_base_usd']).to_numpy(dtype=float)
+        cells = pd.DataFrame({
+            'distance_bin': get_distance_bins(df[distance_column], step_distance_bin, max_distance_bin),
+            'ratio_bin': np.round(ratio / ratio_step) * ratio_step,
+            'log_ratio': np.log(ratio),
+        })
+        if source == 'recprice':
+            frames.append(cells.groupby(['distance_bin', 'ratio_bin']).agg(
+                log_ratio=('log_ratio', 'mean'), calcprices_count=('log_ratio', 'size')))
+        else:
+            cells['is_order_done'] = df['is_order_done'].fillna(False).to_numpy(dtype=bool)
+            frames.append(cells.groupby(['distance_bin', 'ratio_bin']).agg(
+                orders_count=('is_order_done', 'size'), rides_count=('is_order_done', 'sum')))
+    df_cells = frames[0].join(frames[1], how='left').fillna({'orders_count': 0, 'rides_count': 0})
+    return df_cells.reset_index()
+
+
+def fit_logit(x, trials, successes, groups, n_groups, n_iter=50, ridge=1e-3, tol=1e-10):
+    """
+    Binomial logit(p) = intercept + slope * x of every group at once (Newton steps on 2 x 2 systems),
+    from grouped trials and successes. ridge keeps the slope of a group without price variation at 0
+    """
+    x, trials, successes = (np.asarray(i, dtype=float) for i in (x, trials, successes))
+    rate = np.bincount(groups, successes, n_groups) / np.bincount(groups, trials, n_groups)
+    rate = np.clip(np.nan_to_num(rate, nan=0.5), 1e-6, 1 - 1e-6)
+    intercept, slope = np.log(rate / (1 - rate)), np.zeros(n_groups)
+    for _ in range(n_iter):
+        p = 1 / (1 + np.exp(-(intercept[groups] + slope[groups] * x)))
+        residual, weight = successes - trials * p, trials * p * (1 - p)
+        g0, g1 = np.bincount(groups, residual, n_groups), np.bincount(groups, residual * x, n_groups) - ridge * slope
+        h00 = np.bincount(groups, weight, n_groups) + 1e-12
+        h01 = np.bincount(groups, weight * x, n_groups)
+        h11 = np.bincount(groups, weight * x * x, n_groups) + ridge
+        det = h00 * h11 - h01 ** 2
+        step0, step1 = (h11 * g0 - h01 * g1) / det, (h00 * g1 - h01 * g0) / det
+        intercept, slope = intercept + step0, slope + step1
+        if max(np.abs(step0).max(), np.abs(step1).max()) < tol:
+            break
+    return intercept, slope
+
+
+def fit_elasticities(df_recprice, df_full, step_distance_bin=1, max_distance_bin=25, ratio_step=0.05,
+                     distance_column='log_distance_in_km'):
+    """
+    Demand response per distance bin: logit(cp2order) and logit(order2done) linear in log(recprice / price_base).
+    The slopes are the elasticities of the odds to the surge multiplier
+    """
+    df_cells = aggregate_response(df_recprice, df_full, step_distance_bin, max_distance_bin, ratio_step,
+                                  distance_column)
+    bins, codes = np.unique(df_cells['distance_bin'], return_inverse=True)
+    df_model = pd.DataFrame({'distance_bin': bins})
+    df_model['calcprices_count'] = np.bincount(codes, df_cells['calcprices_count'], len(bins)).astype('int64')
+    for name, trials, successes in [('cp2order', 'calcprices_count', 'orders_count'),
+                                    ('order2done', 'orders_count', 'rides_count')]:
+        # orders of calcprices df_full does not match are capped by the calcprices of the cell
+        k = np.minimum(df_cells[successes], df_cells[trials])
+        intercept, slope = fit_logit(df_cells['log_ratio'], df_cells[trials], k, codes, len(bins))
+        df_model[f'{name}_intercept'], df_model[f'{name}_elasticity'] = intercept, slope
+    return df_model
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def evaluate_configs(df_recprice, df_model, alphas, axis_prices, step_distance_bin=1, max_distance_bin=25,
+                     max_cells=20_000_000, surge_column='original_dynamic_surge_updated',
+                     distance_column='log_distance_in_km'):
+    """
+    Expected cp2order, cp2done, rides and GMV (rides x recprice) of the historical calcprices re-priced
+    with the two-component surge for every (α, axis_price), in configs x calcprices chunks,
+    and their relative change to the current surge (α=1) under the same model
+    """
+    df = df_recprice[['price_base_usd', surge_column, 'minprice_usd', distance_column]].dropna(
+        subset=['price_base_usd', surge_column, distance_column])
+    df = df[df['price_base_usd'] > 0]
+    bins = get_distance_bins(df[distance_column], step_distance_bin, max_distance_bin)
+    df_model = df_model.set_index('distance_bin').reindex(np.unique(bins))
+    # distance bins the fit has not seen respond as the average one
+    df_model = df_model.fillna(df_model.mean(numeric_only=True))
+    position = np.searchsorted(df_model.index.to_numpy(), bins)
+    coefs = {col: df_model[col].to_numpy()[position] for col in
+             ['cp2order_intercept', 'cp2order_elasticity', 'order2done_intercept', 'order2done_elasticity']}
+    base_price = df['price_base_usd'].to_numpy(dtype=float)
+    surge = df[surge_column].to_numpy(dtype=float)
+    minprice = df['minprice_usd'].to_numpy(dtype=float)
+
+    df_grid = get_config_grid(alphas, axis_prices)
+    ## the current surge is evaluated as the first config
+    alpha = np.r_[1.0, df_grid['alpha'].to_numpy()][:, None]
+    axis_price = np.r_[0.0, df_grid['axis_price'].to_numpy()][:, None]
+    totals = {key: np.zeros(len(alpha)) for key in ['orders', 'rides', 'recprice', 'gmv']}
+    for rows, prices in iter_highrate_chunks(base_price, surge, minprice, alpha, axis_price, max_cells):
+        log_ratio = np.log(np.maximum(prices, 1e-9) / base_price[rows])
+        orders = sigmoid(coefs['cp2order_intercept'][rows] + coefs['cp2order_elasticity'][rows] * log_ratio)
+        rides = orders * sigmoid(coefs['order2done_intercept'][rows] + coefs['order2done_elasticity'][rows] * log_ratio)
+        totals['orders'] += orders.sum(axis=1)
+        totals['rides'] += rides.sum(axis=1)
+        totals['recprice'] += prices.sum(axis=1)
+        totals['gmv'] += (rides * prices).sum(axis=1)
+
+    n = len(df)
+    values = {
+        'cp2order': totals['orders'] / n, 'cp2done': totals['rides'] / n,
+        'recprice_usd': totals['recprice'] / n, 'gmv': totals['gmv'] / n,
+    }
+    for key, value in values.items():
+        df_grid[key] = value[1:]
+        df_grid[f'{key}_uplift_rel'] = value[1:] / value[0] - 1
+    return df_grid
+
+
+def choose_config(df_configs, objective='cp2done', max_price_change=0.01):
+    """
+    The config with the best objective ('cp2done' or 'gmv') among the ones that keep
+    the mean recprice within max_price_change of the current one (None - no constraint)
+    """
+    df = df_configs
+    if max_price_change is not None:
+        df = df[df['recprice_usd_uplift_rel'].abs() <= max_price_change]
+    if not len(df):
+        return None
+    return df.loc[df[objective].idxmax()]
+
+
+def optimize_city(df_recprice, df_full, alphas=np.linspace(0, 1, 21), axis_prices=None, objective='cp2done',
+                  max_price_change=0.01, step_distance_bin=1, max_distance_bin=25, max_cells=20_000_000):
+    """
+    Fits the demand response of one city and searches (α, axis_price) for the best expected objective.
+    axis_prices default to the 5-95% quantiles of price_base_usd in 50 steps.
+    Returns the recommended config, all configs and the fitted model
+    """
+    df_model = fit_elasticities(df_recprice, df_full, step_distance_bin, max_distance_bin)
+    if axis_prices is None:
+        low, high = np.nanquantile(df_recprice['price_base_usd'].to_numpy(dtype=float), [0.05, 0.95])
+        axis_prices = np.linspace(low, high, 50)
+    df_configs = evaluate_configs(df_recprice, df_model, alphas, axis_prices, step_distance_bin, max_distance_bin,
+                                  max_cells)
+    return choose_config(df_configs, objective, max_price_change), df_configs, df_model
+
+
+def run_city(city_id, order_type, load, **kwargs):
+    """load(city_id, order_type) -> (df_recprice, df_full) prepared as in total.py"""
+    df_recprice, df_full = load(city_id, order_type)
+    best, df_configs, df_model = optimize_city(df_recprice, df_full, **kwargs)
+    result = {'city_id': city_id, 'order_type': order_type, 'calcprices_count': len(df_recprice)}
+    if best is not None:
+        result.update(best.to_dict())
+    return result
+
+
+def optimize_cities(candidates, load, workers=4, output=None, **kwargs):
+    """
+    Recommended two-component parameters of every candidate city, one row per city.
+    candidates: (city_id, order_type) pairs or dicts with these keys (the stats of choose_cities).
+    load must be picklable (a module-level function) for workers > 1. A failed city is reported and skipped
+    """
+    candidates = [(i['city_id'], i['order_type']) if isinstance(i, dict) else tuple(i) for i in candidates]
+    results = run_in_pool(run_city, [(city_id, order_type, load) for city_id, order_type in candidates], workers,
+                          name=lambda args: f'{args[0]} {args[1]}', **kwargs)
+    df_results = pd.DataFrame(results)
+    if len(df_results):
+        df_results = df_results.sort_values(['city_id', 'order_type'], kind='stable', ignore_index=True)
+    if output is not None:
+        save_results(df_results, output)
+    return df_results
@@ -0,0 +1,199 @@
+import re
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from .metrics import METRIC_REGISTRY
+
+## columns prepare_recprice_data/prepare_order_data add, as SQL over the downloaded columns
+PREPARED_COLUMNS = {
+    'recprice': {
+        'group_name': 'recprice_group_name',
+        'utc_dt': 'CAST(utc_recprice_dttm AS DATE)',
+        'utc_hour': 'hour(utc_recprice_dttm)',
+        'utc_weekday': 'isodow(utc_recprice_dttm) - 1',
+        'local_dt': 'CAST(local_recprice_dttm AS DATE)',
+        'local_hour': 'hour(local_recprice_dttm)',
+        'local_weekday': 'isodow(local_recprice_dttm) - 1',
+        'ts': "time_bucket(INTERVAL '30 minutes', CAST(local_recprice_dttm AS TIMESTAMP))",
+    },
+    'order': {
+        'group_name': 'order_group_name',
+        'utc_dt': 'CAST(utc_order_dttm AS DATE)',
+        'utc_hour': 'hour(utc_order_dttm)',
+        'utc_weekday': 'isodow(utc_order_dttm) - 1',
+        'local_dt': 'CAST(local_order_dttm AS DATE)',
+        'local_hour': 'hour(local_order_dttm)',
+        'local_weekday': 'isodow(local_order_dttm) - 1',
+        'is_order_good': 'COALESCE(price_start_usd >= price_highrate_usd, false)',
+        'is_order_with_tender': 'COALESCE(is_order_with_tender, false)',
+        'is_order_start_price_bid': 'COALESCE(is_order_start_price_bid, false)',
+        'is_order_accepted_start_price_bid': 'COALESCE(is_order_accepted_start_price_bid, false)',
+        'is_order_done_start_price_bid': 'COALESCE(is_order_done_start_price_bid, false)',
+        'is_order_accepted': 'COALESCE(is_order_accepted, false)',
+        'is_order_done': 'COALESCE(is_order_done, false)',
+        'ts': "time_bucket(INTERVAL '30 minutes', CAST(local_order_dttm AS TIMESTAMP))",
+    },
+}
+
+
+def get_connection(memory_limit=None, temp_directory=None):
+    con = duckdb.connect()
+    # local timestamps are stored as UTC wall clock, as pandas reads them
+    con.execute("SET TimeZone = 'UTC'")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    if temp_directory is not None:
+        con.execute(f"SET temp_directory = '{temp_directory}'")
+    return con
+
+
+def get_columns(con, relation):
+    """column -> DuckDB type"""
+    return {row[0]: row[1] for row in con.execute(f'DESCRIBE SELECT * FROM {relation}').fetchall()}
+
+
+def create_source_view(con, name, source, kind, where=None):
+    """
+    A prepared frame is scanned as it is; a path or glob of raw Parquet files
+    (data/exp_id=.../recprice/*/*.pqt) gets the prepare_* columns on the fly.
+    Hive partition columns (utc_date=...) are readable in `where`, so whole files are skipped
+    """
+    if isinstance(source, pd.DataFrame):
+        con.register(f'{name}_frame', source)
+        query = f'SELECT * FROM {name}_frame'
+    else:
+        paths = [str(source)] if isinstance(source, str) or not hasattr(source, '__iter__') else [str(i) for i in source]
+        scan = f'read_parquet({paths}, hive_partitioning = true, union_by_name = true)'
+        raw_columns = get_columns(con, scan)
+        derived = PREPARED_COLUMNS.get(kind, {})
+        replace = [f'{expr} AS {col}' for col, expr in derived.items() if col in raw_columns]
+        add = [f'{expr} AS {col}' for col, expr in derived.items() if col not in raw_columns]
+        select = '*'
+        if replace:
+            select += f" REPLACE ({', '.join(replace)})"
+        if add:
+            select += ', ' + ', '.join(add)
+        query = f'SELECT {select} FROM {scan}'
+    if where is not None:
+        query = f'SELECT * FROM ({query}) WHERE {where}'
+    con.execute(f'CREATE OR REPLACE TEMP VIEW {name} AS {query}')
+
+
+def create_full_view(con, name='full_src', order='order_src', recprice='recprice_src'):
+    """
+    get_full_df on the order and recprice views, group_name taken from recprice as in total.py.
+    np.round(x, 3) is rint(x * 1000) / 1000, so the prices are compared as round_even of the scaled values:
+    DuckDB round(x, 3) rounds halves away from zero
+    """
+    order_columns = get_columns(con, order)
+    recprice_columns = get_columns(con, recprice)
+    common = [col for col in recprice_columns if col in order_columns]
+    con.execute(f"""
+    CREATE OR REPLACE TEMP VIEW {name} AS
+    SELECT o.* REPLACE (r.recprice_group_name AS group_name), r.* EXCLUDE ({', '.join(common)})
+    FROM {order} o
+    JOIN {recprice} r
+        ON o.calcprice_uuid = r.calcprice_uuid
+    WHERE round_even(r.recprice_usd * 1000, 0) = round_even(o.price_highrate_usd * 1000, 0)
+    """)
+
+
+def get_sql_condition(condition):
+    """
+    A registry filter for DuckDB with the semantics of eval_condition. A term `a / b <op> c` is spelled out
+    for b = 0: pandas gives inf or -inf (NaN for 0 / 0, never kept), DuckDB NULL or a NaN that compares
+    greater than any number
+    """
+    terms = []
+    for term in condition.split(' and '):
+        match = re.fullmatch(r'\s*(\w+)\s*/\s*(\w+)\s*(>=|<=|>|<)\s*(.+?)\s*', term)
+        if match is not None:
+            numerator, denominator, op, value = match.groups()
+            term = (f"CASE WHEN {denominator} = 0 THEN {numerator} <> 0 AND "
+                    f"(CASE WHEN {numerator} > 0 THEN 'inf' ELSE '-inf' END)::DOUBLE {op} {value} "
+                    f"ELSE {numerator} / {denominator} {op} {value} END")
+        terms.append(f'({term})')
+    return ' AND '.join(terms)
+
+
+def get_aggregate_query(view, group_cols, registry, columns):
+    """
+    One GROUP BY per source. A metric is NULL for a group where its filter keeps no rows
+    and 0 for a group with rows but only missing values, like aggregate_source
+    """
+    keys = ', '.join(group_cols)
+    selects = []
+    for name, _, column, how, condition in registry:
+        where = f' FILTER (WHERE {get_sql_condition(condition)})' if condition is not None else ''
+        if how == 'nunique':
+            value = f'COUNT(DISTINCT {column}){where}'
+        elif columns[column] == 'BOOLEAN':
+            value = f'SUM(CAST({column} AS BIGINT)){where}'
+        else:
+            value = f'SUM({column}){where}'
+        cast = 'BIGINT' if is_integer_type(columns[column]) or how == 'nunique' else 'DOUBLE'
+        selects.append(f'CASE WHEN COUNT(*){where} > 0 THEN CAST(COALESCE({value}, 0) AS {cast}) END AS {name}')
+    not_null = ' AND '.join(f'{col} IS NOT NULL' for col in group_cols)
+    metrics = ',\n        '.join(selects)
+    return f"""
+    SELECT {keys},
+        {metrics}
+    FROM {view}
+    WHERE {not_null}
+    GROUP BY {keys}
+    """
+
+
+def is_integer_type(duckdb_type):
+    return duckdb_type == 'BOOLEAN' or duckdb_type in ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT',
+                                                       'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT')
+
+
+def calculate_metrics_duckdb(recprice, order, full=None, group_cols=['group_name'], registry=METRIC_REGISTRY,
+                             where=None, con=None, memory_limit=None, temp_directory=None):
+    """
+    calculate_metrics as DuckDB queries over prepared frames or raw Parquet files.
+    Only the columns of the registry and the groups are read, `where` is pushed down to the scans
+    and the result has one row per group. full=None builds df_full from order and recprice.
+    memory_limit/temp_directory let DuckDB spill distinct counts of big groups to disk
+    """
+    con = get_connection(memory_limit, temp_directory) if con is None else con
+    create_source_view(con, 'recprice_src', recprice, 'recprice', where)
+    create_source_view(con, 'order_src', order, 'order', where)
+    if full is None:
+        create_full_view(con)
+    else:
+        create_source_view(con, 'full_src', full, 'full', where)
+
+    sources = list(dict.fromkeys(i[1] for i in registry))
+    queries = {}
+    integer = {}
+    for source in sources:
+        columns = get_columns(con, f'{source}_src')
+        source_registry = [i for i in registry if i[1] == source]
+        queries[source] = get_aggregate_query(f'{source}_src', group_cols, source_registry, columns)
+        for name, _, column, how, _ in source_registry:
+            integer[name] = how == 'nunique' or is_integer_type(columns[column])
+
+    ## groups of the first registry source (recprice) are the base of the left join
+    keys = ', '.join(group_cols)
+    ctes = ',\n'.join(f'{source}_agg AS ({query})' for source, query in queries.items())
+    joins = '\n'.join(f'LEFT JOIN {source}_agg USING ({keys})' for source in sources[1:])
+    names = ', '.join(f'{source}_agg.{name}' for name, source, _, _, _ in registry)
+    dfm = con.execute(f"""
+    WITH {ctes}
+    SELECT {keys}, {names}
+    FROM {sources[0]}_agg
+    {joins}
+    ORDER BY {keys}
+    """).fetchdf()
+
+    for name, _, _, _, _ in registry:
+        values = dfm[name]
+        if integer[name] and values.notnull().all():
+            dfm[name] = values.astype('int64')
+        else:
+            dfm[name] = values.astype(float)
+    return dfm
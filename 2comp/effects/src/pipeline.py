@@ -1,6 +1,12 @@
 import numpy as np
+import pandas as pd
 from scipy.stats import ttest_ind
-from statsmodels.stats.power import TTestIndPower
+from scipy.stats import t as student_t
+
+from .power import calc_nobs1, calc_power
+
+## covariate columns of the pre-period: <numerator or denominator column><PRE_SUFFIX>
+PRE_SUFFIX = "_pre"
 
 
 class RatioMetricHypothesisTestingPipeline:
@@ -108,16 +114,287 @@ class RatioMetricHypothesisTestingPipeline:
         ]
 
     def calc_power(self):
-        power_analysis = TTestIndPower()
-        self.result["power"] = power_analysis.solve_power(
+        self.result["power"] = float(calc_power(
             effect_size=self.result["effect_size"],
             nobs1=self.result["n_obs_control"],
             alpha=0.05,
             ratio=self.result["n_obs_experimental"] / self.result["n_obs_control"],
-        )
+        ))
 
     def calc_obs_needed(self):
-        power_analysis = TTestIndPower()
-        self.result["obs_needed"] = 2 * power_analysis.solve_power(
+        self.result["obs_needed"] = 2 * float(calc_nobs1(
             effect_size=self.result["effect_size"], power=0.8, alpha=0.05
-        )
\ No newline at end of file
+        ))
+
+class BatchRatioMetricHypothesisTestingPipeline:
+    """
+    RatioMetricHypothesisTestingPipeline for a whole metric list at once:
+    numerators and denominators are matrix columns, one row per switch interval
+    """
+
+    def __init__(self, data, metric_list, groups, equal_var=True, adjustment=None):
+        missing = [i for i in metric_list if i[1] not in data.columns or i[2] not in data.columns]
+        for i in missing:
+            print(f"KeyError: missing columns for metric {i}")
+        self.metric_list = [i for i in metric_list if i not in missing]
+        self.metrics = [i[0] for i in self.metric_list]
+        self.numerators = data[[i[1] for i in self.metric_list]].fillna(0).to_numpy(dtype=float)
+        self.denominators = data[[i[2] for i in self.metric_list]].fillna(0).to_numpy(dtype=float)
+        self.is_control = (data["group_name"] == groups["control"]).to_numpy()
+        self.is_treatment = (data["group_name"] == groups["treatment"]).to_numpy()
+        self.equal_var = equal_var
+        self.adjustment = adjustment
+        if adjustment is not None:
+            # NaN where the interval has no pre-period slot
+            self.pre_numerators = data.reindex(
+                columns=[f"{i[1]}{PRE_SUFFIX}" for i in self.metric_list]).to_numpy(dtype=float)
+            self.pre_denominators = data.reindex(
+                columns=[f"{i[2]}{PRE_SUFFIX}" for i in self.metric_list]).to_numpy(dtype=float)
+        self.result: dict = {"metric": self.metrics}
+
+    def run(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.check_zero_denominator()
+            self.calc_values()
+            self.linearize_data()
+            self.calc_pvalue()
+            self.calc_effect_size()
+            self.calc_n_obs()
+            self.calc_power()
+            self.calc_obs_needed()
+            self.apply_skip()
+        return pd.DataFrame(self.result)
+
+    def check_zero_denominator(self):
+        self.skip = (
+            (self.denominators[self.is_control].sum(axis=0) == 0)
+            | (self.denominators[self.is_treatment].sum(axis=0) == 0)
+        )
+
+    def calc_values(self):
+        self.result["control_value"] = (
+            self.numerators[self.is_control].sum(axis=0)
+            / self.denominators[self.is_control].sum(axis=0)
+        )
+        self.result["experimental_value"] = (
+            self.numerators[self.is_treatment].sum(axis=0)
+            / self.denominators[self.is_treatment].sum(axis=0)
+        )
+        self.result["uplift_abs"] = (
+            self.result["experimental_value"] - self.result["control_value"]
+        )
+        self.result["uplift_rel"] = (
+            self.result["uplift_abs"] / self.result["control_value"]
+        )
+
+    def linearize_data(self):
+        k = self.result["control_value"]
+        self.linearized = self.numerators - k * self.denominators
+        if self.adjustment is not None:
+            self.adjust_data()
+        control_lin = self.linearized[self.is_control]
+        experimental_lin = self.linearized[self.is_treatment]
+        self.n1, self.n2 = np.int64(len(control_lin)), np.int64(len(experimental_lin))
+        self.u1, self.u2 = control_lin.mean(axis=0), experimental_lin.mean(axis=0)
+        self.s1, self.s2 = control_lin.var(axis=0, ddof=1), experimental_lin.var(axis=0, ddof=1)
+
+    def adjust_data(self):
+        """
+        CUPED on the linearized intervals: the covariate is the pre-period of the interval's slot,
+        linearized with the pre-period ratio. adjustment='cuped' - one theta for both groups,
+        'regression' - a theta per group (regression adjustment with interactions).
+        Intervals without a pre-period slot are not adjusted
+        """
+        x, y = self.pre_numerators, self.pre_denominators
+        groups = [self.is_control, self.is_treatment]
+        matched = ~(np.isnan(x) | np.isnan(y)) & (self.is_control | self.is_treatment)[:, None]
+        x, y = np.where(matched, x, 0), np.where(matched, y, 0)
+        covariate = x - x.sum(axis=0) / y.sum(axis=0) * y
+        covariate = np.where(matched, covariate - (covariate * matched).sum(axis=0) / matched.sum(axis=0), 0)
+        covariate = np.nan_to_num(covariate, nan=0.0, posinf=0.0, neginf=0.0)
+
+        ## within-group (co)variances, so that the treatment effect does not leak into theta
+        cov, var = [], []
+        for rows in groups:
+            c_dev = covariate[rows] - covariate[rows].mean(axis=0)
+            lin_dev = self.linearized[rows] - self.linearized[rows].mean(axis=0)
+            cov.append((c_dev * lin_dev).sum(axis=0))
+            var.append((c_dev ** 2).sum(axis=0))
+        if self.adjustment == "cuped":
+            theta = [np.nan_to_num((cov[0] + cov[1]) / (var[0] + var[1]))] * 2
+        elif self.adjustment == "regression":
+            theta = [np.nan_to_num(cov[0] / var[0]), np.nan_to_num(cov[1] / var[1])]
+        else:
+            raise ValueError(f"unknown adjustment {self.adjustment}")
+
+        variance_before = sum(self.linearized[rows].var(axis=0, ddof=1) for rows in groups)
+        for rows, group_theta in zip(groups, theta):
+            self.linearized[rows] -= group_theta * covariate[rows]
+        variance_after = sum(self.linearized[rows].var(axis=0, ddof=1) for rows in groups)
+        self.result["theta"] = (theta[0] + theta[1]) / 2
+        self.result["variance_reduction"] = 1 - variance_after / variance_before
+
+    def calc_pvalue(self):
+        """T-test for the means of two independent samples, Student's or Welch's"""
+        n1, n2, s1, s2 = self.n1, self.n2, self.s1, self.s2
+        if self.equal_var:
+            df = n1 + n2 - 2
+            se = np.sqrt(((n1 - 1) * s1 + (n2 - 1) * s2) / df * (1 / n1 + 1 / n2))
+        else:
+            v1, v2 = s1 / n1, s2 / n2
+            df = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+            se = np.sqrt(v1 + v2)
+        t = (self.u1 - self.u2) / se
+        self.result["pvalue"] = 2 * student_t.sf(np.abs(t), df)
+
+    def calc_effect_size(self):
+        """Cohen's d"""
+        n1, n2 = self.n1, self.n2
+        s = np.sqrt(((n1 - 1) * self.s1 + (n2 - 1) * self.s2) / (n1 + n2 - 2))
+        self.result["effect_size"] = (self.u2 - self.u1) / s
+
+    def calc_n_obs(self):
+        # a group without intervals has no n_obs, as value_counts()[group] fails
+        self.result["n_obs_control"] = np.full(len(self.metrics), self.n1 if self.n1 else np.nan)
+        self.result["n_obs_experimental"] = np.full(len(self.metrics), self.n2 if self.n2 else np.nan)
+
+    def calc_power(self):
+        self.result["power"] = calc_power(
+            effect_size=np.where(self.skip, np.nan, self.result["effect_size"]),
+            nobs1=self.n1,
+            alpha=0.05,
+            ratio=self.n2 / self.n1,
+        )
+
+    def calc_obs_needed(self):
+        self.result["obs_needed"] = 2 * calc_nobs1(
+            effect_size=np.where(self.skip, np.nan, self.result["effect_size"]), power=0.8, alpha=0.05
+        )
+
+    def apply_skip(self):
+        for key in ["control_value", "experimental_value", "uplift_abs", "uplift_rel",
+                    "pvalue", "effect_size", "power", "obs_needed", "theta", "variance_reduction"]:
+            if key in self.result:
+                self.result[key] = np.where(self.skip, np.nan, self.result[key])
+
+
+def linearize_moments(moments_control, moments_treatment):
+    """
+    Means and variances of the linearized intervals x - k * y, k the control ratio, from per-group
+    sums over the intervals: moments[..., :] = [n, Σx, Σy, Σx², Σy², Σxy], x numerators,
+    y denominators, any leading shape (e.g. cells x metrics)
+    """
+    n1, x1, y1, xx1, yy1, xy1 = np.moveaxis(np.asarray(moments_control, dtype=float), -1, 0)
+    n2, x2, y2, xx2, yy2, xy2 = np.moveaxis(np.asarray(moments_treatment, dtype=float), -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = x1 / y1
+        u1, u2 = (x1 - k * y1) / n1, (x2 - k * y2) / n2
+        ss1 = xx1 - 2 * k * xy1 + k ** 2 * yy1 - n1 * u1 ** 2
+        ss2 = xx2 - 2 * k * xy2 + k ** 2 * yy2 - n2 * u2 ** 2
+        s1, s2 = np.maximum(ss1, 0) / (n1 - 1), np.maximum(ss2, 0) / (n2 - 1)
+    return {
+        "control_value": k, "experimental_value": x2 / y2, "skip": (y1 == 0) | (y2 == 0),
+        "n1": n1, "n2": n2, "u1": u1, "u2": u2, "s1": s1, "s2": s2, "y1_mean": y1 / n1,
+    }
+
+
+def ratio_ttest_from_moments(moments_control, moments_treatment, equal_var=True):
+    """
+    BatchRatioMetricHypothesisTestingPipeline from per-group sums over the intervals instead of
+    the intervals themselves, see linearize_moments. Returns a dict of result arrays
+    """
+    lin = linearize_moments(moments_control, moments_treatment)
+    n1, n2, u1, u2, s1, s2, skip = (lin[i] for i in ["n1", "n2", "u1", "u2", "s1", "s2", "skip"])
+    result = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["control_value"] = lin["control_value"]
+        result["experimental_value"] = lin["experimental_value"]
+        result["uplift_abs"] = result["experimental_value"] - result["control_value"]
+        result["uplift_rel"] = result["uplift_abs"] / result["control_value"]
+        if equal_var:
+            df = n1 + n2 - 2
+            se = np.sqrt(((n1 - 1) * s1 + (n2 - 1) * s2) / df * (1 / n1 + 1 / n2))
+        else:
+            v1, v2 = s1 / n1, s2 / n2
+            df = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+            se = np.sqrt(v1 + v2)
+        result["pvalue"] = 2 * student_t.sf(np.abs((u1 - u2) / se), df)
+        s = np.sqrt(((n1 - 1) * s1 + (n2 - 1) * s2) / (n1 + n2 - 2))
+        result["effect_size"] = (u2 - u1) / s
+        result["n_obs_control"] = np.where(n1 > 0, n1, np.nan)
+        result["n_obs_experimental"] = np.where(n2 > 0, n2, np.nan)
+        result["power"] = calc_power(np.where(skip, np.nan, result["effect_size"]), n1, ratio=n2 / n1, alpha=0.05)
+        result["obs_needed"] = 2 * calc_nobs1(np.where(skip, np.nan, result["effect_size"]), power=0.8, alpha=0.05)
+    for key in ["control_value", "experimental_value", "uplift_abs", "uplift_rel",
+                "pvalue", "effect_size", "power", "obs_needed"]:
+        result[key] = np.where(skip, np.nan, result[key])
+    return result
+
+
+def delta_ttest_from_moments(moments_control, moments_treatment, equal_var=True):
+    """
+    ratio_ttest_from_moments with the delta-method variance of each group's ratio,
+    Var(x̄ / ȳ) ≈ Var(x - r * y) / (n * ȳ²) with the group's own ratio r, in place of
+    the variance of the intervals linearized with the control ratio.
+    equal_var pools the per-interval variances Var(x - r * y) / ȳ² of both groups as Student's t-test does
+    """
+    result = ratio_ttest_from_moments(moments_control, moments_treatment, equal_var)
+    n1, x1, y1, xx1, yy1, xy1 = np.moveaxis(np.asarray(moments_control, dtype=float), -1, 0)
+    n2, x2, y2, xx2, yy2, xy2 = np.moveaxis(np.asarray(moments_treatment, dtype=float), -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r1, r2 = x1 / y1, x2 / y2
+        # x - r * y sums to zero with the group's own ratio
+        s1 = np.maximum(xx1 - 2 * r1 * xy1 + r1 ** 2 * yy1, 0) / (n1 - 1) / (y1 / n1) ** 2
+        s2 = np.maximum(xx2 - 2 * r2 * xy2 + r2 ** 2 * yy2, 0) / (n2 - 1) / (y2 / n2) ** 2
+        if equal_var:
+            df = n1 + n2 - 2
+            se = np.sqrt(((n1 - 1) * s1 + (n2 - 1) * s2) / df * (1 / n1 + 1 / n2))
+        else:
+            v1, v2 = s1 / n1, s2 / n2
+            df = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+            se = np.sqrt(v1 + v2)
+        pvalue = 2 * student_t.sf(np.abs(r2 - r1) / se, df)
+    result["pvalue"] = np.where(np.isnan(result["control_value"]), np.nan, pvalue)
+    return result
+
+
+class MomentsRatioMetricHypothesisTestingPipeline:
+    """
+    BatchRatioMetricHypothesisTestingPipeline from per-group sums, sums of squares and cross-products
+    of numerators and denominators, taken for the whole metric list in one pass over the intervals.
+    variance='linearization' gives the p-values of linearize_data, 'delta' the delta-method ones
+    """
+
+    def __init__(self, data, metric_list, groups, equal_var=True, variance="linearization"):
+        missing = [i for i in metric_list if i[1] not in data.columns or i[2] not in data.columns]
+        for i in missing:
+            print(f"KeyError: missing columns for metric {i}")
+        self.metric_list = [i for i in metric_list if i not in missing]
+        self.metrics = [i[0] for i in self.metric_list]
+        self.numerators = data[[i[1] for i in self.metric_list]].fillna(0).to_numpy(dtype=float)
+        self.denominators = data[[i[2] for i in self.metric_list]].fillna(0).to_numpy(dtype=float)
+        self.arms = np.stack([
+            (data["group_name"] == groups["control"]).to_numpy(),
+            (data["group_name"] == groups["treatment"]).to_numpy(),
+        ]).astype(float)
+        self.equal_var = equal_var
+        self.variance = variance
+
+    def calc_moments(self):
+        """(control, treatment) x metrics x [n, Σx, Σy, Σx², Σy², Σxy]"""
+        x, y = self.numerators, self.denominators
+        sums = self.arms @ np.hstack([x, y, x * x, y * y, x * y])
+        sums = sums.reshape(2, 5, len(self.metrics)).transpose(0, 2, 1)
+        n = np.broadcast_to(self.arms.sum(axis=1)[:, None, None], (2, len(self.metrics), 1))
+        return np.concatenate([n, sums], axis=-1)
+
+    def run(self):
+        moments = self.calc_moments()
+        if self.variance == "delta":
+            result = delta_ttest_from_moments(moments[0], moments[1], self.equal_var)
+        else:
+            result = ratio_ttest_from_moments(moments[0], moments[1], self.equal_var)
+        # interval counts stay integers as in calc_n_obs
+        for key, n in zip(["n_obs_control", "n_obs_experimental"], self.arms.sum(axis=1).astype("int64")):
+            result[key] = np.full(len(self.metrics), n if n else np.nan)
+        return pd.DataFrame({"metric": self.metrics, **result})
@@ -0,0 +1,56 @@
+import numpy as np
+from scipy.stats import nct, norm
+from scipy.stats import t as student_t
+
+
+def calc_power(effect_size, nobs1, ratio=1.0, alpha=0.05, exact=True):
+    """
+    Power of the two-sided two-sample t-test for arrays of effect sizes and nobs,
+    same as TTestIndPower().power: noncentral t when exact, normal approximation otherwise.
+    NaN where the effect size or the sample sizes are undefined
+    """
+    effect_size, nobs1, ratio = np.broadcast_arrays(
+        np.asarray(effect_size, dtype=float), np.asarray(nobs1, dtype=float), np.asarray(ratio, dtype=float)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nobs2 = nobs1 * ratio
+        valid = np.isfinite(effect_size) & (nobs1 > 1) & (nobs2 > 1)
+        nc = effect_size * np.sqrt(nobs1 * nobs2 / (nobs1 + nobs2))
+        if exact:
+            df = np.where(valid, nobs1 + nobs2 - 2, 1)
+            crit = student_t.isf(alpha / 2, df)
+            power = nct.sf(crit, df, nc) + nct.cdf(-crit, df, nc)
+        else:
+            crit = norm.isf(alpha / 2)
+            power = norm.sf(crit - nc) + norm.cdf(-crit - nc)
+    return np.where(valid, power, np.nan)
+
+
+def calc_nobs1(effect_size, power=0.8, ratio=1.0, alpha=0.05, exact=True, n_iter=60):
+    """
+    Observations in the first group to reach the power, same as
+    TTestIndPower().solve_power(effect_size=..., power=..., alpha=..., ratio=...).
+    Starts from the normal approximation and, when exact, refines it by bisection
+    on the noncentral t power for the whole batch at once.
+    NaN where the effect size is zero or undefined
+    """
+    effect_size, ratio = np.broadcast_arrays(np.asarray(effect_size, dtype=float), np.asarray(ratio, dtype=float))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        valid = np.isfinite(effect_size) & (effect_size != 0) & (ratio > 0)
+        d = np.where(valid, np.abs(effect_size), 1.0)
+        r = np.where(valid, ratio, 1.0)
+        z = norm.isf(alpha / 2) + norm.ppf(power)
+        nobs1 = (1 + 1 / r) * (z / d) ** 2
+        if exact:
+            lo = np.full(d.shape, 1.0 + 1e-6)
+            hi = np.maximum(2 * nobs1, 4.0)
+            # the normal approximation undershoots for small samples: widen the bracket
+            while (calc_power(d, hi, r, alpha) < power).any():
+                hi = np.where(calc_power(d, hi, r, alpha) < power, hi * 2, hi)
+            for _ in range(n_iter):
+                mid = (lo + hi) / 2
+                below = calc_power(d, mid, r, alpha) < power
+                lo = np.where(below, mid, lo)
+                hi = np.where(below, hi, mid)
+            nobs1 = hi
+    return np.where(valid, nobs1, np.nan)
@@ -1,16 +1,141 @@
 import warnings
 warnings.filterwarnings("ignore")
 
-import h3
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
+from h3.api import basic_int as h3_int
+
+from .join import JoinIndex
+from .schema import h3_to_int
+
+
+## H3 index layout: resolution in bits 52-55, then 15 digits of 3 bits, unused digits set to 7
+H3_RES_OFFSET = 52
+H3_RES_MASK = np.uint64(0xF) << np.uint64(H3_RES_OFFSET)
+H3_MAX_RES = 15
+H3_DIGIT_BITS = 3
+# h3 v4 renamed geo_to_h3 to latlng_to_cell
+latlng_to_cell = getattr(h3_int, 'latlng_to_cell', None) or h3_int.geo_to_h3
+## h3 has no vectorized latlng_to_cell, every distinct point is one call: from this many points on
+## the calls are split over a process pool by default, below it the pool start costs more than it saves
+POOL_MIN_POINTS = 200_000
 
 
-def get_hex(df, hex_size):
-    df[f'hex_from_calc_{hex_size}'] = [h3.geo_to_h3(x, y, hex_size) for x, y in zip(df['fromlatitude'], df['fromlongitude'])]
+def get_hex(df, hex_size, as_int=False, workers=None, hierarchical=False):
+    """hierarchical: take the parents of a finer hex_from_calc_* column if there is one"""
+    finer = [r for r in range(hex_size + 1, H3_MAX_RES + 1) if f'hex_from_calc_{r}' in df.columns]
+    if hierarchical and finer:
+        cells = cell_to_parent(to_cells(df[f'hex_from_calc_{finer[0]}']), hex_size)
+        df[f'hex_from_calc_{hex_size}'] = cells if as_int else cells_to_str(cells)
+        return df
+    return get_hexes(df, [hex_size], as_int, workers)
+
+
+def get_hexes(df, hex_sizes, as_int=False, workers=None, hierarchical=False):
+    """
+    Distinct points are found once for all resolutions.
+    hierarchical: coarser resolutions as parents of the finest one, no indexing per resolution.
+    H3 cells are not exactly nested, so near cell edges the parent is not the cell
+    the point falls into (about 6% of points at resolutions 7-9).
+    workers: see geo_to_cells
+    """
+    points = unique_points(df['fromlatitude'], df['fromlongitude'])
+    hex_sizes = sorted(hex_sizes, reverse=True)
+    for hex_size in hex_sizes:
+        if hierarchical and hex_size != hex_sizes[0]:
+            cells = cell_to_parent(finest, hex_size)
+        else:
+            cells = finest = geo_to_cells(df['fromlatitude'], df['fromlongitude'], hex_size, workers, points=points)
+        df[f'hex_from_calc_{hex_size}'] = cells if as_int else cells_to_str(cells)
     return df
 
 
+def unique_points(lat, lng):
+    """Rows with coordinates, their codes in the distinct points and the distinct points"""
+    points = np.column_stack([np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)])
+    valid = ~np.isnan(points).any(axis=1)
+    ## a (lat, lng) pair as one complex number to factorize pairs by hashing
+    codes, uniques = pd.factorize(np.ascontiguousarray(points[valid]).view(np.complex128).ravel())
+    return valid, codes, np.column_stack([uniques.real, uniques.imag])
+
+
+def geo_to_cells(lat, lng, res, workers=None, chunk_size=500_000, points=None):
+    """
+    uint64 H3 cells of points, 0 for missing coordinates. Every distinct point is indexed once,
+    in chunks over a process pool when workers > 1. workers=None: all CPUs from POOL_MIN_POINTS
+    distinct points on, else one by one in this process. points: unique_points(lat, lng) to reuse
+    """
+    valid, codes, uniques = unique_points(lat, lng) if points is None else points
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(uniques) >= POOL_MIN_POINTS else 1
+    if workers > 1:
+        # at least a chunk per worker
+        chunk_size = max(1, min(chunk_size, -(-len(uniques) // workers)))
+    chunks = [(uniques[i:i + chunk_size], res) for i in range(0, len(uniques), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            unique_cells = list(executor.map(geo_to_cells_chunk, chunks))
+    else:
+        unique_cells = [geo_to_cells_chunk(chunk) for chunk in chunks]
+    cells = np.zeros(len(valid), dtype=np.uint64)
+    if unique_cells:
+        cells[valid] = np.concatenate(unique_cells)[codes]
+    return cells
+
+
+def geo_to_cells_chunk(args):
+    points, res = args
+    lat, lng = points[:, 0].tolist(), points[:, 1].tolist()
+    return np.fromiter((latlng_to_cell(x, y, res) for x, y in zip(lat, lng)), dtype=np.uint64, count=len(lat))
+
+
+def cell_resolution(cells):
+    return ((cells & H3_RES_MASK) >> np.uint64(H3_RES_OFFSET)).astype(np.int8)
+
+
+def cell_to_parent(cells, res):
+    """Vectorized h3 cell_to_parent: set the resolution and fill the finer digits with 7; 0 stays 0"""
+    cells = np.asarray(cells, dtype=np.uint64)
+    if (cell_resolution(cells[cells != 0]) < res).any():
+        raise ValueError(f'cells are coarser than resolution {res}')
+    unused = np.uint64((1 << ((H3_MAX_RES - res) * H3_DIGIT_BITS)) - 1)
+    parents = (cells & ~H3_RES_MASK) | (np.uint64(res) << np.uint64(H3_RES_OFFSET)) | unused
+    return np.where(cells == 0, cells, parents)
+
+
+def to_cells(values):
+    """H3 cells as uint64 from strings or integers"""
+    if pd.api.types.is_integer_dtype(values):
+        return np.asarray(values, dtype=np.uint64)
+    return h3_to_int(values).to_numpy()
+
+
+def cells_to_str(cells):
+    uniques, inverse = np.unique(cells, return_inverse=True)
+    names = np.array([format(cell, 'x') if cell else None for cell in uniques.tolist()], dtype=object)
+    return names[inverse.reshape(-1)]
+
+
+def verify_hex(df, hex_column='hex_from', workers=None):
+    """
+    Recomputes the BigQuery hex column from fromlatitude/fromlongitude at its own resolution.
+    Prints the share of matching rows and returns the rows that don't match
+    """
+    expected = to_cells(df[hex_column])
+    res = cell_resolution(expected[expected != 0])
+    if len(np.unique(res)) > 1:
+        raise ValueError(f'{hex_column} has several resolutions: {np.unique(res)}')
+    if not len(res):
+        return df.iloc[:0]
+    cells = geo_to_cells(df['fromlatitude'], df['fromlongitude'], int(res[0]), workers)
+    match = (cells == expected) | (expected == 0)
+    print(f'{hex_column}: res {res[0]}, доля совпадений: {round(match.mean(), 4)}')
+    return df[~match]
+
+
 def convert_ts_to_timestamp(df):
     try:
         df['ts'] = df['ts'].dt.to_timestamp()
@@ -26,7 +151,21 @@ def get_ts(df, date_column_name, by_time_resolution):
     return df
 
 
-def prepare_recprice_data(df):
+def add_date_columns(df, utc_column, local_column, compact=False):
+    """compact: datetime64 dates and int8 hours/weekdays instead of python date objects"""
+    for prefix, column in [('utc', utc_column), ('local', local_column)]:
+        if compact:
+            df[f'{prefix}_dt'] = df[column].dt.normalize()
+            df[f'{prefix}_hour'] = df[column].dt.hour.astype('int8')
+            df[f'{prefix}_weekday'] = df[column].dt.weekday.astype('int8')
+        else:
+            df[f'{prefix}_dt'] = df[column].dt.date
+            df[f'{prefix}_hour'] = df[column].dt.hour
+            df[f'{prefix}_weekday'] = df[column].dt.weekday
+    return df
+
+
+def prepare_recprice_data(df, compact=False):
     df['group_name'] = df['recprice_group_name']
 #     df = df[
 #         ~(df['log_duration_in_min'].isnull()) &
@@ -38,19 +177,14 @@ def prepare_recprice_data(df):
 #     distance_max = np.quantile(df['log_distance_in_km'], q=0.99)
 #     df = df[(df['log_duration_in_min'] > duration_min) & (df['log_duration_in_min'] < duration_max)]
 #     df = df[(df['log_distance_in_km'] > distance_min) & (df['log_distance_in_km'] < distance_max)]
-    df['utc_dt'] = df['utc_recprice_dttm'].dt.date
-    df['utc_hour'] = df['utc_recprice_dttm'].dt.hour
-    df['utc_weekday'] = df['utc_recprice_dttm'].dt.weekday
-    df['local_dt'] = df['local_recprice_dttm'].dt.date
-    df['local_hour'] = df['local_recprice_dttm'].dt.hour
-    df['local_weekday'] = df['local_recprice_dttm'].dt.weekday
+    df = add_date_columns(df, 'utc_recprice_dttm', 'local_recprice_dttm', compact)
     df = get_ts(df, date_column_name='local_recprice_dttm', by_time_resolution='30min')
-    df['time'] = df['ts'].dt.time
+    df['time'] = df['ts'] - df['ts'].dt.normalize() if compact else df['ts'].dt.time
     df.reset_index(drop=True, inplace=True)
     return df
 
 
-def prepare_order_data(df):
+def prepare_order_data(df, compact=False):
     df['group_name'] = df['order_group_name']
 #     df = df[
 #         ~(df['duration_in_min'].isnull()) &
@@ -62,12 +196,7 @@ def prepare_order_data(df):
 #     distance_max = np.quantile(df['distance_in_km'], q=0.99)
 #     df = df[(df['duration_in_min'] > duration_min) & (df['duration_in_min'] < duration_max)]
 #     df = df[(df['distance_in_km'] > distance_min) & (df['distance_in_km'] < distance_max)]
-    df['utc_dt'] = df['utc_order_dttm'].dt.date
-    df['utc_hour'] = df['utc_order_dttm'].dt.hour
-    df['utc_weekday'] = df['utc_order_dttm'].dt.weekday
-    df['local_dt'] = df['local_order_dttm'].dt.date
-    df['local_hour'] = df['local_order_dttm'].dt.hour
-    df['local_weekday'] = df['local_order_dttm'].dt.weekday
+    df = add_date_columns(df, 'utc_order_dttm', 'local_order_dttm', compact)
     df['is_order_good'] = df['price_start_usd'] >= df['price_highrate_usd']
     df['is_order_with_tender'] = df['is_order_with_tender'].fillna(False)
     df['is_order_start_price_bid'] = df['is_order_start_price_bid'].fillna(False)
@@ -77,7 +206,7 @@ def prepare_order_data(df):
     df['is_order_done'] = df['is_order_done'].fillna(False)
     df['is_order_good'] = df['is_order_good'].fillna(False)
     df = get_ts(df, date_column_name='local_order_dttm', by_time_resolution='30min')
-    df['time'] = df['ts'].dt.time
+    df['time'] = df['ts'] - df['ts'].dt.normalize() if compact else df['ts'].dt.time
     df.reset_index(drop=True, inplace=True)
     return df
 
@@ -94,21 +223,34 @@ def prepare_order_data(df):
 #     return df_full
 
 
-def get_full_df(df_left, df_right):
-    group_cols = ['calcprice_uuid']
-    right_columns = set(df_right.columns) - (set(df_left.columns) & set(df_right.columns) - set(group_cols))
-    df_right = df_right[list(right_columns)]
-    df_full = df_left.merge(df_right, on=group_cols, how='left')
-    df_full = df_full[round(df_full.recprice_usd, 3) == round(df_full.price_highrate_usd, 3)]
-    print(f'только уникальные ордера? – {df_full.shape[0] == df_full.order_uuid.nunique()}')
-    print(f'доля оставшихся ордеров: {round(df_full.order_uuid.nunique() / df_left.order_uuid.nunique(), 4)}')
+def get_full_df(df_left, df_right, join_index=None):
+    """
+    df_left: orders, df_right: recprice. join_index: JoinIndex(df_left, df_right),
+    pass it to reuse the join in prepare_my.
+    Prints whether every kept row is a distinct order_uuid and the share of the distinct order_uuid kept
+    """
+    if join_index is None:
+        join_index = JoinIndex(df_left, df_right, on='calcprice_uuid')
+    recprice_usd = join_index.column(df_left, df_right, 'recprice_usd').to_numpy(dtype=float, na_value=np.nan)
+    price_highrate_usd = join_index.column(df_left, df_right, 'price_highrate_usd').to_numpy(dtype=float, na_value=np.nan)
+    keep = np.round(recprice_usd, 3) == np.round(price_highrate_usd, 3)
+    df_full = join_index.join(df_left, df_right, keep=keep)
+    ## order_uuid.nunique() of the kept rows and of df_left from the codes of df_left, without a second factorize
+    order_codes = pd.factorize(df_left['order_uuid'])[0]
+    kept_codes = order_codes[join_index.pairs()[0][keep]]
+    kept_orders = len(np.unique(kept_codes[kept_codes >= 0]))
+    print(f'только уникальные ордера? – {len(kept_codes) == kept_orders}')
+    print(f'доля оставшихся ордеров: {round(kept_orders / max(order_codes.max(initial=-1) + 1, 1), 4)}')
     return df_full
 
 
 def prepare_my(df_recprice_prepared, df_orders_prepared, df_full,
                bound_dynamic_surge=0.0, step_surge_bin=0.5, step_orders_distance_bin=5,
                filtered_surge_bin=np.unique([1.0, 1.5, 2.0]),
-               filtered_dist_bins = np.arange(0, 25 + 1, 5)):
+               filtered_dist_bins = np.arange(0, 25 + 1, 5), join_index=None):
+    """join_index: JoinIndex(df_orders_prepared, df_recprice_prepared), the one get_full_df used"""
+    if join_index is None:
+        join_index = JoinIndex(df_orders_prepared, df_recprice_prepared, on='calcprice_uuid')
     print('lower_bound_dynamic_surge: ', bound_dynamic_surge)
     print('step_surge_bin: ', step_surge_bin)
     print('step_distance_bin: ', step_orders_distance_bin)
@@ -129,8 +271,7 @@ def prepare_my(df_recprice_prepared, df_orders_prepared, df_full,
 
     # df_recprice
     print('df_recprice...')
-    df_recprice_prepared_merged = df_recprice_prepared.merge(df_orders_prepared[['calcprice_uuid', 'distance_in_km']],
-                                                             on=['calcprice_uuid'], how='left')
+    df_recprice_prepared_merged = join_index.join(df_recprice_prepared, df_orders_prepared, ['distance_in_km'], reverse=True)
     df_recprice_prepared_merged = df_recprice_prepared_merged[df_recprice_prepared_merged['original_dynamic_surge_updated'] > bound_dynamic_surge]
     df_recprice_prepared_merged['surge_bin'] = (df_recprice_prepared_merged['original_dynamic_surge_updated'] // step_surge_bin) * step_surge_bin
     df_recprice_prepared_merged['orders_distance_bin'] = (df_recprice_prepared_merged['distance_in_km'] // step_orders_distance_bin) * step_orders_distance_bin
@@ -139,8 +280,7 @@ def prepare_my(df_recprice_prepared, df_orders_prepared, df_full,
 
     # df_orders
     print('df_orders...')
-    df_orders_prepared_merged = df_orders_prepared.merge(df_recprice_prepared[['calcprice_uuid', 'original_dynamic_surge_updated']],
-                                                         on=['calcprice_uuid'], how='left')
+    df_orders_prepared_merged = join_index.join(df_orders_prepared, df_recprice_prepared, ['original_dynamic_surge_updated'])
     df_orders_prepared_merged = df_orders_prepared_merged[df_orders_prepared_merged['original_dynamic_surge_updated'] > bound_dynamic_surge]
     df_orders_prepared_merged['surge_bin'] = (df_orders_prepared_merged['original_dynamic_surge_updated'] // step_surge_bin) * step_surge_bin
     df_orders_prepared_merged['orders_distance_bin'] = (df_orders_prepared_merged['distance_in_km'] // step_orders_distance_bin) * step_orders_distance_bin
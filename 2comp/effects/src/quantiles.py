@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+
+def cumulative_percentiles(cumulative, bin_starts, frequencies, q):
+    """
+    Percentiles q of entities x bins matrices of cumulative frequencies, bin starts and frequencies.
+    The total of an entity is its last cumulative value, so q = 1 always finds the bin that completes it
+    """
+    n_entities, n_bins = cumulative.shape
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if not n_bins:
+        return np.full((n_entities, len(q)), np.nan)
+    totals = cumulative[:, -1]
+    targets = q[None, :] * totals[:, None]
+
+    ## one searchsorted over (entity, cumulative) pairs finds the first bin >= target of every entity
+    key = np.dtype([('entity', 'int64'), ('value', 'float64')])
+    bins = np.empty(cumulative.shape, dtype=key)
+    bins['entity'], bins['value'] = np.arange(n_entities)[:, None], cumulative
+    queries = np.empty(targets.shape, dtype=key)
+    queries['entity'], queries['value'] = np.arange(n_entities)[:, None], targets
+    position = np.searchsorted(bins.ravel(), queries.ravel(), side='left').reshape(targets.shape)
+    position -= np.arange(n_entities)[:, None] * n_bins
+    found = (position < n_bins) & (totals[:, None] > 0)
+
+    rows = np.arange(n_entities)[:, None]
+    position = np.minimum(position, n_bins - 1)
+    previous = np.maximum(position - 1, 0)
+    first = position == 0
+    previous_cumulative = np.where(first, 0, cumulative[rows, previous])
+    previous_start = np.where(first, 0, bin_starts[rows, previous])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = (targets - previous_cumulative) / frequencies[rows, position]
+        values = previous_start + share * (bin_starts[rows, position] - previous_start)
+    return np.where(found, values, np.nan)
+
+
+def entity_percentiles(codes, bin_starts, frequencies, q, n_entities=None):
+    """
+    binned_percentile of choose cities.ipynb for many histograms and percentiles at once.
+    codes: entity of every bin, the bins of an entity contiguous and in their order;
+    q: percentiles in [0, 1]. Returns n_entities x len(q).
+    The value is interpolated between the previous bin start (0 for the first bin) and the start of the first bin
+    with cumulative frequency >= q x total. NaN frequencies count as 0, an entity without frequency
+    or a q above its total gives NaN
+    """
+    codes = np.asarray(codes, dtype='int64')
+    bin_starts = np.asarray(bin_starts, dtype=float)
+    frequencies = np.nan_to_num(np.asarray(frequencies, dtype=float))
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if n_entities is None:
+        n_entities = codes.max() + 1 if len(codes) else 0
+    if not len(codes):
+        return np.full((n_entities, len(q)), np.nan)
+    ## ragged histograms are padded to entities x longest histogram with zero frequencies after the last bin,
+    ## so that the cumulative sum runs within every entity and the padding never is the first bin >= target
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    lengths = np.diff(np.r_[starts, len(codes)])
+    columns = np.arange(len(codes)) - np.repeat(starts, lengths)
+    padded_frequencies = np.zeros((n_entities, lengths.max()))
+    padded_frequencies[codes, columns] = frequencies
+    padded_starts = np.zeros(padded_frequencies.shape)
+    padded_starts[codes, columns] = bin_starts
+    return cumulative_percentiles(np.cumsum(padded_frequencies, axis=1), padded_starts, padded_frequencies, q)
+
+
+def binned_percentiles(frequencies, bin_starts, q):
+    """
+    Percentiles q of a stacked entities x bins frequency matrix, bin_starts shared (bins) or per entity
+    (entities x bins). A zero-frequency column is still a bin: it is the previous bin of the next one
+    """
+    frequencies = np.nan_to_num(np.asarray(frequencies, dtype=float))
+    bin_starts = np.broadcast_to(np.asarray(bin_starts, dtype=float), frequencies.shape)
+    return cumulative_percentiles(np.cumsum(frequencies, axis=1), bin_starts, frequencies, q)
+
+
+def binned_percentile_frame(df, q, by=['city_id', 'order_type'], bin_start='bin_start', frequency='frequency'):
+    """
+    Percentiles q of the histogram of every by group of a long frame (one row per group and bin,
+    the bins of a group in their order as binned_percentile expects). One row per group, a column per q
+    """
+    codes, keys = pd.MultiIndex.from_frame(df[by]).factorize()
+    ## stable: the bins of a group keep their order
+    order = np.argsort(codes, kind='stable')
+    values = entity_percentiles(codes[order], df[bin_start].to_numpy(dtype=float)[order],
+                                df[frequency].to_numpy(dtype=float)[order], q, len(keys))
+    df_res = keys.to_frame(index=False, name=by)
+    for i, value in enumerate(np.atleast_1d(q)):
+        df_res[value] = values[:, i]
+    return df_res
+
+
+def binned_percentile(df, x, bin_start='bin_start', frequency='frequency'):
+    """The x percentile of one histogram frame, as binned_percentile of the notebooks"""
+    return entity_percentiles(np.zeros(len(df), dtype='int64'), df[bin_start], df[frequency], [x], 1)[0, 0]
+
+
+def filter_distance_bins(df, dist_bin_min=300, dist_bin_max_perc=0.99, by=['city_id', 'order_type'],
+                         bin_start='bin_start', frequency='frequency'):
+    """
+    Mask of the rows of draw in choose cities.ipynb: dist_bin_min <= bin_start <= the dist_bin_max_perc
+    binned percentile of the row's group, for all groups at once
+    """
+    df_perc = binned_percentile_frame(df, [dist_bin_max_perc], by, bin_start, frequency)
+    max_bin = df[by].merge(df_perc, on=by, how='left')[dist_bin_max_perc].to_numpy()
+    starts = df[bin_start].to_numpy(dtype=float)
+    return pd.Series((starts <= max_bin) & (starts >= dist_bin_min), index=df.index)
@@ -0,0 +1,140 @@
+import argparse
+import functools
+import multiprocessing
+import pathlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import pandas as pd
+
+
+GROUP_COLS = ['group_name', 'switch_start_dttm', 'switch_finish_dttm']
+
+
+def parse_exp_ids(values):
+    """'2081', '2102-2104' or '2081,2102' -> sorted unique list of ints"""
+    exp_ids = set()
+    for value in values:
+        for part in str(value).split(','):
+            if '-' in part:
+                start, stop = part.split('-')
+                exp_ids.update(range(int(start), int(stop) + 1))
+            elif part:
+                exp_ids.add(int(part))
+    return sorted(exp_ids)
+
+
+def run_experiment(exp_id, user_name, days_before=0, alpha=0.05, refresh=False):
+    """
+    download -> prepare -> metrics -> tests for one switchback, as in total.py.
+    The BigQuery temp tables are namespaced by exp_id, so experiments can run side by side
+    """
+    from .download import download_experiment_data, download_recprice_data, download_order_data
+    from .prepare import prepare_recprice_data, prepare_order_data, get_full_df
+    from .metrics import calculate_metrics, get_switchback_results
+
+    user_name = f'{user_name}_{exp_id}'
+    df_exp = download_experiment_data(exp_id=exp_id, user_name=user_name, refresh=refresh)
+    params = dict(
+        start_date=(df_exp.utc_start_dttm.dt.date - timedelta(days=days_before)).astype('str').iloc[0],
+        stop_date=df_exp.utc_finish_dttm.dt.date.astype('str').iloc[0],
+        city_id=df_exp.city_id.iloc[0],
+        order_type=df_exp.order_type.iloc[0],
+        user_name=user_name,
+        exp_id=exp_id,
+        refresh=refresh,
+    )
+    df_recprice_prepared = prepare_recprice_data(download_recprice_data(**params))
+    df_orders_prepared = prepare_order_data(download_order_data(**params))
+    df_full = get_full_df(df_orders_prepared, df_recprice_prepared)
+    df_full['group_name'] = df_full['recprice_group_name']
+
+    df_metrics = calculate_metrics(df_recprice_prepared, df_orders_prepared, df_full, group_cols=GROUP_COLS)
+    df_res = get_switchback_results(df_metrics, alpha=alpha)
+    df_res.insert(0, 'exp_id', exp_id)
+    df_res.insert(1, 'exp_name', df_exp.exp_name.iloc[0])
+    df_res.insert(2, 'city_id', params['city_id'])
+    df_res.insert(3, 'order_type', params['order_type'])
+    return df_res
+
+
+def run_in_pool(func, jobs, workers=4, name=str, **kwargs):
+    """
+    func(*args, **kwargs) for every args tuple of jobs in a process pool of at most `workers` processes,
+    or one by one in this process for workers <= 1. Returns the results in the order they finish;
+    a failed job is reported with its traceback and skipped. name(args) labels the progress
+    """
+    results = []
+    for args, get_result in iter_outcomes(func, list(jobs), workers, **kwargs):
+        try:
+            results.append(get_result())
+            print(f'{name(args)}: done')
+        except Exception:
+            print(f'{name(args)}: failed\n{traceback.format_exc()}')
+    return results
+
+
+def iter_outcomes(func, jobs, workers, **kwargs):
+    """(args, call returning the result or raising) of every job, in the order the jobs finish"""
+    if workers <= 1:
+        for args in jobs:
+            yield args, functools.partial(func, *args, **kwargs)
+        return
+    # spawn: every worker opens its own BigQuery client instead of sharing the parent's one
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)) or 1, mp_context=context) as executor:
+        futures = {executor.submit(func, *args, **kwargs): args for args in jobs}
+        for future in as_completed(futures):
+            yield futures[future], future.result
+
+
+def run_experiments(exp_ids, user_name, workers=4, output=None, **kwargs):
+    """
+    Runs the experiments in a process pool of at most `workers` processes and returns
+    one table with the results of all of them, by exp_id with the metrics of each in their own order,
+    as one by one. A failed experiment is reported and skipped
+    """
+    results = run_in_pool(run_experiment, [(exp_id, user_name) for exp_id in exp_ids], workers,
+                          name=lambda args: f'exp_id={args[0]}', **kwargs)
+    df_results = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    if len(df_results):
+        df_results = df_results.sort_values('exp_id', kind='stable', ignore_index=True)
+    if output is not None:
+        save_results(df_results, output)
+    return df_results
+
+
+def save_results(df, path):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix in ('.pqt', '.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Switchback results for several experiments')
+    parser.add_argument('exp_ids', nargs='+', help='experiment ids: 2081 2102-2104')
+    parser.add_argument('--user-name', required=True)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--days-before', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--refresh', action='store_true')
+    parser.add_argument('--output', default='data/results.csv', help='.csv or .pqt')
+    args = parser.parse_args(argv)
+
+    run_experiments(
+        parse_exp_ids(args.exp_ids),
+        args.user_name,
+        workers=args.workers,
+        output=args.output,
+        days_before=args.days_before,
+        alpha=args.alpha,
+        refresh=args.refresh,
+    )
+
+
+if __name__ == '__main__':
+    main()
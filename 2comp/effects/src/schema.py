@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# column -> compact dtype: 'uuid' is 128-bit binary, 'h3' is the uint64 cell id,
+# other values are pandas dtypes. Prices stay float64: get_full_df matches them to 3 decimals
+ORDER_SCHEMA = {
+    'city_id': 'int32',
+    'order_type': 'category',
+    'order_uuid': 'uuid',
+    'calcprice_uuid': 'uuid',
+    'duration_in_min': 'float32',
+    'distance_in_km': 'float32',
+    'distance': 'float32',
+    'tenders_count': 'Int16',
+    'hex_from': 'h3',
+    'order_group_name': 'category',
+}
+
+RECPRICE_SCHEMA = {
+    'city_id': 'int32',
+    'order_type': 'category',
+    'calcprice_uuid': 'uuid',
+    'user_id': 'int64',
+    'log_distance_in_km': 'float32',
+    'log_duration_in_min': 'float32',
+    'hex_from': 'h3',
+    'recprice_group_name': 'category',
+}
+
+# ascii code -> hex digit value
+HEX_LOOKUP = np.zeros(256, dtype=np.uint8)
+HEX_LOOKUP[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+HEX_LOOKUP[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+HEX_LOOKUP[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+
+def hex_to_nibbles(values, width):
+    """Hex strings (nulls as '') as a (n, width) matrix of digit values, shorter strings left-padded with 0"""
+    padded = values.str.zfill(width).to_numpy(dtype=f'S{width}')
+    return HEX_LOOKUP[np.frombuffer(padded.tobytes(), dtype=np.uint8).reshape(-1, width)]
+
+
+def uuid_to_binary(values):
+    """36-character uuid strings as fixed-size 16-byte Arrow binary, nulls kept"""
+    values = pd.Series(values)
+    valid = values.notnull().to_numpy()
+    nibbles = hex_to_nibbles(values.fillna('').astype(str).str.replace('-', '', regex=False), 32)
+    packed = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    arr = pa.FixedSizeBinaryArray.from_buffers(pa.binary(16), len(values), [None, pa.py_buffer(packed.tobytes())])
+    arr = pc.if_else(pa.array(valid), arr, pa.scalar(None, pa.binary(16)))
+    return pd.Series(pd.arrays.ArrowExtensionArray(arr), index=values.index, name=values.name)
+
+
+def h3_to_int(values):
+    """H3 cell strings as uint64 cell ids, nulls as 0 (the H3 null index)"""
+    values = pd.Series(values)
+    nibbles = hex_to_nibbles(values.fillna('').astype(str), 16).astype(np.uint64)
+    shifts = np.arange(60, -1, -4, dtype=np.uint64)
+    cells = np.bitwise_or.reduce(nibbles << shifts, axis=1)
+    return pd.Series(cells, index=values.index, name=values.name)
+
+
+def apply_schema(df, schema):
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'uuid':
+            df[col] = uuid_to_binary(df[col])
+        elif dtype == 'h3':
+            df[col] = h3_to_int(df[col])
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def read_parquet(path):
+    """pd.read_parquet of frames with apply_schema dtypes: pandas can not rebuild the uuid binary dtype from the file"""
+    return pq.read_table(path).to_pandas(
+        types_mapper=lambda dtype: pd.ArrowDtype(dtype) if pa.types.is_fixed_size_binary(dtype) else None
+    )
@@ -0,0 +1,161 @@
+import numpy as np
+from scipy.optimize import brentq
+from scipy.stats import norm
+
+from .pipeline import linearize_moments
+
+
+def obrien_fleming_spending(t, alpha=0.05):
+    """Lan-DeMets alpha spending of the O'Brien-Fleming type, two-sided: 4 - 4 * Phi(z_(1 - alpha/4) / sqrt(t))"""
+    t = np.minimum(np.asarray(t, dtype=float), 1)
+    with np.errstate(divide='ignore'):
+        return np.where(t > 0, 4 * norm.sf(norm.isf(alpha / 4) / np.sqrt(t)), 0.0)
+
+
+def pocock_spending(t, alpha=0.05):
+    t = np.asarray(t, dtype=float)
+    return alpha * np.log(1 + (np.e - 1) * np.minimum(t, 1))
+
+
+def group_sequential_bounds(fractions, alpha=0.05, spending=obrien_fleming_spending, n_grid=801):
+    """Two-sided z boundaries for looks at the information fractions, spending alpha as `spending` does"""
+    bounds, state = [], None
+    for t in fractions:
+        bound, state = next_bound(t, state, alpha, spending, n_grid)
+        bounds.append(bound)
+    return np.array(bounds)
+
+
+def next_bound(t, state=None, alpha=0.05, spending=obrien_fleming_spending, n_grid=801):
+    """
+    Boundary of the look at information fraction t and the state for the next look.
+    state: (grid, mass, t, spent) - the density of the score that has not crossed yet, carried
+    from look to look on a grid (Armitage-McPherson-Rowe recursion), None before the first look
+    """
+    grid, mass, t_prev, spent = (np.zeros(1), np.ones(1), 0.0, 0.0) if state is None else state
+    t = min(float(t), 1.0)
+    if t <= t_prev:
+        return np.inf, (grid, mass, t_prev, spent)
+    sd = np.sqrt(t - t_prev)
+    target = float(spending(t, alpha)) - spent
+
+    def crossing(c):
+        return (mass * (norm.cdf((-c - grid) / sd) + norm.sf((c - grid) / sd))).sum()
+
+    c_max = 50 * np.sqrt(t)
+    if target <= 0 or crossing(c_max) >= target:
+        return np.inf, (grid, mass, t_prev, spent)
+    c = brentq(lambda c: crossing(c) - target, 1e-10, c_max)
+    new_grid = np.linspace(-c, c, n_grid)
+    weights = np.full(n_grid, new_grid[1] - new_grid[0])
+    weights[[0, -1]] /= 2
+    density = (mass[None, :] * norm.pdf((new_grid[:, None] - grid[None, :]) / sd) / sd).sum(axis=1)
+    return c / np.sqrt(t), (new_grid, density * weights, t, spent + crossing(c))
+
+
+def msprt_pvalue(estimate, variance, tau2):
+    """
+    Always-valid p-value of one look of the mixture SPRT with a normal N(0, tau2) mixture
+    over the effect: 1 / likelihood ratio, capped at 1
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_lr = 0.5 * np.log(variance / (variance + tau2)) + estimate ** 2 * tau2 / (2 * variance * (variance + tau2))
+        return np.minimum(1.0, np.exp(-log_lr))
+
+
+class SequentialTest:
+    """
+    Repeated looks at a running switchback from the moments of the intervals
+    (OnlineMetrics.cell_moments or linearize_moments input), without the false positives
+    of re-running the fixed-horizon t-test every day.
+    method='msprt': always-valid p-values of the mixture SPRT, any number of looks.
+    The mixture sd is tau_rel of the control metric value, i.e. the relative uplift we expect.
+    method='group_sequential': boundaries with O'Brien-Fleming (or another) alpha spending.
+    n_planned is the planned n1 + n2 of a cell, the observations of both groups together:
+    intervals_cnt of a switchback, twice it when both groups run in every interval (hex experiments).
+    The information fraction of a look is the largest n1 + n2 of the cells over n_planned.
+    A metric stops at the first look that rejects and stays stopped
+    """
+
+    def __init__(self, metrics, method='msprt', alpha=0.05, tau_rel=0.05, n_planned=None,
+                 spending=obrien_fleming_spending):
+        if method not in ('msprt', 'group_sequential'):
+            raise ValueError(f'unknown method {method}')
+        if method == 'group_sequential' and n_planned is None:
+            raise ValueError("method='group_sequential' needs n_planned")
+        self.metrics = list(metrics)
+        self.method = method
+        self.alpha = alpha
+        self.tau_rel = tau_rel
+        self.n_planned = n_planned
+        self.spending = spending
+        self.fractions = []
+        self.bound_state = None
+        self.pvalue = None
+        self.stopped = None
+        self.stopped_look = None
+
+    def extend_state(self, shape):
+        """New cells (rows appended to the moments) start with a fresh state"""
+        if self.stopped is None:
+            self.pvalue = np.ones(shape)
+            self.stopped = np.zeros(shape, dtype=bool)
+            self.stopped_look = np.full(shape, -1)
+        elif self.stopped.shape != shape:
+            pad = [(0, new - old) for new, old in zip(shape, self.stopped.shape)]
+            self.pvalue = np.pad(self.pvalue, pad, constant_values=1.0)
+            self.stopped = np.pad(self.stopped, pad, constant_values=False)
+            self.stopped_look = np.pad(self.stopped_look, pad, constant_values=-1)
+
+    def look(self, moments_control, moments_treatment):
+        """One look at the current moments (... x metrics x 6), returns the state of every metric"""
+        lin = linearize_moments(moments_control, moments_treatment)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimate = lin['u2'] - lin['u1']
+            variance = lin['s1'] / lin['n1'] + lin['s2'] / lin['n2']
+            z = estimate / np.sqrt(variance)
+        valid = ~lin['skip'] & np.isfinite(z)
+        self.extend_state(estimate.shape)
+        look = len(self.fractions)
+        result = {'metric': np.broadcast_to(self.metrics, estimate.shape), 'look': look}
+
+        if self.method == 'msprt':
+            ## the prior sd of the effect on the linearized scale: tau_rel * k * mean control denominator
+            tau2 = (self.tau_rel * lin['control_value'] * lin['y1_mean']) ** 2
+            pvalue = np.where(valid, msprt_pvalue(estimate, variance, tau2), 1.0)
+            self.pvalue = np.minimum(self.pvalue, pvalue)
+            reject = self.pvalue < self.alpha
+            self.fractions.append(np.nan)
+            result['always_valid_pvalue'] = self.pvalue.copy()
+        else:
+            ## observations of both groups so far: the cell with the most of them
+            fraction = float(np.nanmax(lin['n1'] + lin['n2'])) / self.n_planned
+            self.fractions.append(fraction)
+            bound, self.bound_state = next_bound(fraction, self.bound_state, self.alpha, self.spending)
+            reject = valid & (np.abs(z) >= bound)
+            result['information_fraction'] = min(fraction, 1.0)
+            result['bound'] = bound
+
+        new = reject & ~self.stopped
+        self.stopped_look[new] = look
+        self.stopped |= reject
+        result.update({
+            'control_value': lin['control_value'],
+            'experimental_value': lin['experimental_value'],
+            'uplift_rel': lin['experimental_value'] / lin['control_value'] - 1,
+            'z': z,
+            'is_stopped': self.stopped.copy(),
+            'stopped_look': self.stopped_look.copy(),
+        })
+        return result
+
+
+def look_online(test, online, groups={"control": "Control", "treatment": "A"}):
+    """SequentialTest.look on an OnlineMetrics, one row per cell and metric"""
+    cells, control, treatment = online.cell_moments(groups)
+    result = test.look(control, treatment)
+    n_metrics = len(online.metric_list)
+    df_res = cells.loc[cells.index.repeat(n_metrics)].reset_index(drop=True)
+    for key, values in result.items():
+        df_res[key] = np.broadcast_to(values, (len(cells), n_metrics)).reshape(-1)
+    return df_res
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+
+def two_component_highrate(base_price, surge, alpha, axis_price, minprice=None):
+    """
+    Two-component surge from confluence.md:
+    Highrate = base_price * (α*surge + β) + β*axis_price*(surge-1), β = 1 - α.
+    α=1 is the current multiplicative surge, a trip with base_price = axis_price costs the same for any α.
+    Broadcasts, so a grid of α and axis_price of shape (configs, 1) gives configs x trips prices.
+    The price is not below minprice where it is known
+    """
+    beta = 1 - alpha
+    highrate = base_price * (alpha * surge + beta) + beta * axis_price * (surge - 1)
+    if minprice is not None:
+        highrate = np.fmax(highrate, minprice)
+    return highrate
+
+
+def get_distance_bins(distance, step_distance_bin=1, max_distance_bin=25):
+    """distance // step_distance_bin * step_distance_bin, clipped at max_distance_bin"""
+    return np.minimum((np.asarray(distance, dtype=float) // step_distance_bin) * step_distance_bin, max_distance_bin)
+
+
+def iter_highrate_chunks(base_price, surge, minprice, alpha, axis_price, max_cells=20_000_000):
+    """
+    two_component_highrate of every config (alpha and axis_price of shape (configs, 1)) for consecutive
+    chunks of the trips, at most max_cells prices at a time: yields the rows slice and configs x rows prices
+    """
+    chunk_size = max(1, max_cells // max(len(alpha), 1))
+    for start in range(0, len(base_price), chunk_size):
+        rows = slice(start, start + chunk_size)
+        yield rows, two_component_highrate(base_price[rows], surge[rows], alpha, axis_price, minprice[rows])
+
+
+def get_config_grid(alphas, axis_prices):
+    """All (α, axis_price) pairs, β = 1 - α"""
+    alpha, axis_price = np.meshgrid(np.asarray(alphas, dtype=float), np.asarray(axis_prices, dtype=float), indexing='ij')
+    return pd.DataFrame({'alpha': alpha.ravel(), 'beta': 1 - alpha.ravel(), 'axis_price': axis_price.ravel()})
+
+
+def histogram_quantiles(counts, edges, q):
+    """Quantiles q of histograms counts[..., bins] with shared edges, linear inside a bin"""
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1:]
+    result = []
+    for value in q:
+        target = value * total
+        idx = np.minimum((cumulative < target).sum(axis=-1, keepdims=True), counts.shape[-1] - 1)
+        before = np.take_along_axis(cumulative, idx, axis=-1) - np.take_along_axis(counts, idx, axis=-1)
+        inside = np.take_along_axis(counts, idx, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.clip(np.where(inside > 0, (target - before) / inside, 0), 0, 1)
+        quantile = edges[idx] + share * (edges[idx + 1] - edges[idx])
+        result.append(np.where(total > 0, quantile, np.nan)[..., 0])
+    return result
+
+
+def simulate_recprice(df_recprice, alphas, axis_prices, step_distance_bin=1, max_distance_bin=25,
+                      price_edges=None, quantiles=[0.1, 0.5, 0.9], max_cells=20_000_000,
+                      surge_column='original_dynamic_surge_updated', distance_column='log_distance_in_km'):
+    """
+    Re-prices the historical calcprices with the two-component surge for every (α, axis_price)
+    of the grid: configs x trips prices in chunks of at most max_cells values, summed per distance bin
+    (distance_column // step_distance_bin * step_distance_bin, clipped at max_distance_bin).
+    One row per config and distance bin: calcprices_count, the mean recprice of the config and of α=1
+    (the current surge, minprice included), their ratio - 1, the share of cheaper and dearer calcprices.
+    price_edges: histogram edges of the recprice per config and bin, adds the recprice quantiles
+    """
+    df = df_recprice[['price_base_usd', surge_column, 'minprice_usd', distance_column]].dropna(
+        subset=['price_base_usd', surge_column, distance_column])
+    distance_bins = get_distance_bins(df[distance_column], step_distance_bin, max_distance_bin)
+    bin_values, bin_codes = np.unique(distance_bins, return_inverse=True)
+    n_bins = len(bin_values)
+    ## rows sorted by distance bin: per-bin sums are reduceat over contiguous segments
+    order = np.argsort(bin_codes, kind='stable')
+    bin_codes = bin_codes[order]
+    base_price = df['price_base_usd'].to_numpy(dtype=float)[order]
+    surge = df[surge_column].to_numpy(dtype=float)[order]
+    minprice = df['minprice_usd'].to_numpy(dtype=float)[order]
+    # the grid's α=1 rows go through the same arithmetic, so they compare equal to the current prices
+    current = two_component_highrate(base_price, surge, 1.0, 0.0, minprice)
+
+    df_grid = get_config_grid(alphas, axis_prices)
+    alpha = df_grid['alpha'].to_numpy()[:, None]
+    axis_price = df_grid['axis_price'].to_numpy()[:, None]
+    n_configs = len(df_grid)
+
+    price_sum = np.zeros((n_configs, n_bins))
+    lower = np.zeros((n_configs, n_bins), dtype='int64')
+    higher = np.zeros((n_configs, n_bins), dtype='int64')
+    if price_edges is not None:
+        price_edges = np.asarray(price_edges, dtype=float)
+        n_hist = len(price_edges) - 1
+        width = np.diff(price_edges)
+        uniform = np.allclose(width, width[0])
+        hist = np.zeros(n_configs * n_bins * n_hist, dtype='int64')
+    for rows, prices in iter_highrate_chunks(base_price, surge, minprice, alpha, axis_price, max_cells):
+        codes = bin_codes[rows]
+        segments = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        bins = codes[segments]
+        price_sum[:, bins] += np.add.reduceat(prices, segments, axis=1)
+        lower[:, bins] += np.add.reduceat((prices < current[rows]).view(np.int8), segments, axis=1, dtype='int64')
+        higher[:, bins] += np.add.reduceat((prices > current[rows]).view(np.int8), segments, axis=1, dtype='int64')
+        if price_edges is not None:
+            # prices out of the edges go to the first and last bins
+            if uniform:
+                price_bins = ((prices - price_edges[0]) / width[0]).clip(0, n_hist - 1).astype('int64')
+            else:
+                price_bins = np.clip(np.searchsorted(price_edges, prices, side='right') - 1, 0, n_hist - 1)
+            price_bins += (np.arange(n_configs)[:, None] * n_bins + codes) * n_hist
+            hist += np.bincount(price_bins.ravel(), minlength=len(hist))
+
+    count = np.bincount(bin_codes, minlength=n_bins).astype(float)
+    current_sum = np.bincount(bin_codes, weights=current, minlength=n_bins)
+    df_res = df_grid.loc[df_grid.index.repeat(n_bins)].reset_index(drop=True)
+    df_res['distance_bin'] = np.tile(bin_values, n_configs)
+    df_res['calcprices_count'] = np.tile(count, n_configs).astype('int64')
+    df_res['recprice_usd'] = (price_sum / count).ravel()
+    df_res['current_recprice_usd'] = np.tile(current_sum / count, n_configs)
+    df_res['recprice_uplift_rel'] = df_res['recprice_usd'] / df_res['current_recprice_usd'] - 1
+    df_res['lower_share'] = (lower / count).ravel()
+    df_res['higher_share'] = (higher / count).ravel()
+    if price_edges is not None:
+        counts = hist.reshape(n_configs * n_bins, n_hist)
+        for value, quantile in zip(quantiles, histogram_quantiles(counts, price_edges, quantiles)):
+            df_res[f'recprice_usd_q{round(value * 100)}'] = quantile
+    return df_res
@@ -9,7 +9,8 @@ from datetime import timedelta
 
 from src.download import download_experiment_data, download_recprice_data, download_order_data
 from src.prepare import prepare_recprice_data, prepare_order_data, get_full_df
-from src.metrics import calculate_metrics, get_switchback_results, get_metrics
+from src.join import JoinIndex
+from src.metrics import calculate_metrics, get_switchback_results, get_switchback_cell_results, get_metrics
 from src.draw import draw_heatmap, draw_lines
 
 # Parameters
@@ -51,6 +52,7 @@ df_recprice = download_recprice_data(
     city_id=CITY_ID,
     order_type=ORDER_TYPE,
     user_name=USER_NAME,
+    exp_id=EXP_ID,
 )
 
 ## Order Data
@@ -60,12 +62,14 @@ df_orders = download_order_data(
     city_id=CITY_ID,
     order_type=ORDER_TYPE,
     user_name=USER_NAME,
+    exp_id=EXP_ID,
 )
 
 # Prepare Data
 df_recprice_prepared = prepare_recprice_data(df_recprice)
 df_orders_prepared = prepare_order_data(df_orders)
-df_full = get_full_df(df_recprice_prepared, df_orders_prepared)
+join_index = JoinIndex(df_orders_prepared, df_recprice_prepared, on='calcprice_uuid')
+df_full = get_full_df(df_orders_prepared, df_recprice_prepared, join_index)
 df_full['group_name'] = df_full['recprice_group_name']
 
 bound_dynamic_surge = 1.0
@@ -83,8 +87,7 @@ df_full['surge_bin'] = df_full['surge_bin'].clip(upper=max(filtered_surge_bin))
 df_full['orders_distance_bin'] = df_full['orders_distance_bin'].clip(upper=max(filtered_dist_bins))
 
 # df_recprice
-df_recprice_prepared_merged = df_recprice_prepared.merge(df_orders_prepared[['calcprice_uuid', 'distance_in_km']],
-                                                         on=['calcprice_uuid'], how='left')
+df_recprice_prepared_merged = join_index.join(df_recprice_prepared, df_orders_prepared, ['distance_in_km'], reverse=True)
 df_recprice_prepared_merged = df_recprice_prepared_merged[
     df_recprice_prepared_merged['original_dynamic_surge_updated'] > bound_dynamic_surge]
 df_recprice_prepared_merged['surge_bin'] = (df_recprice_prepared_merged[
@@ -96,9 +99,7 @@ df_recprice_prepared_merged['orders_distance_bin'] = df_recprice_prepared_merged
     upper=max(filtered_dist_bins))
 
 # df_orders
-df_orders_prepared_merged = df_orders_prepared.merge(
-    df_recprice_prepared[['calcprice_uuid', 'original_dynamic_surge_updated']],
-    on=['calcprice_uuid'], how='left')
+df_orders_prepared_merged = join_index.join(df_orders_prepared, df_recprice_prepared, ['original_dynamic_surge_updated'])
 df_orders_prepared_merged = df_orders_prepared_merged[
     df_orders_prepared_merged['original_dynamic_surge_updated'] > bound_dynamic_surge]
 df_orders_prepared_merged['surge_bin'] = (df_orders_prepared_merged[
@@ -121,35 +122,14 @@ metrics_total_tbl = get_switchback_results(df_metrics_total, alpha=0.05)[
     ['metric', 'control_value', 'experimental_value', 'uplift_rel', 'pvalue', 'is_significant']
 ]
 
-results = []
-for surge_bin in filtered_surge_bin:
-    for dist_bin in filtered_dist_bins:
-        df_metrics_total = calculate_metrics(
-            df_recprice_prepared_merged[(df_recprice_prepared_merged['surge_bin'] == surge_bin) &
-                                        (df_recprice_prepared_merged['orders_distance_bin'] == dist_bin)],
-            df_orders_prepared_merged[(df_orders_prepared_merged['surge_bin'] == surge_bin) &
-                                      (df_orders_prepared_merged['orders_distance_bin'] == dist_bin)],
-            df_full[(df_full['surge_bin'] == surge_bin) &
-                    (df_full['orders_distance_bin'] == dist_bin)],
-            group_cols=['group_name', 'switch_start_dttm', 'switch_finish_dttm'],
-        )
-
-        print(surge_bin, dist_bin)
-        metrics_total_tbl = get_switchback_results(df_metrics_total, alpha=0.05)
-
-        single_row = {}
-        for _, row in metrics_total_tbl.iterrows():
-            metric_name = row['metric']
-            for stat_name in metrics_total_tbl.columns:
-                single_row[f"{metric_name}.{stat_name}"] = row[stat_name]
-        df_single_row = pd.DataFrame([single_row])
-
-        metrics_row = {'surge_bin': surge_bin, 'orders_distance_bin': dist_bin}
-        metrics_row.update(df_single_row.iloc[0].to_dict())  # Assuming one row in df_metrics_total
-
-        results.append(metrics_row)
-
-df_results = pd.DataFrame(results)
+df_results = get_switchback_cell_results(
+    df_recprice_prepared_merged,
+    df_orders_prepared_merged,
+    df_full,
+    alpha=0.05,
+    surge_bins=filtered_surge_bin,
+    dist_bins=filtered_dist_bins,
+)
 df_results
 
 draw_heatmap(df_results, ['balance', 'cp2order'], ['uplift_abs', 'uplift_rel'], 0.5)
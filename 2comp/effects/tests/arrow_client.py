@@ -0,0 +1,26 @@
+class LocalArrowClient:
+    """Stand-in for bigquery.Client serving pyarrow tables: get_table(query) -> pyarrow.Table"""
+
+    def __init__(self, get_table, batch_size=65536):
+        self.get_table = get_table
+        self.batch_size = batch_size
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        return LocalArrowJob(self.get_table(query), self.batch_size)
+
+
+class LocalArrowJob:
+    def __init__(self, table, batch_size):
+        self.table = table
+        self.batch_size = batch_size
+
+    def result(self):
+        return self
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.table.to_batches(max_chunksize=self.batch_size))
+
+    def to_dataframe(self):
+        return self.table.to_pandas()
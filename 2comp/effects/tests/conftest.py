@@ -0,0 +1,107 @@
+import contextlib
+import io
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+
+from src import pipeline
+from src.prepare import get_full_df, prepare_order_data, prepare_recprice_data
+
+GROUP_COLS = ['group_name', 'switch_start_dttm', 'switch_finish_dttm']
+
+
+def make_logs(n_rec=20000, n_int=40, seed=0, before=True):
+    """
+    Synthetic recprice and order logs of a switchback with hourly intervals, as the download queries return them.
+    before: 3 hours of 'Before' calcprices without a switch window
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2024-05-01', tz='UTC')
+    switches = start + pd.to_timedelta(np.arange(n_int) * 60, unit='min')
+    rec = pd.DataFrame({
+        'city_id': 1, 'order_type': 'ride',
+        'calcprice_uuid': [str(uuid.UUID(int=int(i))) for i in rng.integers(0, 2 ** 62, n_rec)],
+        'user_id': rng.integers(0, 1000, n_rec),
+    })
+    interval = rng.integers(-3 if before else 0, n_int, n_rec)
+    rec['utc_recprice_dttm'] = start + pd.to_timedelta(interval * 60 + rng.uniform(0, 60, n_rec), unit='min')
+    rec['local_recprice_dttm'] = (rec['utc_recprice_dttm'] - pd.Timedelta(hours=5)).dt.tz_localize(None)
+    rec['switch_start_dttm'] = pd.Series(switches[np.clip(interval, 0, None)]).where(interval >= 0)
+    rec['switch_finish_dttm'] = rec['switch_start_dttm'] + pd.Timedelta(minutes=60)
+    group = np.where(rng.random(n_rec) < .5, 'A', 'Control')
+    rec['recprice_group_name'] = np.where(interval >= 0, group, 'Before')
+    rec['price_base_usd'] = rng.gamma(3, 1.5, n_rec)
+    rec['surge'] = np.round(1 + rng.exponential(.3, n_rec) * (rng.random(n_rec) < .5), 2)
+    rec['dynamic_surge'] = rec['surge']
+    rec['original_dynamic_surge_updated'] = rec['surge']
+    rec['recprice_usd'] = np.round(rec['price_base_usd'] * rec['surge'], 3)
+    rec['recprice'] = rec['recprice_usd'] * 4000
+    rec['minprice_usd'] = 1.5
+    rec.loc[rng.random(n_rec) < .01, 'minprice_usd'] = np.nan
+    rec['fromlatitude'] = 4.6 + rng.normal(0, .05, n_rec)
+    rec['fromlongitude'] = -74.1 + rng.normal(0, .05, n_rec)
+    rec['log_distance_in_km'] = rng.gamma(2, 3, n_rec)
+    rec['log_duration_in_min'] = rec['log_distance_in_km'] * 2
+    rec['hex_from'] = '87' + pd.Series(rng.integers(0, 50, n_rec)).astype(str)
+
+    # orders from 30% of the calcprices
+    o = rec.sample(frac=.3, random_state=seed).reset_index(drop=True)
+    n = len(o)
+    orders = pd.DataFrame({
+        'city_id': 1, 'order_type': 'ride',
+        'order_uuid': [str(uuid.UUID(int=int(i))) for i in rng.integers(0, 2 ** 62, n)],
+        'local_order_dttm': o['local_recprice_dttm'] + pd.Timedelta(seconds=30),
+        'utc_order_dttm': o['utc_recprice_dttm'] + pd.Timedelta(seconds=30),
+        'price_highrate_usd': np.where(rng.random(n) < .9, o['recprice_usd'], o['recprice_usd'] * 1.1),
+    })
+    orders['price_start_usd'] = orders['price_highrate_usd'] * rng.choice([0.8, 1.0, 1.2], n)
+    orders.loc[rng.random(n) < .05, 'price_start_usd'] = o['minprice_usd']
+    orders['fromlatitude'], orders['fromlongitude'] = o['fromlatitude'], o['fromlongitude']
+    orders['distance_in_km'] = o['log_distance_in_km'] * rng.uniform(.9, 1.1, n)
+    orders['duration_in_min'] = orders['distance_in_km'] * 2
+    orders['tenders_count'] = rng.integers(0, 4, n)
+    orders['price_tender_usd'] = np.where(orders['tenders_count'] > 0, orders['price_start_usd'] * 1.05, np.nan)
+    orders['is_order_with_tender'] = pd.Series(orders['tenders_count'] > 0, dtype=object).where(rng.random(n) > .02)
+    orders['is_order_start_price_bid'] = pd.Series(rng.random(n) < .3, dtype=object)
+    orders['is_order_accepted_start_price_bid'] = orders['is_order_start_price_bid'] & (rng.random(n) < .5)
+    orders['is_order_done_start_price_bid'] = orders['is_order_accepted_start_price_bid'] & (rng.random(n) < .7)
+    orders['is_order_accepted'] = rng.random(n) < .6
+    orders['is_order_done'] = orders['is_order_accepted'] & (rng.random(n) < .7)
+    orders['price_done_usd'] = np.where(orders['is_order_done'], orders['price_start_usd'], np.nan)
+    orders['rides_price_highrate_usd'] = np.where(orders['is_order_done'], orders['price_highrate_usd'], np.nan)
+    orders['rides_price_start_usd'] = np.where(orders['is_order_done'], orders['price_start_usd'], np.nan)
+    orders['calcprice_uuid'] = o['calcprice_uuid']
+    orders.loc[rng.random(n) < .02, 'calcprice_uuid'] = None
+    orders['switch_start_dttm'], orders['switch_finish_dttm'] = o['switch_start_dttm'], o['switch_finish_dttm']
+    orders['hex_from'] = o['hex_from']
+    orders['order_group_name'] = o['recprice_group_name']
+    return rec, orders
+
+
+def prepare_logs(rec, orders):
+    """prepare_*_data and get_full_df as total.py runs them"""
+    df_recprice = prepare_recprice_data(rec.copy())
+    df_order = prepare_order_data(orders.copy())
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_full = get_full_df(df_order, df_recprice)
+    df_full['group_name'] = df_full['recprice_group_name']
+    return df_recprice, df_order, df_full
+
+
+@pytest.fixture(scope='session')
+def logs():
+    return make_logs()
+
+
+@pytest.fixture(scope='session')
+def prepared(logs):
+    return prepare_logs(*logs)
+
+
+@pytest.fixture
+def ttest_ind(monkeypatch):
+    # ttest_ind of recent scipy has no random_state
+    monkeypatch.setattr(pipeline, 'ttest_ind', lambda a, b, random_state=None: scipy.stats.ttest_ind(a, b))
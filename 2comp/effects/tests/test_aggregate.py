@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from src.aggregate import encode_groups, group_count, group_nunique, group_sum
+
+
+def random_frames(seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for n in [500, 300]:
+        df = pd.DataFrame({
+            'key': rng.choice(['a', 'b', 'c', None], n),
+            'hour': rng.integers(0, 5, n),
+            'value': np.where(rng.random(n) < .1, np.nan, rng.normal(size=n)),
+            'id': rng.integers(0, 50, n).astype(str),
+        })
+        frames.append(df)
+    return frames
+
+
+def test_encode_groups_shares_codes_in_groupby_order():
+    frames = random_frames()
+    group_codes = encode_groups(frames, ['key', 'hour'])
+    expected = pd.concat(frames).groupby(['key', 'hour']).size().reset_index()[['key', 'hour']]
+    pd.testing.assert_frame_equal(group_codes.keys, expected, check_dtype=False, check_column_type=False)
+    for df, codes in zip(frames, group_codes.codes):
+        assert ((codes == -1) == df['key'].isnull()).all()
+        keys = group_codes.keys.iloc[codes[codes >= 0]].reset_index(drop=True)
+        pd.testing.assert_frame_equal(keys, df[df['key'].notnull()][['key', 'hour']].reset_index(drop=True),
+                                      check_dtype=False)
+
+
+def test_group_aggregates_match_groupby():
+    df = random_frames()[0]
+    group_codes = encode_groups([df], ['key', 'hour'])
+    codes, n_groups = group_codes.codes[0], group_codes.n_groups
+    mask = (df['value'] > 0).to_numpy()
+    expected = df.groupby(['key', 'hour']).agg(count=('id', 'size'), value=('value', 'sum'), ids=('id', 'nunique'))
+    np.testing.assert_array_equal(group_count(codes, n_groups), expected['count'])
+    np.testing.assert_allclose(group_sum(codes, df['value'].to_numpy(), n_groups), expected['value'])
+    value_codes = pd.factorize(df['id'])[0]
+    np.testing.assert_array_equal(group_nunique(codes, value_codes, n_groups), expected['ids'])
+    masked = df[mask].groupby(['key', 'hour'])['id'].nunique()
+    masked = masked.reindex(pd.MultiIndex.from_frame(group_codes.keys), fill_value=0)
+    np.testing.assert_array_equal(group_nunique(codes, value_codes, n_groups, mask), masked)
@@ -0,0 +1,115 @@
+import math
+
+import h3
+import mmh3
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.assign import assign_groups, get_switch_index, lookup_windows, murmurhash3_32
+
+
+def windows(n=200, seed=0, gaps=True):
+    rng = np.random.default_rng(seed)
+    starts = np.cumsum(rng.integers(1 if gaps else 0, 100, n)) * 60
+    finishes = starts + rng.integers(30, 120, n) * 60 if gaps else np.r_[starts[1:], starts[-1] + 3600]
+    return starts.astype('int64'), finishes.astype('int64')
+
+
+def test_lookup_windows_matches_interval_index():
+    starts, finishes = windows(gaps=False)
+    keep = finishes > starts
+    starts, finishes = starts[keep], finishes[keep]
+    ts = np.random.default_rng(1).integers(starts[0] - 3600, finishes[-1] + 3600, 5000)
+    expected = pd.IntervalIndex.from_arrays(starts, finishes, closed='left').get_indexer(ts)
+    np.testing.assert_array_equal(lookup_windows(ts, starts, finishes, overlap='raise'), expected)
+
+
+def test_overlapping_windows_take_the_latest_start():
+    starts, finishes = windows()
+    order = np.random.default_rng(2).permutation(len(starts))
+    starts, finishes = starts[order], finishes[order]
+    ts = np.random.default_rng(3).integers(starts.min() - 3600, finishes.max() + 3600, 3000)
+    contains = (starts[None, :] <= ts[:, None]) & (ts[:, None] < finishes[None, :])
+    latest = np.where(contains, starts[None, :], np.iinfo('int64').min)
+    expected = np.where(contains.any(axis=1), latest.argmax(axis=1), -1)
+    got = lookup_windows(ts, starts, finishes)
+    np.testing.assert_array_equal(starts[got[got >= 0]], starts[expected[expected >= 0]])
+    np.testing.assert_array_equal(got >= 0, expected >= 0)
+    with pytest.raises(ValueError):
+        lookup_windows(ts, starts, finishes, overlap='raise')
+
+
+@pytest.mark.parametrize('ts_tz, window_tz', [(None, 'UTC'), ('UTC', None)])
+def test_tz_awareness_mismatch_raises(ts_tz, window_tz):
+    start = pd.Timestamp('2024-05-01 10:00')
+    df = pd.DataFrame({'city_id': [1], 'order_type': ['ride'], 'ts': [start.tz_localize(ts_tz)]})
+    df_exp = pd.DataFrame({'city_id': [1], 'order_type': ['ride'],
+                           'switch_start_dttm': [start.tz_localize(window_tz)],
+                           'switch_finish_dttm': [(start + pd.Timedelta(hours=1)).tz_localize(window_tz)]})
+    with pytest.raises(ValueError):
+        get_switch_index(df, df_exp, 'ts')
+    df_exp[['switch_start_dttm', 'switch_finish_dttm']] = df_exp[['switch_start_dttm', 'switch_finish_dttm']].apply(
+        lambda column: column.dt.tz_localize(None) if window_tz else column.dt.tz_localize(ts_tz))
+    assert get_switch_index(df, df_exp, 'ts').tolist() == [0]
+
+
+@pytest.mark.parametrize('seed, signed', [(0, False), (0, True), (42, True)])
+def test_murmurhash3_32_matches_mmh3(seed, signed):
+    rng = np.random.default_rng(seed)
+    alphabet = list('abcdef0123456789') + ['é', 'ж', '漢', '😀']
+    keys = [''.join(rng.choice(alphabet, n)) for n in rng.integers(0, 40, 2000)] + ['', 'a', 'abcd', 'abcde']
+    expected = [mmh3.hash(key, seed, signed=signed) for key in keys]
+    assert murmurhash3_32(keys, seed, signed).tolist() == expected
+
+
+@pytest.fixture
+def experiment():
+    start = pd.Timestamp('2024-05-01', tz='UTC')
+    n = 10
+    df_exp = pd.DataFrame({
+        'city_id': 1, 'order_type': 'ride', 'exp_salt': 'salt2081',
+        'switch_start_dttm': start + pd.to_timedelta(np.arange(n), unit='h'),
+        'switch_finish_dttm': start + pd.to_timedelta(np.arange(n) + 1, unit='h'),
+        'group_name': np.where(np.arange(n) % 2, 'A', 'Control'),
+        'is_hex': np.arange(n) % 3 > 0, 'hexagon_size': np.where(np.arange(n) % 2, 7, 8),
+    })
+    rng = np.random.default_rng(0)
+    m = 1000
+    df = pd.DataFrame({
+        'city_id': 1, 'order_type': 'ride',
+        'utc_dttm': start + pd.to_timedelta(rng.uniform(-1, n + 1, m), unit='h'),
+        'fromlatitude': 4.6 + rng.normal(0, .05, m), 'fromlongitude': -74.1 + rng.normal(0, .05, m),
+    })
+    return df, df_exp
+
+
+def assign_groups_loop(df, df_exp, signed):
+    """The query's assignment row by row: window, H3 cell, murmurhash of salt || switch start || cell"""
+    groups, hexes = [], []
+    for ts, lat, lng in zip(df['utc_dttm'], df['fromlatitude'], df['fromlongitude']):
+        inside = df_exp[(df_exp['switch_start_dttm'] <= ts) & (ts < df_exp['switch_finish_dttm'])]
+        if not len(inside):
+            groups.append('Before')
+            hexes.append(h3.latlng_to_cell(lat, lng, 7))
+            continue
+        window = inside.iloc[0]
+        cell = h3.latlng_to_cell(lat, lng, int(window['hexagon_size']))
+        hexes.append(cell)
+        if window['is_hex']:
+            unix = int(window['switch_start_dttm'].timestamp())
+            mmhash = mmh3.hash(f"{window['exp_salt']}{unix}{cell}", signed=signed)
+            groups.append('A' if math.fmod(mmhash, 100) < 50 else 'Control')
+        else:
+            groups.append(window['group_name'])
+    return groups, hexes
+
+
+@pytest.mark.parametrize('signed', [False, True])
+def test_assign_groups_matches_per_row_assignment(experiment, signed):
+    df, df_exp = experiment
+    result = assign_groups(df.copy(), df_exp, 'utc_dttm', 'group_name', signed)
+    groups, hexes = assign_groups_loop(df, df_exp, signed)
+    assert result['group_name'].tolist() == groups
+    assert result['hex_from'].tolist() == hexes
+    assert set(groups) == {'A', 'Control', 'Before'}
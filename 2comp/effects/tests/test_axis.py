@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.axis import DistanceBins, find_axis_price, find_crossings, first_crossing, group_means
+
+
+@pytest.fixture(scope='module')
+def df_full():
+    """Recprices of A and Control crossing several times over distance, 30 switch intervals per group"""
+    rng = np.random.default_rng(0)
+    n = 60000
+    df = pd.DataFrame({
+        'group_name': np.where(rng.random(n) < .5, 'A', 'Control'),
+        'switch_start_dttm': pd.Timestamp('2024-05-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 30, n), unit='h'),
+        'distance': rng.gamma(2, 1500, n),
+    })
+    wave = np.where(df['group_name'] == 'A', 0.8 * np.sin(df['distance'] / 1500), 0)
+    df['recprice'] = 2 + df['distance'] / 1000 + wave + rng.normal(0, .5, n)
+    df.loc[rng.random(n) < .01, 'recprice'] = np.nan
+    return df
+
+
+def crossings_loop(df_full, bin_size):
+    """The effects.ipynb scan over every sign change: merge of the group means per bin, then two-line intersections"""
+    df = df_full[df_full['recprice'].notnull()].copy()
+    df['orders_distance_bin'] = (df['distance'] // bin_size) * bin_size
+    grouped = df.groupby(['orders_distance_bin', 'group_name'])['recprice'].mean().reset_index()
+    merged = pd.merge(grouped[grouped['group_name'] == 'A'], grouped[grouped['group_name'] == 'Control'],
+                      on='orders_distance_bin', suffixes=('_a', '_control'))
+    merged['diff'] = merged['recprice_a'] - merged['recprice_control']
+    rows = []
+    for idx in merged.index[(merged['diff'].shift() * merged['diff']) < 0]:
+        x1, y1_a, y1_control = merged.loc[idx - 1, ['orders_distance_bin', 'recprice_a', 'recprice_control']]
+        x2, y2_a, y2_control = merged.loc[idx, ['orders_distance_bin', 'recprice_a', 'recprice_control']]
+        slope_a = (y2_a - y1_a) / (x2 - x1)
+        slope_control = (y2_control - y1_control) / (x2 - x1)
+        intercept_a = y1_a - slope_a * x1
+        intercept_control = y1_control - slope_control * x1
+        x_intersect = (intercept_control - intercept_a) / (slope_a - slope_control)
+        rows.append({'distance': x_intersect, 'axis_price': slope_a * x_intersect + intercept_a})
+    return pd.DataFrame(rows, columns=['distance', 'axis_price'])
+
+
+@pytest.mark.parametrize('bin_size', [300, 1000])
+def test_distance_bins_match_groupby(df_full, bin_size):
+    distance_bins = DistanceBins(df_full)
+    x, sums, counts = distance_bins.aggregate(bin_size)
+    df = df_full[df_full['recprice'].notnull()].copy()
+    df['orders_distance_bin'] = (df['distance'] // bin_size) * bin_size
+    expected = df.groupby(['group_name', 'switch_start_dttm', 'orders_distance_bin'])['recprice'].agg(['sum', 'count'])
+    intervals = pd.MultiIndex.from_frame(distance_bins.intervals)
+    for values, stat in [(sums, 'sum'), (counts, 'count')]:
+        result = pd.DataFrame(values, index=intervals, columns=x).stack()
+        result = result[counts.ravel() > 0]
+        np.testing.assert_allclose(result.sort_index().to_numpy(), expected[stat].sort_index().to_numpy(), rtol=1e-9)
+
+
+@pytest.mark.parametrize('bin_size', [300, 1000])
+def test_axis_price_matches_notebook_scan(df_full, bin_size):
+    df_crossings, ci = find_axis_price(df_full, bin_size, n_resamples=20)
+    expected = crossings_loop(df_full, bin_size)
+    assert len(expected) > 1
+    pd.testing.assert_frame_equal(df_crossings, expected, rtol=1e-9)
+    np.testing.assert_allclose(ci[['distance', 'axis_price']].to_numpy(dtype=float), expected.iloc[0], rtol=1e-9)
+
+
+def test_resampled_crossings_match_per_resample_loop(df_full):
+    distance_bins = DistanceBins(df_full)
+    x, sums, counts = distance_bins.aggregate(300)
+    is_treatment = distance_bins.is_treatment
+    rng = np.random.default_rng(1)
+    weights_control = rng.poisson(1.0, (50, (~is_treatment).sum())).astype(float)
+    weights_treatment = rng.poisson(1.0, (50, is_treatment.sum())).astype(float)
+    control, treatment = group_means(sums, counts, is_treatment, weights_control, weights_treatment)
+    crossing_x, crossing_y = first_crossing(*find_crossings(x, treatment - control, treatment))
+    for i in range(len(weights_control)):
+        ## the resample as repeated intervals
+        repeats = np.zeros(len(is_treatment), dtype='int64')
+        repeats[~is_treatment], repeats[is_treatment] = weights_control[i], weights_treatment[i]
+        resample = np.repeat(np.arange(len(is_treatment)), repeats)
+        means = group_means(sums[resample], counts[resample], is_treatment[resample])
+        np.testing.assert_allclose(control[i], means[0], rtol=1e-9)
+        np.testing.assert_allclose(treatment[i], means[1], rtol=1e-9)
+        is_crossing, x_cross, y_cross = find_crossings(x, means[1] - means[0], means[1])
+        expected_x, expected_y = (x_cross[is_crossing][0], y_cross[is_crossing][0]) if is_crossing.any() else (np.nan,) * 2
+        np.testing.assert_allclose([crossing_x[i], crossing_y[i]], [expected_x, expected_y], rtol=1e-9)
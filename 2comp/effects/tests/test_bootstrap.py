@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.bootstrap import get_switchback_results_bootstrap, interval_strata, mixed_strata, permute_within
+from src.metrics import METRIC_LIST, calculate_metrics
+
+from .conftest import GROUP_COLS
+
+
+@pytest.fixture(scope='module')
+def dfm(prepared):
+    """Control and A in every interval, as in a hex experiment"""
+    return calculate_metrics(*prepared, GROUP_COLS)
+
+
+@pytest.fixture(scope='module')
+def dfm_switchback(dfm):
+    """One group per interval, alternating"""
+    interval = pd.factorize(dfm['switch_start_dttm'], sort=True)[0]
+    return dfm[dfm['group_name'] == np.where(interval % 2, 'A', 'Control')].reset_index(drop=True)
+
+
+def bootstrap(df, **kwargs):
+    return get_switchback_results_bootstrap(df, 0.05, n_resamples=500, batch_size=200, **kwargs)
+
+
+def test_permute_within_keeps_strata():
+    strata = np.array([2, 0, 1, 0, 2, 2, 1, 0])
+    permutation, order = permute_within(strata, 50, rng=0)
+    moved = np.empty(permutation.shape, dtype='int64')
+    moved[:, order] = permutation
+    assert (strata[moved] == strata).all()
+    assert (np.sort(moved, axis=1) == np.arange(len(strata))).all()
+
+
+def test_mixed_strata():
+    strata = np.array([0, 0, 1, 1, 2])
+    is_treatment = np.array([True, False, True, True, False])
+    assert mixed_strata(strata, is_treatment).tolist() == [True, True, False, False, False]
+
+
+def test_strata_as_fine_as_intervals_fall_back_to_unstratified(dfm_switchback):
+    fine = bootstrap(dfm_switchback, strata=['day', 'hour'])
+    unstratified = bootstrap(dfm_switchback, strata=None)
+    pd.testing.assert_series_equal(fine['permutation_pvalue'], unstratified['permutation_pvalue'])
+    weekday = bootstrap(dfm_switchback)['permutation_pvalue']
+    assert (weekday.dropna() < 1).any()
+
+
+def test_shared_intervals_resample_both_groups_jointly(dfm):
+    ## A equal to Control in every interval: with the same weights every resample has a zero uplift
+    control = dfm[dfm['group_name'] == 'Control']
+    df = pd.concat([control, control.assign(group_name='A')], ignore_index=True)
+    df_res = bootstrap(df, permutation=False)
+    bounds = df_res[['uplift_abs_ci_low', 'uplift_abs_ci_high']].dropna().to_numpy()
+    assert len(bounds) and np.allclose(bounds, 0)
+
+
+def bootstrap_loop(df, n_resamples, alpha=0.05, method='poisson', strata=['weekday'], random_state=42):
+    """
+    The resampling of get_switchback_results_bootstrap one resample at a time, from the same random draws:
+    repeated interval rows and their ratios of sums, then labels shuffled within each stratum
+    """
+    rng = np.random.default_rng(random_state)
+    df = df[df['group_name'].isin(['Control', 'A'])].reset_index(drop=True)
+    df = df.fillna({col: 0 for _, numerator, denominator in METRIC_LIST for col in (numerator, denominator)})
+    is_treatment = (df['group_name'] == 'A').to_numpy()
+
+    def ratios(rows):
+        sub = df.loc[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.array([sub[numerator].sum() / sub[denominator].sum() for _, numerator, denominator in METRIC_LIST])
+
+    def draw(n):
+        return rng.poisson(1.0, n) if method == 'poisson' else rng.multinomial(n, np.full(n, 1 / n))
+
+    intervals = pd.factorize(df['switch_start_dttm'])[0]
+    if mixed_strata(intervals, is_treatment).any():
+        control, treatment = [], []
+        for _ in range(n_resamples):
+            rows = np.repeat(df.index, draw(intervals.max() + 1)[intervals])
+            control.append(ratios(rows[~is_treatment[rows]]))
+            treatment.append(ratios(rows[is_treatment[rows]]))
+    else:
+        control, treatment = [[ratios(np.repeat(np.flatnonzero(group), draw(group.sum())))
+                               for _ in range(n_resamples)] for group in (~is_treatment, is_treatment)]
+    control, treatment = np.array(control), np.array(treatment)
+    res = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, values in [('uplift_abs', treatment - control), ('uplift_rel', treatment / control - 1)]:
+            values = np.where(np.isfinite(values), values, np.nan)
+            res[f'{name}_ci_low'], res[f'{name}_ci_high'] = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                                                                             axis=0)
+
+    codes = interval_strata(df, strata)
+    order = np.argsort(codes, kind='stable')
+    blocks = np.split(np.arange(len(codes)), np.flatnonzero(np.diff(codes[order])) + 1)
+    observed = ratios(np.flatnonzero(is_treatment)) - ratios(np.flatnonzero(~is_treatment))
+    extreme, finite = np.zeros(len(METRIC_LIST)), np.zeros(len(METRIC_LIST))
+    for _ in range(n_resamples):
+        u = rng.random(len(codes))
+        labels = np.empty(len(codes), dtype=bool)
+        for block in blocks:
+            members = order[block]
+            labels[members] = is_treatment[members[np.argsort(u[block])]]
+        uplift = ratios(np.flatnonzero(labels)) - ratios(np.flatnonzero(~labels))
+        extreme += (np.abs(uplift) >= np.abs(observed) * (1 - 1e-12)) & np.isfinite(uplift)
+        finite += np.isfinite(uplift)
+    res['permutation_pvalue'] = np.where(np.isfinite(observed), (1 + extreme) / (1 + finite), np.nan)
+    return pd.DataFrame(res)
+
+
+@pytest.mark.parametrize('method', ['poisson', 'multinomial'])
+@pytest.mark.parametrize('shared', [False, True])
+def test_bootstrap_matches_per_resample_loop(dfm, dfm_switchback, method, shared):
+    df = dfm if shared else dfm_switchback
+    result = get_switchback_results_bootstrap(df, 0.05, n_resamples=120, method=method, batch_size=50)
+    expected = bootstrap_loop(df, 120, method=method)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, rtol=1e-9)
@@ -0,0 +1,72 @@
+import contextlib
+import io
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.cube import BIN_COLS, build_cube, load_cube
+from src.metrics import calculate_metrics
+from src.prepare import prepare_my
+
+from .conftest import GROUP_COLS, prepare_logs
+
+STEPS = [
+    (0.5, 5, np.unique([1.0, 1.5, 2.0]), np.arange(0, 26, 5)),
+    (0.25, 1, np.arange(1.0, 1.8, 0.25), np.arange(0, 13, 1)),
+]
+
+
+@pytest.fixture(scope='module', params=['single', 'multi'])
+def prepared_orders(request, logs, prepared):
+    """multi: 10% of the calcprices with a second order 0.5 km further, in another fine distance bin"""
+    if request.param == 'single':
+        return prepared
+    rec, orders = logs
+    rng = np.random.default_rng(3)
+    second = orders[orders['calcprice_uuid'].notnull()].sample(frac=.1, random_state=3).copy()
+    second['order_uuid'] = [str(uuid.UUID(int=int(i))) for i in rng.integers(0, 2 ** 62, len(second))]
+    second['distance_in_km'] += 0.5
+    return prepare_logs(rec, pd.concat([orders, second], ignore_index=True))
+
+
+@pytest.fixture(scope='module')
+def cube(prepared_orders):
+    return build_cube(*prepared_orders, bound_dynamic_surge=0.0)
+
+
+def metrics_rescan(prepared, group_cols, step_surge_bin, step_distance_bin, surge_bins, dist_bins):
+    """The prepare_my and calculate_metrics pass over the rows that the cube replaces"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = prepare_my(*prepared, bound_dynamic_surge=0.0, step_surge_bin=step_surge_bin,
+                            step_orders_distance_bin=step_distance_bin, filtered_surge_bin=surge_bins,
+                            filtered_dist_bins=dist_bins)
+    return calculate_metrics(*frames, group_cols)
+
+
+def assert_same_metrics(result, expected, group_cols):
+    result = result.sort_values(group_cols).reset_index(drop=True)
+    expected = expected.sort_values(group_cols).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False, rtol=1e-9)
+
+
+@pytest.mark.parametrize('steps', STEPS)
+@pytest.mark.parametrize('group_cols', [GROUP_COLS + BIN_COLS, ['group_name'] + BIN_COLS, BIN_COLS])
+def test_cube_metrics_match_rescan(prepared_orders, cube, steps, group_cols):
+    step_surge_bin, step_distance_bin, surge_bins, dist_bins = steps
+    result = cube.metrics(group_cols, step_surge_bin, step_distance_bin, surge_bins, dist_bins)
+    expected = metrics_rescan(prepared_orders, group_cols, *steps)
+    assert_same_metrics(result, expected, group_cols)
+
+
+def test_cube_needs_bin_columns(cube):
+    with pytest.raises(ValueError):
+        cube.metrics(GROUP_COLS + ['surge_bin'])
+
+
+def test_cube_save_load(cube, tmp_path):
+    cube.save(tmp_path / 'cube.parquet')
+    loaded = load_cube(tmp_path / 'cube.parquet')
+    group_cols = GROUP_COLS + BIN_COLS
+    pd.testing.assert_frame_equal(loaded.metrics(group_cols), cube.metrics(group_cols))
@@ -0,0 +1,149 @@
+import os
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+
+from src import download
+
+from .arrow_client import LocalArrowClient
+from .conftest import make_logs
+
+
+class RecordingJob:
+    def __init__(self, client, query):
+        self.client = client
+        self.query = query
+
+    def result(self):
+        self.client.calls.append('create' if 'CREATE' in self.query else 'result')
+        return self
+
+    def to_dataframe(self):
+        self.client.calls.append('select')
+        return pd.DataFrame({'exp_id': [7], 'utc_start_dttm': [pd.Timestamp('2024-05-01', tz='UTC')]})
+
+
+class RecordingClient:
+    def __init__(self):
+        self.calls = []
+
+    def query(self, query):
+        return RecordingJob(self, query)
+
+
+@pytest.fixture
+def bq_client(monkeypatch, tmp_path):
+    bq_client = RecordingClient()
+    monkeypatch.setattr(download, 'client', bq_client)
+    monkeypatch.setattr(download, 'CACHE_DIR', tmp_path / 'cache')
+    monkeypatch.setattr(download, 'EXP_IDS', {})
+    monkeypatch.setattr(download, 'EXP_TABLES', {})
+    return bq_client
+
+
+def download_all(stop_date='2024-05-02'):
+    download.download_experiment_data(7, 'user')
+    for function in [download.download_recprice_data, download.download_order_data]:
+        function('2024-05-01', stop_date, 1, 'ride', 'user', exp_id=7)
+
+
+def test_warm_cache_rerun_does_not_query(bq_client, monkeypatch):
+    download_all()
+    assert bq_client.calls == ['create', 'select', 'select', 'select']
+    # a new process: the experiment table is unknown, the cache is warm
+    monkeypatch.setattr(download, 'EXP_TABLES', {})
+    bq_client.calls.clear()
+    download_all()
+    assert bq_client.calls == []
+
+
+def test_cache_miss_creates_the_experiment_table_once(bq_client, monkeypatch):
+    download_all()
+    monkeypatch.setattr(download, 'EXP_TABLES', {})
+    bq_client.calls.clear()
+    download_all(stop_date='2024-05-03')
+    assert bq_client.calls == ['create', 'select', 'select']
+    bq_client.calls.clear()
+    download.download_experiment_data(7, 'user', refresh=True)
+    assert bq_client.calls == ['create', 'select']
+
+
+@pytest.fixture(scope='module')
+def orders_table(logs):
+    return pa.Table.from_pandas(logs[1], preserve_index=False)
+
+
+def test_streamed_batches_round_trip_through_parquet(orders_table, tmp_path):
+    bq_client = LocalArrowClient(lambda query: orders_table, batch_size=1000)
+    batches = download.stream_order_data('2024-05-01', '2024-05-02', 1, 'ride', 'user', bq_client=bq_client)
+    rows = download.write_batches_to_parquet(batches, tmp_path / 'orders.pqt')
+    assert rows == orders_table.num_rows
+    assert bq_client.queries == [download.get_order_query('2024-05-01', '2024-05-02', 1, 'ride', 'user')]
+    parquet_file = pq.ParquetFile(tmp_path / 'orders.pqt')
+    assert parquet_file.metadata.num_row_groups == -(-orders_table.num_rows // 1000)
+    assert parquet_file.read().equals(orders_table)
+
+
+def test_empty_result_writes_a_readable_file(orders_table, tmp_path):
+    empty = orders_table.slice(0, 0)
+    bq_client = LocalArrowClient(lambda query: empty)
+    batches = download.stream_recprice_data('2024-05-01', '2024-05-02', 1, 'ride', 'user', bq_client=bq_client)
+    assert download.write_batches_to_parquet(batches, tmp_path / 'empty.pqt', schema=empty.schema) == 0
+    assert pq.read_table(tmp_path / 'empty.pqt').equals(empty)
+    assert download.write_batches_to_parquet(iter([]), tmp_path / 'no_schema.pqt') == 0
+    assert pd.read_parquet(tmp_path / 'no_schema.pqt').empty
+
+
+def test_storage_client_is_optional(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'google.cloud.bigquery_storage', None)
+    assert download.get_bqstorage_client() is None
+
+
+@pytest.fixture
+def recprice_downloads(monkeypatch):
+    """download_recprice_data of 5 days of logs, recording the date ranges it is asked for"""
+    rec = make_logs(n_rec=5000, n_int=120, seed=2, before=False)[0]
+    calls = []
+
+    def download_recprice_data(start_date, stop_date, city_id, order_type, user_name):
+        calls.append((start_date, stop_date))
+        utc_date = rec['utc_recprice_dttm'].dt.tz_localize(None).dt.normalize()
+        return rec[(utc_date >= start_date) & (utc_date <= stop_date)].reset_index(drop=True)
+
+    monkeypatch.setattr(download, 'download_recprice_data', download_recprice_data)
+    monkeypatch.setattr(download, 'ensure_experiment_table', lambda user_name, exp_id=None: None)
+    return rec, calls
+
+
+def test_incremental_download_matches_full_download(recprice_downloads, tmp_path):
+    rec, calls = recprice_downloads
+    ## the partitions come back in date order, the query in no particular one
+    incremental = lambda **kwargs: download.download_recprice_data_incremental(
+        '2024-05-01', '2024-05-05', 1, 'ride', 'user', 7, data_root=tmp_path, **kwargs
+    ).sort_values('calcprice_uuid', ignore_index=True)
+    expected = download.download_recprice_data('2024-05-01', '2024-05-05', 1, 'ride', 'user').sort_values(
+        'calcprice_uuid', ignore_index=True)
+    assert len(expected) == len(rec)
+    calls.clear()
+
+    pd.testing.assert_frame_equal(incremental(), expected)
+    assert calls == [('2024-05-01', '2024-05-05')]
+    ## complete partitions are read back, one written before its date was over is downloaded again
+    calls.clear()
+    stale = pd.Timestamp('2024-05-03 12:00').timestamp()
+    os.utime(download.get_partition_path(tmp_path, pd.Timestamp('2024-05-03')), (stale, stale))
+    pd.testing.assert_frame_equal(incremental(), expected)
+    assert calls == [('2024-05-03', '2024-05-03')]
+    calls.clear()
+    download.get_partition_path(tmp_path, pd.Timestamp('2024-05-01')).unlink()
+    download.get_partition_path(tmp_path, pd.Timestamp('2024-05-04')).unlink()
+    pd.testing.assert_frame_equal(incremental(), expected)
+    assert calls == [('2024-05-01', '2024-05-01'), ('2024-05-04', '2024-05-04')]
+    calls.clear()
+    pd.testing.assert_frame_equal(incremental(refresh=True), expected)
+    assert calls == [('2024-05-01', '2024-05-05')]
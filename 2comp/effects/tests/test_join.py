@@ -0,0 +1,71 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.join import JoinIndex
+from src.prepare import get_full_df
+
+
+def get_full_df_merge(df_left, df_right):
+    """get_full_df before JoinIndex"""
+    group_cols = ['calcprice_uuid']
+    right_columns = set(df_right.columns) - (set(df_left.columns) & set(df_right.columns) - set(group_cols))
+    df_right = df_right[list(right_columns)]
+    df_full = df_left.merge(df_right, on=group_cols, how='left')
+    df_full = df_full[round(df_full.recprice_usd, 3) == round(df_full.price_highrate_usd, 3)]
+    print(f'только уникальные ордера? – {df_full.shape[0] == df_full.order_uuid.nunique()}')
+    print(f'доля оставшихся ордеров: {round(df_full.order_uuid.nunique() / df_left.order_uuid.nunique(), 4)}')
+    return df_full
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    keys = np.array(['a', 'b', 'c', 'd', None], dtype=object)
+    left = pd.DataFrame({'key': rng.choice(keys, 300), 'x': np.arange(300), 'shared': 1.0})
+    right = pd.DataFrame({'key': rng.choice(keys[1:], 40), 'y': rng.normal(size=40), 'shared': 2.0})
+    return left, right
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_join_matches_merge(frames, reverse):
+    left, right = frames[::-1] if reverse else frames
+    index = JoinIndex(*frames, on='key')
+    columns = [col for col in right.columns if col not in left.columns]
+    expected = left.merge(right[['key'] + columns], on='key', how='left')
+    pd.testing.assert_frame_equal(index.join(left, right, reverse=reverse), expected)
+    with pytest.raises(ValueError):
+        index.join(left.iloc[1:], right, reverse=reverse)
+
+
+@pytest.mark.parametrize('duplicates', [False, True])
+def test_get_full_df_matches_merge(prepared, duplicates):
+    df_recprice, df_order, _ = prepared
+    if duplicates:
+        ## repeated order rows and a few orders without an order_uuid
+        df_order = pd.concat([df_order, df_order.sample(frac=.1, random_state=0)], ignore_index=True)
+        df_order.loc[df_order.sample(frac=.02, random_state=1).index, 'order_uuid'] = None
+    out, expected_out = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(out):
+        result = get_full_df(df_order, df_recprice)
+    with contextlib.redirect_stdout(expected_out):
+        expected = get_full_df_merge(df_order, df_recprice)
+    assert out.getvalue() == expected_out.getvalue()
+    assert sorted(result.columns) == sorted(expected.columns)
+    # the merge makes integer columns float for the unmatched orders it drops afterwards
+    pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+
+
+def test_prepare_my_joins_match_merge(prepared):
+    df_recprice, df_order, _ = prepared
+    index = JoinIndex(df_order, df_recprice, on='calcprice_uuid')
+    pd.testing.assert_frame_equal(
+        index.join(df_recprice, df_order, ['distance_in_km'], reverse=True),
+        df_recprice.merge(df_order[['calcprice_uuid', 'distance_in_km']], on=['calcprice_uuid'], how='left'))
+    pd.testing.assert_frame_equal(
+        index.join(df_order, df_recprice, ['original_dynamic_surge_updated']),
+        df_order.merge(df_recprice[['calcprice_uuid', 'original_dynamic_surge_updated']], on=['calcprice_uuid'],
+                       how='left'))
@@ -0,0 +1,87 @@
+import contextlib
+import io
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import metrics
+from src.aggregate import encode_groups
+from src.metrics import (METRIC_REGISTRY, add_pre_period_covariates, calculate_metrics, flatten_switchback_results,
+                         get_switchback_cell_results, get_switchback_results)
+from src.prepare import prepare_my
+
+from .conftest import GROUP_COLS
+
+CALCULATE_GROUP_COLS = [GROUP_COLS, ['group_name'], ['group_name', 'utc_hour', 'local_dt']]
+
+
+def calculate_metrics_chain(df_recprice, df_order, df_full, group_cols):
+    """calculate_metrics before the registry: one metric_* groupby per metric merged onto calcprices_count"""
+    frames = {'recprice': df_recprice, 'order': df_order, 'full': df_full}
+    functions = {'orders_recprice_count': metrics.metric_orders_by_recprice_neighborhood_10_count}
+    parts = [functions.get(name, getattr(metrics, f'metric_{name}', None))(frames[source], group_cols)
+             for name, source, _, _, _ in METRIC_REGISTRY]
+    return reduce(lambda left, right: left.merge(right, on=group_cols, how='left'), parts)
+
+
+@pytest.mark.parametrize('group_cols', CALCULATE_GROUP_COLS)
+def test_calculate_metrics_matches_merge_chain(prepared, group_cols):
+    expected = calculate_metrics_chain(*prepared, group_cols)
+    # the chain sums the object-dtype flags of prepare_order_data into object columns
+    pd.testing.assert_frame_equal(calculate_metrics(*prepared, group_cols), expected, rtol=1e-9, check_dtype=False)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'pandas'])
+def test_calculate_metrics_backends_agree(prepared, backend):
+    expected = calculate_metrics_chain(*prepared, GROUP_COLS)
+    pd.testing.assert_frame_equal(calculate_metrics(*prepared, GROUP_COLS, backend=backend), expected, rtol=1e-9,
+                                  check_dtype=False)
+
+
+def test_calculate_metrics_reuses_group_codes(prepared):
+    group_codes = encode_groups(list(prepared), GROUP_COLS)
+    expected = calculate_metrics(*prepared, GROUP_COLS)
+    for _ in range(2):
+        pd.testing.assert_frame_equal(calculate_metrics(*prepared, GROUP_COLS, group_codes=group_codes), expected)
+    with pytest.raises(ValueError):
+        calculate_metrics(prepared[0].iloc[1:], *prepared[1:], GROUP_COLS, group_codes=group_codes)
+
+
+def test_switchback_cell_results_match_per_cell_loop(prepared):
+    surge_bins, dist_bins = np.unique([1.0, 1.5, 2.0]), np.arange(0, 26, 5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = prepare_my(*prepared, bound_dynamic_surge=1.0, step_surge_bin=0.5, step_orders_distance_bin=5,
+                            filtered_surge_bin=surge_bins, filtered_dist_bins=dist_bins)
+    rows = []
+    for surge_bin in surge_bins:
+        for dist_bin in dist_bins:
+            cell = [df[(df['surge_bin'] == surge_bin) & (df['orders_distance_bin'] == dist_bin)] for df in frames]
+            row = {'surge_bin': surge_bin, 'dist_bin': dist_bin}
+            row.update(flatten_switchback_results(get_switchback_results(calculate_metrics(*cell, GROUP_COLS), 0.05)))
+            rows.append(row)
+    expected = pd.DataFrame(rows)
+    result = get_switchback_cell_results(*frames, 0.05, surge_bins, dist_bins)
+    # obs_needed of an exactly zero effect is round-off in the loop (~1e34) and NaN from the moments
+    for column in [i for i in result.columns if i.endswith('.obs_needed')]:
+        zero = result[column.replace('.obs_needed', '.effect_size')] == 0
+        expected.loc[zero, column] = np.nan
+    pd.testing.assert_frame_equal(result, expected, rtol=1e-9)
+
+
+def test_pre_period_covariates_match_per_interval_loop(prepared):
+    ## the 'Before' hours of the synthetic logs match the same UTC hours of the experiment
+    slot_cols = ['utc_hour']
+    dfm = calculate_metrics(*prepared, GROUP_COLS)
+    result = add_pre_period_covariates(dfm, *prepared, slot_cols=slot_cols)
+    before = [df[df['group_name'] == 'Before'] for df in prepared]
+    metric_cols = [name for name, _, _, _, _ in METRIC_REGISTRY]
+    expected = pd.DataFrame(np.nan, index=dfm.index, columns=[f'{col}_pre' for col in metric_cols])
+    for i, ts in dfm['switch_start_dttm'].items():
+        slot = [df[df['utc_hour'] == ts.hour] for df in before]
+        if len(slot[0]):
+            expected.loc[i] = calculate_metrics(*slot, slot_cols)[metric_cols].to_numpy(dtype=float)[0]
+    assert expected.notna().any(axis=1).sum() == 6
+    pd.testing.assert_frame_equal(result[dfm.columns], dfm)
+    pd.testing.assert_frame_equal(result[expected.columns].astype(float), expected)
@@ -0,0 +1,65 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.metrics import calculate_metrics, get_switchback_results
+from src.online import GROUP_COLS, OnlineMetrics
+from src.prepare import prepare_my
+
+SOURCES = ['recprice', 'order', 'full']
+STATS = ['control_value', 'experimental_value', 'uplift_abs', 'pvalue', 'n_obs_control', 'n_obs_experimental']
+
+
+@pytest.fixture(scope='module')
+def frames(prepared):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return prepare_my(*prepared, bound_dynamic_surge=1.0, step_surge_bin=0.5, step_orders_distance_bin=5)
+
+
+def feed(online, frames, n_batches=3, seed=0):
+    """The rows of every source in random batches, the sources interleaved"""
+    rng = np.random.default_rng(seed)
+    batches = [(source, part) for source, df in zip(SOURCES, frames)
+               for part in np.array_split(rng.permutation(len(df)), n_batches)]
+    for i in rng.permutation(len(batches)):
+        source, rows = batches[i]
+        online.update(frames[SOURCES.index(source)].iloc[np.sort(rows)], source)
+    return online
+
+
+@pytest.fixture(scope='module')
+def expected(frames):
+    return calculate_metrics(*frames, GROUP_COLS)
+
+
+def test_online_metrics_match_calculate_metrics(frames, expected):
+    result = feed(OnlineMetrics(), frames).metrics()
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+
+def test_merged_accumulators_match_one(frames, expected):
+    halves = [[df.iloc[i::2] for df in frames] for i in range(2)]
+    online = feed(OnlineMetrics(), halves[0]).merge(feed(OnlineMetrics(), halves[1], seed=1))
+    pd.testing.assert_frame_equal(online.metrics(), expected, check_dtype=False, rtol=1e-9)
+
+
+def test_results_match_get_switchback_results_per_cell(frames, expected):
+    result = feed(OnlineMetrics(), frames).results()
+    cell_cols = ['surge_bin', 'orders_distance_bin']
+    for cell, df_res in result.groupby(cell_cols):
+        dfm = expected[(expected[cell_cols] == cell).all(axis=1)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            loop = get_switchback_results(dfm, 0.05)
+        pd.testing.assert_frame_equal(df_res.set_index('metric')[STATS], loop.set_index('metric')[STATS],
+                                      check_dtype=False, rtol=1e-7)
+
+
+def test_hll_distinct_counts(frames, expected):
+    result = feed(OnlineMetrics(distinct='hll', precision=10), frames, n_batches=1).metrics()
+    exact = expected['orders_count'].to_numpy(dtype=float)
+    large = exact >= 10
+    assert large.any()
+    np.testing.assert_allclose(result['orders_count'].to_numpy()[large], exact[large], rtol=0.1)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+
+from src.optimize import evaluate_configs, fit_logit, sigmoid
+from src.simulate import get_distance_bins, two_component_highrate
+
+SURGE = 'original_dynamic_surge_updated'
+
+
+@pytest.fixture(scope='module')
+def df_model():
+    bins = np.arange(0, 26, 1.0)
+    return pd.DataFrame({'distance_bin': bins, 'cp2order_intercept': -0.5, 'cp2order_elasticity': -1 - 0.1 * bins,
+                         'order2done_intercept': 1.0, 'order2done_elasticity': -0.5})
+
+
+def evaluate_config_loop(df, df_model, alpha, axis_price):
+    df = df.dropna(subset=['price_base_usd', SURGE, 'log_distance_in_km'])
+    df = df[df['price_base_usd'] > 0]
+    coefs = df_model.set_index('distance_bin').loc[get_distance_bins(df['log_distance_in_km'])]
+    prices = two_component_highrate(df['price_base_usd'], df[SURGE], alpha, axis_price, df['minprice_usd'])
+    log_ratio = np.log(prices / df['price_base_usd']).to_numpy()
+    orders = sigmoid(coefs['cp2order_intercept'].to_numpy() + coefs['cp2order_elasticity'].to_numpy() * log_ratio)
+    rides = orders * sigmoid(coefs['order2done_intercept'].to_numpy()
+                             + coefs['order2done_elasticity'].to_numpy() * log_ratio)
+    return {'cp2order': orders.mean(), 'cp2done': rides.mean(), 'recprice_usd': prices.mean(),
+            'gmv': (rides * prices.to_numpy()).mean()}
+
+
+@pytest.mark.parametrize('max_cells', [20_000_000, 1000])
+def test_evaluate_configs_matches_per_config_loop(logs, df_model, max_cells):
+    result = evaluate_configs(logs[0], df_model, [0.2, 1.0], [3.0, 6.0], max_cells=max_cells)
+    current = evaluate_config_loop(logs[0], df_model, 1.0, 0.0)
+    for _, row in result.iterrows():
+        expected = evaluate_config_loop(logs[0], df_model, row['alpha'], row['axis_price'])
+        for key, value in expected.items():
+            assert row[key] == pytest.approx(value, rel=1e-10)
+            assert row[f'{key}_uplift_rel'] == pytest.approx(value / current[key] - 1, abs=1e-10)
+
+
+def test_fit_logit_matches_statsmodels():
+    rng = np.random.default_rng(0)
+    groups = np.repeat([0, 1], 30)
+    x = rng.normal(0, 0.3, 60)
+    trials = rng.integers(50, 500, 60)
+    successes = rng.binomial(trials, sigmoid(np.where(groups, 0.5 - 2 * x, -1 + x)))
+    intercept, slope = fit_logit(x, trials, successes, groups, 2, ridge=0)
+    for group in [0, 1]:
+        rows = groups == group
+        fit = sm.GLM(np.c_[successes[rows], trials[rows] - successes[rows]], sm.add_constant(x[rows]),
+                     family=sm.families.Binomial()).fit()
+        np.testing.assert_allclose([intercept[group], slope[group]], fit.params, rtol=1e-6)
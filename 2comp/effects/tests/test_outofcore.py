@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.metrics import calculate_metrics
+from src.outofcore import calculate_metrics_duckdb
+
+from .conftest import GROUP_COLS, make_logs, prepare_logs
+
+
+@pytest.fixture(scope='module')
+def edge_logs():
+    """Logs with zero highrate prices and highrate prices half a rounding step off the recprice"""
+    rec, orders = make_logs(n_rec=10000, seed=1)
+    rng = np.random.default_rng(1)
+    rows = rng.random(len(orders))
+    orders.loc[rows < 0.03, 'price_highrate_usd'] = 0.0
+    orders.loc[rows < 0.01, 'price_start_usd'] = 0.0
+    half = (rows >= 0.03) & (rows < 0.2)
+    orders.loc[half, 'price_highrate_usd'] += rng.choice([-0.0005, 0.0005, 0.0004999, 0.0005001], half.sum())
+    return rec, orders
+
+
+def assert_metrics_equal(result, expected):
+    result, expected = result.copy(), expected.copy()
+    for df in (result, expected):
+        for col in GROUP_COLS[1:]:
+            df[col] = df[col].astype('datetime64[ns, UTC]')
+        df['group_name'] = df['group_name'].astype(str)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+
+def test_duckdb_backend_matches_pandas(edge_logs):
+    frames = prepare_logs(*edge_logs)
+    expected = calculate_metrics(*frames, GROUP_COLS, backend='pandas')
+    assert_metrics_equal(calculate_metrics(*frames, GROUP_COLS, backend='duckdb'), expected)
+
+
+def test_raw_parquet_matches_pandas(edge_logs, tmp_path):
+    ## df_full built in SQL: the round to 3 decimals and the zero highrate prices of the orders
+    for name, df, column in [('recprice', edge_logs[0], 'utc_recprice_dttm'), ('order', edge_logs[1], 'utc_order_dttm')]:
+        for date, part in df.groupby(df[column].dt.date):
+            path = tmp_path / name / f'utc_date={date}'
+            path.mkdir(parents=True)
+            part.to_parquet(path / 'part-0.pqt', index=False)
+    result = calculate_metrics_duckdb(str(tmp_path / 'recprice/*/*.pqt'), str(tmp_path / 'order/*/*.pqt'), None,
+                                      GROUP_COLS)
+    expected = calculate_metrics(*prepare_logs(*edge_logs), GROUP_COLS, backend='pandas')
+    assert_metrics_equal(result, expected)
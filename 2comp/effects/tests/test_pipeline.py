@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+import statsmodels.api as sm
+
+from src.metrics import METRIC_LIST, calculate_metrics, get_switchback_results
+from src.pipeline import MomentsRatioMetricHypothesisTestingPipeline, RatioMetricHypothesisTestingPipeline
+
+from .conftest import GROUP_COLS
+
+STATS = ['control_value', 'experimental_value', 'uplift_abs', 'uplift_rel', 'pvalue', 'effect_size',
+         'n_obs_control', 'n_obs_experimental', 'power', 'obs_needed']
+
+
+@pytest.fixture(scope='module')
+def dfm(prepared):
+    return calculate_metrics(*prepared, GROUP_COLS)
+
+
+def get_switchback_results_loop(df, alpha, metric_list=METRIC_LIST, groups={"control": "Control", "treatment": "A"}):
+    """get_switchback_results before the batch pipeline: one RatioMetricHypothesisTestingPipeline per metric"""
+    res_list = []
+    for i in metric_list:
+        test = RatioMetricHypothesisTestingPipeline(df, i[0], i[1], i[2], groups)
+        test.run()
+        res_list.append(test.result)
+    df_res = pd.DataFrame(res_list)
+    df_res['is_significant'] = df_res['pvalue'] < alpha
+    return df_res
+
+
+@pytest.mark.parametrize('rows', [None, 3])
+def test_batch_pipeline_matches_per_metric_loop(dfm, ttest_ind, rows):
+    df = dfm
+    if rows is not None:
+        # a few intervals, and a metric whose treatment denominator is zero
+        df = dfm.groupby('group_name').head(rows).copy()
+        df.loc[df['group_name'] == 'A', 'tenders_count'] = 0
+    expected = get_switchback_results_loop(df, 0.05)
+    result = get_switchback_results(df, 0.05)
+    expected = expected.astype({col: float for col in STATS}).reindex(columns=result.columns)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-7)
+
+
+def test_batch_pipeline_welch(dfm):
+    result = get_switchback_results(dfm, 0.05, equal_var=False)
+    for metric, numerator, denominator in METRIC_LIST:
+        control, treatment = (dfm[dfm['group_name'] == group][[numerator, denominator]].fillna(0).to_numpy(dtype=float)
+                              for group in ['Control', 'A'])
+        k = control[:, 0].sum() / control[:, 1].sum()
+        expected = scipy.stats.ttest_ind(control[:, 0] - k * control[:, 1], treatment[:, 0] - k * treatment[:, 1],
+                                         equal_var=False).pvalue
+        np.testing.assert_allclose(result.loc[result['metric'] == metric, 'pvalue'], expected, rtol=1e-7)
+
+
+@pytest.mark.parametrize('equal_var', [True, False])
+def test_delta_pipeline_matches_ttest_from_stats(dfm, equal_var):
+    ## unequal group sizes: the pooled variance differs from the sum of the group variances
+    dfm = dfm[(dfm['group_name'] == 'A') | (np.arange(len(dfm)) % 3 == 0)]
+    result = MomentsRatioMetricHypothesisTestingPipeline(dfm, METRIC_LIST, {'control': 'Control', 'treatment': 'A'},
+                                                         equal_var, variance='delta').run()
+    for metric, numerator, denominator in METRIC_LIST:
+        stats = []
+        for group in ['Control', 'A']:
+            x, y = dfm.loc[dfm['group_name'] == group, [numerator, denominator]].fillna(0).to_numpy(dtype=float).T
+            r = x.sum() / y.sum()
+            ## per-interval deviation of the group's own ratio, on the ratio scale
+            stats += [r, np.std((x - r * y) / y.mean(), ddof=1), len(x)]
+        expected = scipy.stats.ttest_ind_from_stats(*stats, equal_var=equal_var).pvalue
+        np.testing.assert_allclose(result.loc[result['metric'] == metric, 'pvalue'], expected, rtol=1e-7)
+
+
+def cuped_reference(df, numerator, denominator, adjustment):
+    """
+    CUPED of one metric with statsmodels: theta is the covariate coefficient of the OLS of the linearized
+    intervals on the group and the covariate ('cuped'), or on the covariate within each group ('regression')
+    """
+    df = df[df['group_name'].isin(['Control', 'A'])]
+    is_control = (df['group_name'] == 'Control').to_numpy()
+    x, y = df[numerator].to_numpy(dtype=float), df[denominator].to_numpy(dtype=float)
+    linearized = x - x[is_control].sum() / y[is_control].sum() * y
+    pre = df[[f'{numerator}_pre', f'{denominator}_pre']].dropna()
+    covariate = pre.iloc[:, 0] - pre.iloc[:, 0].sum() / pre.iloc[:, 1].sum() * pre.iloc[:, 1]
+    covariate = (covariate - covariate.mean()).reindex(df.index, fill_value=0).to_numpy()
+    if adjustment == 'cuped':
+        exog = sm.add_constant(np.column_stack([~is_control, covariate]).astype(float))
+        thetas = [sm.OLS(linearized, exog).fit().params[2]] * 2
+    else:
+        thetas = [sm.OLS(linearized[rows], sm.add_constant(covariate[rows])).fit().params[1]
+                  for rows in [is_control, ~is_control]]
+    adjusted = linearized.copy()
+    for rows, theta in zip([is_control, ~is_control], thetas):
+        adjusted[rows] -= theta * covariate[rows]
+    variance = lambda values: values[is_control].var(ddof=1) + values[~is_control].var(ddof=1)
+    return {'theta': np.mean(thetas), 'variance_reduction': 1 - variance(adjusted) / variance(linearized),
+            'pvalue': scipy.stats.ttest_ind(adjusted[is_control], adjusted[~is_control]).pvalue}
+
+
+@pytest.fixture(scope='module')
+def dfm_pre():
+    """Intervals whose metrics follow their pre-period, some without a pre-period slot"""
+    rng = np.random.default_rng(1)
+    n = 300
+    df = pd.DataFrame({'group_name': np.where(np.arange(n) % 2, 'A', 'Control')})
+    for numerator, denominator in [('orders', 'calcprices'), ('rides', 'orders')]:
+        df[f'{denominator}_pre'] = rng.poisson(200, n).astype(float)
+        df[f'{numerator}_pre'] = df[f'{denominator}_pre'] * rng.uniform(.2, .4, n)
+        df[denominator] = df[f'{denominator}_pre'] * rng.normal(1, .1, n)
+        df[numerator] = df[f'{numerator}_pre'] * rng.normal(1, .1, n) * np.where(df['group_name'] == 'A', 1.02, 1)
+    df.loc[rng.random(n) < .1, ['orders_pre', 'calcprices_pre']] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('adjustment', ['cuped', 'regression'])
+def test_cuped_matches_ols(dfm_pre, ttest_ind, adjustment):
+    metric_list = [('conversion', 'orders', 'calcprices'), ('done', 'rides', 'orders')]
+    result = get_switchback_results(dfm_pre, 0.05, metric_list=metric_list, adjustment=adjustment)
+    for metric, numerator, denominator in metric_list:
+        expected = cuped_reference(dfm_pre, numerator, denominator, adjustment)
+        row = result[result['metric'] == metric].iloc[0]
+        assert row['variance_reduction'] > 0.2
+        for stat, value in expected.items():
+            np.testing.assert_allclose(row[stat], value, rtol=1e-7, err_msg=f'{metric} {stat}')
+
+
+def test_cuped_without_pre_period_is_unadjusted(dfm, ttest_ind):
+    result = get_switchback_results(dfm, 0.05, adjustment='cuped')
+    expected = get_switchback_results(dfm, 0.05)
+    np.testing.assert_array_equal(result['theta'], 0)
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
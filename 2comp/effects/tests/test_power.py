@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from statsmodels.stats.power import TTestIndPower
+
+from src.power import calc_nobs1, calc_power
+
+EFFECT_SIZES = [-0.8, -0.05, 0.01, 0.2, 0.5, 1.3]
+
+
+@pytest.mark.parametrize('ratio', [1.0, 0.7, 2.5])
+def test_calc_power_matches_statsmodels(ratio):
+    nobs1 = np.array([5, 20, 300, 5000])
+    effect_size, nobs1 = np.meshgrid(EFFECT_SIZES, nobs1)
+    expected = [TTestIndPower().power(effect_size=d, nobs1=n, alpha=0.05, ratio=ratio)
+                for d, n in zip(effect_size.ravel(), nobs1.ravel())]
+    np.testing.assert_allclose(calc_power(effect_size, nobs1, ratio=ratio).ravel(), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('ratio', [1.0, 2.5])
+def test_calc_nobs1_matches_statsmodels(ratio):
+    expected = [TTestIndPower().solve_power(effect_size=d, power=0.8, alpha=0.05, ratio=ratio) for d in EFFECT_SIZES]
+    np.testing.assert_allclose(calc_nobs1(EFFECT_SIZES, power=0.8, ratio=ratio), expected, rtol=1e-6)
+
+
+def test_undefined_inputs_give_nan():
+    assert np.isnan(calc_power([np.nan, 0.3], [10, 1])).all()
+    assert np.isnan(calc_nobs1([0.0, np.nan])).all()
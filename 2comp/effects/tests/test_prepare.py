@@ -0,0 +1,48 @@
+import h3
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import prepare
+from src.prepare import cell_to_parent, geo_to_cells, get_hexes
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    n = 3000
+    df = pd.DataFrame({'fromlatitude': 4.6 + rng.normal(0, .05, n), 'fromlongitude': -74.1 + rng.normal(0, .05, n)})
+    df.loc[rng.random(n) < .02, 'fromlatitude'] = np.nan
+    ## repeated points are indexed once
+    return pd.concat([df, df.iloc[:500]], ignore_index=True)
+
+
+def get_hex_loop(df, hex_size):
+    """get_hex before the distinct points: one h3 call per row"""
+    return [None if np.isnan(x) else h3.latlng_to_cell(x, y, hex_size)
+            for x, y in zip(df['fromlatitude'], df['fromlongitude'])]
+
+
+def test_get_hexes_matches_per_row_h3(points):
+    df = get_hexes(points.copy(), [7, 9])
+    for hex_size in [7, 9]:
+        expected = pd.Series(get_hex_loop(points, hex_size), dtype=object)
+        assert df[f'hex_from_calc_{hex_size}'].astype(object).fillna('').tolist() == expected.fillna('').tolist()
+
+
+def test_process_pool_by_default_for_many_points(points, monkeypatch):
+    monkeypatch.setattr(prepare, 'POOL_MIN_POINTS', 1000)
+    monkeypatch.setattr(prepare.os, 'cpu_count', lambda: 2)
+    used = []
+    executor = prepare.ProcessPoolExecutor
+    monkeypatch.setattr(prepare, 'ProcessPoolExecutor',
+                        lambda max_workers: used.append(max_workers) or executor(max_workers))
+    cells = geo_to_cells(points['fromlatitude'], points['fromlongitude'], 8)
+    assert used == [2]
+    assert (cells == geo_to_cells(points['fromlatitude'], points['fromlongitude'], 8, workers=1)).all()
+
+
+def test_cell_to_parent_matches_h3(points):
+    cells = geo_to_cells(points['fromlatitude'], points['fromlongitude'], 9, workers=1)
+    expected = [h3.str_to_int(h3.cell_to_parent(h3.int_to_str(int(cell)), 7)) if cell else 0 for cell in cells.tolist()]
+    assert cell_to_parent(cells, 7).tolist() == expected
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.quantiles import binned_percentile_frame, binned_percentiles, entity_percentiles
+
+QS = [0.0, 0.25, 0.5, 0.9, 0.9999, 1.0]
+
+
+def binned_percentile_notebook(df, x, bin_start='bin_start', frequency='frequency'):
+    """binned_percentile of choose cities.ipynb"""
+    data = df.reset_index(drop=True)
+    data['cumulative_frequency'] = data[frequency].cumsum()
+    total_frequency = data[frequency].sum()
+    percentile_freq = x * total_frequency
+    percentile_bin = data[data['cumulative_frequency'] >= percentile_freq].iloc[0]
+    bin_index = data.index[data['cumulative_frequency'] >= percentile_freq][0]
+    previous_cumulative = data.iloc[bin_index - 1]['cumulative_frequency'] if bin_index > 0 else 0
+    previous_bin_start = data.iloc[bin_index - 1][bin_start] if bin_index > 0 else 0
+    current_bin_start = percentile_bin[bin_start]
+    current_frequency = percentile_bin[frequency]
+    excess = percentile_freq - previous_cumulative
+    bin_range = current_bin_start - previous_bin_start
+    return previous_bin_start + (excess / current_frequency) * bin_range
+
+
+@pytest.fixture(scope='module')
+def histograms():
+    """2000 x 40 integer counts from 1 to 1e14: exact within an entity, far beyond 2**53 summed over all"""
+    rng = np.random.default_rng(0)
+    magnitudes = 10.0 ** rng.integers(0, 15, (2000, 1))
+    frequencies = np.round(rng.uniform(0, 1, (2000, 40)) * magnitudes)
+    frequencies[:, 0] += 1
+    bin_starts = np.arange(40) * 100.0
+    return frequencies, bin_starts
+
+
+def expected_percentiles(frequencies, bin_starts, rows):
+    return np.array([[binned_percentile_notebook(pd.DataFrame({'bin_start': bin_starts, 'frequency': frequencies[i]}), q)
+                      for q in QS] for i in rows])
+
+
+def test_binned_percentiles_match_notebook(histograms):
+    frequencies, bin_starts = histograms
+    rows = range(0, 2000, 7)
+    np.testing.assert_allclose(binned_percentiles(frequencies, bin_starts, QS)[rows],
+                               expected_percentiles(frequencies, bin_starts, rows), rtol=1e-12)
+
+
+def test_ragged_entity_percentiles_match_notebook(histograms):
+    frequencies, bin_starts = histograms
+    lengths = np.random.default_rng(1).integers(1, 41, len(frequencies))
+    mask = np.arange(40) < lengths[:, None]
+    codes = np.nonzero(mask)[0]
+    got = entity_percentiles(codes, np.broadcast_to(bin_starts, mask.shape)[mask], frequencies[mask], QS)
+    rows = range(0, 2000, 7)
+    expected = [[binned_percentile_notebook(pd.DataFrame({'bin_start': bin_starts[:lengths[i]],
+                                                          'frequency': frequencies[i, :lengths[i]]}), q)
+                 for q in QS] for i in rows]
+    np.testing.assert_allclose(got[rows], expected, rtol=1e-12)
+    assert not np.isnan(got).any()
+
+
+def test_binned_percentile_frame_groups(histograms):
+    frequencies, bin_starts = histograms
+    df = pd.DataFrame({'city_id': np.repeat(np.arange(50), 40), 'order_type': 'econom',
+                       'bin_start': np.tile(bin_starts, 50), 'frequency': frequencies[:50].ravel()})
+    got = binned_percentile_frame(df.sample(frac=1, random_state=0).sort_values('bin_start', kind='stable'), QS)
+    got = got.sort_values('city_id')[QS].to_numpy()
+    np.testing.assert_allclose(got, expected_percentiles(frequencies, bin_starts, range(50)), rtol=1e-12)
+
+
+def test_undefined_percentiles_are_nan():
+    got = binned_percentiles([[0, 0, 0], [1, 2, 1]], [0, 10, 20], [0.5, 1.5])
+    assert np.isnan(got[0]).all() and np.isnan(got[1, 1])
+    assert entity_percentiles([], [], [], [0.5], 2).shape == (2, 1)
@@ -0,0 +1,49 @@
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+from src import runner
+from src.metrics import calculate_metrics, get_switchback_results
+from src.runner import parse_exp_ids, run_experiments, run_in_pool
+
+from .conftest import GROUP_COLS, make_logs, prepare_logs
+
+
+def divide(a, b, scale=1):
+    return scale * a / b
+
+
+def run_experiment(exp_id, user_name, alpha=0.05):
+    """run_experiment on synthetic logs of every exp_id, without BigQuery; exp_id 0 fails"""
+    if exp_id == 0:
+        raise ValueError('no experiment 0')
+    with contextlib.redirect_stdout(io.StringIO()):
+        prepared = prepare_logs(*make_logs(n_rec=3000, n_int=10, seed=exp_id))
+    df_res = get_switchback_results(calculate_metrics(*prepared, GROUP_COLS), alpha=alpha)
+    df_res.insert(0, 'exp_id', exp_id)
+    return df_res
+
+
+def test_parse_exp_ids():
+    assert parse_exp_ids(['2081', '2102-2104', '2081,2110']) == [2081, 2102, 2103, 2104, 2110]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_in_pool_skips_failed_jobs(workers, capsys):
+    results = run_in_pool(divide, [(1, 2), (1, 0), (3, 1)], workers, name=lambda args: f'{args[0]}/{args[1]}',
+                          scale=2)
+    assert sorted(results) == [1.0, 6.0]
+    out = capsys.readouterr().out
+    assert '1/0: failed' in out and 'ZeroDivisionError' in out and '3/1: done' in out
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_experiments_matches_loop(monkeypatch, tmp_path, workers):
+    monkeypatch.setattr(runner, 'run_experiment', run_experiment)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run_experiments([3, 0, 1, 2], 'user', workers, output=tmp_path / 'results.pqt', alpha=0.1)
+    expected = pd.concat([run_experiment(exp_id, 'user', alpha=0.1) for exp_id in [1, 2, 3]], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected)
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / 'results.pqt'), expected)
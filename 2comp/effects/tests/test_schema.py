@@ -0,0 +1,52 @@
+import contextlib
+import io
+import uuid
+
+import h3
+import numpy as np
+import pandas as pd
+
+from src.metrics import calculate_metrics
+from src.prepare import get_full_df, prepare_order_data, prepare_recprice_data
+from src.schema import ORDER_SCHEMA, RECPRICE_SCHEMA, apply_schema, h3_to_int, read_parquet, uuid_to_binary
+
+from .conftest import GROUP_COLS
+
+
+def test_uuid_to_binary_matches_uuid_bytes():
+    rng = np.random.default_rng(0)
+    values = pd.Series([str(uuid.UUID(int=int(i) << 64 | int(j))) for i, j in rng.integers(0, 2 ** 63, (500, 2))],
+                       dtype=object)
+    values.iloc[[0, 7]] = None
+    values.iloc[1] = values.iloc[1].upper()
+    expected = [None if value is None else uuid.UUID(value).bytes for value in values]
+    assert [None if pd.isna(value) else value for value in uuid_to_binary(values)] == expected
+
+
+def test_h3_to_int_matches_h3():
+    rng = np.random.default_rng(0)
+    values = pd.Series([h3.latlng_to_cell(lat, lng, res) for lat, lng, res in
+                        zip(rng.uniform(-80, 80, 500), rng.uniform(-180, 180, 500), rng.integers(0, 16, 500))],
+                       dtype=object)
+    values.iloc[3] = None
+    expected = [0 if value is None else h3.str_to_int(value) for value in values]
+    assert h3_to_int(values).tolist() == expected
+
+
+def test_compact_logs_give_the_same_metrics(logs, prepared, tmp_path):
+    rec, orders = (apply_schema(df.copy(), schema) for df, schema in zip(logs, [RECPRICE_SCHEMA, ORDER_SCHEMA]))
+    assert sum(df.memory_usage(deep=True).sum() for df in (rec, orders)) < \
+        0.8 * sum(df.memory_usage(deep=True).sum() for df in logs)
+    ## the download cache keeps the compact dtypes
+    for name, df, schema in [('rec', rec, RECPRICE_SCHEMA), ('orders', orders, ORDER_SCHEMA)]:
+        df.to_parquet(tmp_path / f'{name}.pqt')
+        columns = [col for col in schema if col in df.columns]
+        pd.testing.assert_frame_equal(read_parquet(tmp_path / f'{name}.pqt')[columns], df[columns])
+    df_recprice = prepare_recprice_data(rec, compact=True)
+    df_order = prepare_order_data(orders, compact=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_full = get_full_df(df_order, df_recprice)
+    df_full['group_name'] = df_full['recprice_group_name']
+    result = calculate_metrics(df_recprice, df_order, df_full, GROUP_COLS).astype({'group_name': object})
+    # distances are float32
+    pd.testing.assert_frame_equal(result, calculate_metrics(*prepared, GROUP_COLS), check_dtype=False, rtol=1e-6)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from src.sequential import SequentialTest, group_sequential_bounds, pocock_spending
+
+
+def moments(x, y):
+    """Moments of one metric of intervals x, y: 1 x 6"""
+    return np.array([[len(x), x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()]])
+
+
+def test_obrien_fleming_bounds():
+    ## Lan-DeMets O'Brien-Fleming type, 5 equally spaced looks, two-sided alpha 0.05
+    expected = [4.877, 3.357, 2.680, 2.290, 2.031]
+    np.testing.assert_allclose(group_sequential_bounds(np.arange(1, 6) / 5), expected, atol=5e-3)
+
+
+def test_single_look_is_the_fixed_horizon_test():
+    assert group_sequential_bounds([1.0], spending=pocock_spending)[0] == pytest.approx(1.959964, abs=1e-4)
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_information_fraction_counts_both_groups(shared):
+    rng = np.random.default_rng(0)
+    n_intervals = 40
+    ## a switchback splits the intervals, a hex experiment has both groups in every interval
+    n_group = n_intervals if shared else n_intervals // 2
+    n_planned = 2 * n_intervals if shared else n_intervals
+    test = SequentialTest(['metric'], method='group_sequential', n_planned=n_planned)
+    for elapsed in [n_group // 4, n_group // 2]:
+        x, y = rng.poisson(10, (2, elapsed)), rng.poisson(20, (2, elapsed)) + 1
+        result = test.look(moments(x[0], y[0]), moments(x[1], y[1]))
+    assert result['information_fraction'] == pytest.approx(0.5)
+    assert result['bound'] == pytest.approx(group_sequential_bounds([0.25, 0.5])[1])
+
+
+def test_method_is_checked():
+    with pytest.raises(ValueError):
+        SequentialTest(['metric'], method='obf', n_planned=10)
+    with pytest.raises(ValueError):
+        SequentialTest(['metric'], method='group_sequential')
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.simulate import get_distance_bins, histogram_quantiles, simulate_recprice, two_component_highrate
+
+SURGE = 'original_dynamic_surge_updated'
+CONFIGS = [(0.0, 2.0), (0.35, 4.5), (1.0, 8.0)]
+
+
+def simulate_recprice_loop(df, alphas, axis_prices):
+    """One two_component_highrate and groupby per config"""
+    df = df.dropna(subset=['price_base_usd', SURGE, 'log_distance_in_km'])
+    distance_bin = get_distance_bins(df['log_distance_in_km'])
+    current = two_component_highrate(df['price_base_usd'], df[SURGE], 1.0, 0.0, df['minprice_usd'])
+    frames = []
+    for alpha in alphas:
+        for axis_price in axis_prices:
+            prices = two_component_highrate(df['price_base_usd'], df[SURGE], alpha, axis_price, df['minprice_usd'])
+            frame = pd.DataFrame({'price': prices, 'current': current, 'lower': prices < current,
+                                  'higher': prices > current, 'distance_bin': distance_bin})
+            frame = frame.groupby('distance_bin').agg(
+                calcprices_count=('price', 'size'), recprice_usd=('price', 'mean'),
+                current_recprice_usd=('current', 'mean'), lower_share=('lower', 'mean'),
+                higher_share=('higher', 'mean')).reset_index()
+            frames.append(frame.assign(alpha=alpha, axis_price=axis_price))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize('max_cells', [20_000_000, 1000])
+def test_simulate_recprice_matches_per_config_loop(logs, max_cells):
+    alphas, axis_prices = [i[0] for i in CONFIGS], [i[1] for i in CONFIGS]
+    result = simulate_recprice(logs[0], alphas, axis_prices, max_cells=max_cells)
+    expected = simulate_recprice_loop(logs[0], alphas, axis_prices)
+    columns = ['calcprices_count', 'recprice_usd', 'current_recprice_usd', 'lower_share', 'higher_share']
+    pd.testing.assert_frame_equal(result.set_index(['alpha', 'axis_price', 'distance_bin'])[columns],
+                                  expected.set_index(['alpha', 'axis_price', 'distance_bin'])[columns],
+                                  check_dtype=False, rtol=1e-10)
+
+
+def test_current_surge_is_alpha_one(logs):
+    result = simulate_recprice(logs[0], [1.0], [2.0, 8.0])
+    assert (result['lower_share'] == 0).all() and (result['higher_share'] == 0).all()
+    np.testing.assert_allclose(result['recprice_uplift_rel'], 0, atol=1e-12)
+
+
+def test_histogram_quantiles():
+    values = np.random.default_rng(0).gamma(3, 2, 200000)
+    edges = np.linspace(0, 60, 1201)
+    counts = np.histogram(values, edges)[0]
+    np.testing.assert_allclose(histogram_quantiles(counts, edges, [0.1, 0.5, 0.9]),
+                               np.quantile(values, [0.1, 0.5, 0.9]), atol=0.05)